@@ -4,6 +4,8 @@
 import pytest
 from iembot.basicbot import basicbot
 from pyiem.database import get_dbconnc
+from twisted.internet.testing import StringTransport
+from twisted.words.protocols.jabber.xmlstream import Authenticator, XmlStream
 
 
 @pytest.fixture()
@@ -12,6 +14,15 @@ def bot():
     return basicbot("iembot", None, xml_log_path="/tmp")
 
 
+@pytest.fixture()
+def xmlstream():
+    """A client XmlStream writing to a StringTransport."""
+    xs = XmlStream(Authenticator())
+    xs.namespace = "jabber:client"
+    xs.makeConnection(StringTransport())
+    return xs
+
+
 @pytest.fixture()
 def dbcursor(database):
     """Yield a cursor for the given database."""
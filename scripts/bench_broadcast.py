@@ -0,0 +1,89 @@
+"""Microbenchmark groupchat fan-out serialization.
+
+Compares calling basicbot.send_groupchat_elem for each room, which
+serializes the full stanza every time, with the serialize-once
+basicbot.broadcast_groupchat_elem path.
+
+    python bench_broadcast.py
+"""
+
+import sys
+import time
+
+from iembot.basicbot import basicbot
+from twisted.words.protocols.jabber.xmlstream import Authenticator, XmlStream
+from twisted.words.xish import domish
+
+
+class NullTransport:
+    """Count the bytes written."""
+
+    def __init__(self):
+        """Constructor"""
+        self.written = 0
+
+    def write(self, data):
+        """Pretend to write."""
+        self.written += len(data)
+
+
+def build_elem():
+    """Build a stanza that looks like a large ingest product."""
+    elem = domish.Element(("jabber:client", "message"))
+    elem["from"] = "iembot_ingest@localhost/laptop"
+    elem["type"] = "groupchat"
+    elem.addElement("body", None, "DMX issues SVR for Polk [IA] " * 4)
+    html = elem.addElement("html", "http://jabber.org/protocol/xhtml-im")
+    body = html.addElement("body", "http://www.w3.org/1999/xhtml")
+    body.addRawXml("<p>" + "Severe Thunderstorm Warning &amp; more " * 60)
+    body.addRawXml("</p>")
+    x = elem.addElement("x", "nwschat:nwsbot")
+    x["channels"] = "DMX,SVRDMX"
+    x["product_id"] = "202310031200-KDMX-WUUS53-SVRDMX"
+    return elem
+
+
+def timeit(func, loops):
+    """Return seconds per call."""
+    t0 = time.perf_counter()
+    for _ in range(loops):
+        func()
+    return (time.perf_counter() - t0) / loops
+
+
+def main(argv):
+    """Go Main Go."""
+    loops = int(argv[1]) if len(argv) > 1 else 200
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.conference = "conference.localhost"
+    bot.xmlstream = XmlStream(Authenticator())
+    bot.xmlstream.namespace = "jabber:client"
+    transport = NullTransport()
+    bot.xmlstream.transport = transport
+    elem = build_elem()
+    for count in [1, 50, 500]:
+        rooms = [f"room{i:03d}" for i in range(count)]
+        bot.rooms = {rm: {"joined": True} for rm in rooms}
+
+        def _legacy():
+            for room in rooms:
+                elem["to"] = f"{room}@{bot.conference}"
+                bot.send_groupchat_elem(elem)
+            bot.outbound.flush()
+
+        def _broadcast():
+            bot.broadcast_groupchat_elem(elem, rooms)
+            bot.outbound.flush()
+
+        n = max(loops // count, 5)
+        t_legacy = timeit(_legacy, n)
+        t_broadcast = timeit(_broadcast, n)
+        print(
+            f"{count:4d} rooms: per-room {t_legacy * 1e3:8.3f} ms "
+            f"broadcast {t_broadcast * 1e3:8.3f} ms "
+            f"speedup {t_legacy / t_broadcast:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,108 @@
+"""Benchmark chatlog memory use for 2,000 rooms.
+
+Every product is routed to a number of rooms and each room fetches its own
+copy of the product text from memcache.  Compare the legacy list of
+namedtuples with %Y%m%d%H%M%S timestamps against iembot.chatlog.RoomLog
+with epoch timestamps and strings shared through SharedStrings.
+
+    python bench_chatlog_memory.py [rooms] [products]
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from iembot.chatlog import (
+    CHATLOG_SIZE,
+    ROOM_LOG_ENTRY,
+    RoomLog,
+    SharedStrings,
+)
+
+
+def products(rooms, count):
+    """Generate (rooms, body, html, text) tuples for synthetic products."""
+    rnd = random.Random(42)
+    for i in range(count):
+        text = f"{i:06d} " + "SEVERE THUNDERSTORM WARNING " * 200
+        body = f"DMX issues SVR #{i} for Polk [IA] https://localhost/{i}"
+        yield rnd.sample(rooms, 30), body, f"<p>{body}</p>", text
+
+
+def legacy(rooms, count):
+    """The pre-RoomLog data structure."""
+    chatlog = {}
+    seqnum = 0
+    for targets, body, html, text in products(rooms, count):
+        for rm in targets:
+            roomlog = chatlog.setdefault(rm, [])
+            if len(roomlog) > 40:
+                roomlog.pop()
+            seqnum += 1
+            roomlog.insert(
+                0,
+                ROOM_LOG_ENTRY(
+                    seqnum=seqnum,
+                    timestamp=time.strftime("%Y%m%d%H%M%S"),
+                    # memcache hands every room its own copies
+                    log="".join(list(html)),
+                    author="iembot",
+                    product_id="",
+                    product_text="".join(list(text)),
+                    txtlog="".join(list(body)),
+                ),
+            )
+    return chatlog
+
+
+def ringbuffer(rooms, count):
+    """The RoomLog data structure."""
+    chatlog = {}
+    strings = SharedStrings()
+    seqnum = 0
+    for targets, body, html, text in products(rooms, count):
+        for rm in targets:
+            roomlog = chatlog.get(rm)
+            if roomlog is None:
+                roomlog = chatlog[rm] = RoomLog(CHATLOG_SIZE)
+            seqnum += 1
+            entry = ROOM_LOG_ENTRY(
+                seqnum=seqnum,
+                timestamp=int(time.time()),
+                log="".join(list(html)),
+                author="iembot",
+                product_id="",
+                product_text="".join(list(text)),
+                txtlog="".join(list(body)),
+            )
+            dropped = roomlog.append(strings.share(entry))
+            if dropped is not None:
+                strings.release(dropped)
+    return chatlog, strings
+
+
+def measure(func, rooms, count):
+    """Return (MB held, seconds)."""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    res = func(rooms, count)
+    elapsed = time.perf_counter() - t0
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del res
+    return current / 1e6, elapsed
+
+
+def main(argv):
+    """Go Main Go."""
+    nrooms = int(argv[1]) if len(argv) > 1 else 2000
+    count = int(argv[2]) if len(argv) > 2 else 3000
+    rooms = [f"room{i:04d}" for i in range(nrooms)]
+    for name, func in [("legacy", legacy), ("RoomLog", ringbuffer)]:
+        mb, elapsed = measure(func, rooms, count)
+        print(f"{name:8s} {mb:9.1f} MB {elapsed:7.2f} s")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,93 @@
+"""Benchmark routing fan-out against a synthetic subscription table.
+
+Replays a stream of ingest channel lists through the legacy per-stanza
+list scanning and through the memoized iembot.routing plans.
+
+    python bench_fanout.py [subscriptions] [messages]
+"""
+
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+from iembot.routing import FanoutPlanner
+
+
+def build_bot(subs):
+    """Create a bot-like object with ``subs`` room subscriptions."""
+    rnd = random.Random(42)
+    wfos = [f"W{i:03d}" for i in range(120)]
+    pils = ["SVR", "TOR", "FFW", "SVS", "LSR", "AFD", "NOW", "FLS", "SPS"]
+    channels = [f"{p}{w}" for p in pils for w in wfos] + wfos
+    rooms = [f"room{i:04d}" for i in range(max(subs // 10, 1))]
+    bot = SimpleNamespace(
+        routingtable={},
+        tw_routingtable={},
+        md_routingtable={},
+        webhooks_routingtable={},
+    )
+    for _ in range(subs):
+        bot.routingtable.setdefault(rnd.choice(channels), []).append(
+            rnd.choice(rooms)
+        )
+    for i in range(subs // 50):
+        bot.md_routingtable.setdefault(rnd.choice(channels), []).append(i)
+    return bot, channels
+
+
+def legacy(bot, channels):
+    """The pre-routing.py algorithm, returns number of targets."""
+    alertedRooms = []
+    alertedPages = []
+    for channel in channels:
+        for room in bot.routingtable.get(channel, []):
+            if room in alertedRooms:
+                continue
+            alertedRooms.append(room)
+        for user_id in bot.md_routingtable.get(channel, []):
+            if user_id in alertedPages:
+                continue
+            alertedPages.append(user_id)
+    return len(alertedRooms) + len(alertedPages)
+
+
+def main(argv):
+    """Go Main Go."""
+    subs = int(argv[1]) if len(argv) > 1 else 50_000
+    messages = int(argv[2]) if len(argv) > 2 else 5_000
+    bot, channels = build_bot(subs)
+    rnd = random.Random(0)
+    wfos = [c for c in channels if len(c) == 4]
+    # Outbreak: products repeatedly routed to a few dozen channel combos
+    combos = []
+    for _ in range(200):
+        wfo = rnd.choice(wfos)
+        combos.append(
+            [wfo, f"SVR{wfo}", f"TOR{wfo}", f"SVS{wfo}", f"LSR{wfo}"]
+            + rnd.sample(channels, 20)
+        )
+    stream = [rnd.choice(combos) for _ in range(messages)]
+
+    t0 = time.perf_counter()
+    for chans in stream:
+        legacy(bot, chans)
+    t_legacy = time.perf_counter() - t0
+
+    planner = FanoutPlanner(bot)
+    t0 = time.perf_counter()
+    for chans in stream:
+        plan = planner.plan(chans)
+        len(plan.rooms) + len(plan.mastodon)
+    t_plan = time.perf_counter() - t0
+
+    print(f"{subs} subscriptions, {messages} messages")
+    print(f"legacy: {t_legacy * 1e6 / messages:9.1f} us/message")
+    print(
+        f"plan  : {t_plan * 1e6 / messages:9.1f} us/message "
+        f"(hits {planner.hits} misses {planner.misses})"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
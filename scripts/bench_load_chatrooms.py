@@ -0,0 +1,129 @@
+"""Benchmark reloading the chatroom configuration.
+
+Feeds synthetic rooms and subscriptions through the legacy list based
+loader and through iembot.util's snapshot loader plus apply.
+
+    python bench_load_chatrooms.py [rooms] [subscriptions]
+"""
+
+import random
+import sys
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import iembot.util as botutil
+from iembot.routing import FanoutPlanner
+
+
+class FakeTxn:
+    """A cursor replaying canned result sets in query order."""
+
+    def __init__(self, results):
+        """Constructor"""
+        self.results = list(results)
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, *_args):
+        """Advance to the next result set."""
+        self._rows = self.results.pop(0)
+
+    def fetchall(self):
+        """Return the current result set."""
+        self.rowcount = len(self._rows)
+        return self._rows
+
+
+def build_results(nrooms, nsubs):
+    """Create the three result sets load_chatrooms_from_db reads."""
+    rnd = random.Random(42)
+    rooms = [f"room{i:05d}" for i in range(nrooms)]
+    channels = [f"CH{i:05d}" for i in range(nsubs // 4)]
+    subs = [
+        {"roomname": rnd.choice(rooms), "channel": rnd.choice(channels)}
+        for _ in range(nsubs)
+    ]
+    synd = [{"roomname": rooms[i], "endpoint": "x"} for i in range(50)]
+    rows = [{"roomname": rm, "twitter": None} for rm in rooms]
+    return [subs, synd, rows]
+
+
+def build_bot(nrooms):
+    """A bot-like object already in all but 1% of the rooms."""
+    bot = SimpleNamespace(
+        name="iembot",
+        conference="conference.localhost",
+        myjid=SimpleNamespace(user="iembot"),
+        xmlstream=mock.Mock(),
+        joins=mock.Mock(),
+        pending_sends=mock.Mock(),
+        outbound=mock.Mock(),
+        routingtable={},
+        syndication={},
+        rooms={
+            f"room{i:05d}": {"twitter": None, "occupants": {}, "joined": True}
+            for i in range(nrooms // 100, nrooms)
+        },
+    )
+    bot.fanout = FanoutPlanner(bot)
+    return bot
+
+
+def legacy(txn, bot):
+    """The pre-snapshot algorithm, minus the joins themselves."""
+    rt = {}
+    txn.execute()
+    rooms = []
+    for row in txn.fetchall():
+        rm = row["roomname"]
+        channel = row["channel"]
+        if channel not in rt:
+            rt[channel] = []
+        rt[channel].append(rm)
+        if rm not in rooms:
+            rooms.append(rm)
+    bot.routingtable = rt
+    synd = {}
+    txn.execute()
+    for row in txn.fetchall():
+        synd.setdefault(row["roomname"], []).append(row["endpoint"])
+    bot.syndication = synd
+    txn.execute()
+    oldrooms = list(bot.rooms.keys())
+    for row in txn.fetchall():
+        rm = row["roomname"]
+        if rm not in bot.rooms:
+            bot.rooms[rm] = {"twitter": None, "occupants": {}, "joined": 0}
+        bot.rooms[rm]["twitter"] = row["twitter"]
+        if rm in oldrooms:
+            oldrooms.remove(rm)
+    for rm in oldrooms:
+        del bot.rooms[rm]
+
+
+def main(argv):
+    """Go Main Go."""
+    nrooms = int(argv[1]) if len(argv) > 1 else 5_000
+    nsubs = int(argv[2]) if len(argv) > 2 else 100_000
+    results = build_results(nrooms, nsubs)
+    print(f"{nrooms} rooms, {nsubs} subscriptions")
+
+    bot = build_bot(nrooms)
+    start = time.perf_counter()
+    legacy(FakeTxn(results), bot)
+    print(f"legacy:   {time.perf_counter() - start:8.3f}s in a db thread")
+
+    bot = build_bot(nrooms)
+    with mock.patch("iembot.util.log"):
+        start = time.perf_counter()
+        snapshot = botutil.load_chatrooms_from_db(FakeTxn(results), bot)
+        loaded = time.perf_counter()
+        botutil.apply_chatrooms(snapshot, bot, False)
+        done = time.perf_counter()
+    print(f"snapshot: {loaded - start:8.3f}s in a db thread")
+    print(f"apply:    {done - loaded:8.3f}s on the reactor")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
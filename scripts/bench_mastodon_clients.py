@@ -0,0 +1,96 @@
+"""Count connections made posting toots with fresh versus cached clients.
+
+Several accounts on one local stub Mastodon server post toots from a few
+threads, as iembot does.  Fresh mastodon.Mastodon clients each open their
+own connection, while cached clients share the server's pooled session.
+
+    python bench_mastodon_clients.py [toots]
+"""
+
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import iembot.util as botutil
+import mastodon
+from iembot.clients import ClientCache, SessionPool
+
+CONNECTIONS = []
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer every POST like the statuses endpoint."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        """Count the connection."""
+        BaseHTTPRequestHandler.setup(self)
+        CONNECTIONS.append(self.client_address)
+
+    def do_POST(self):
+        """Create the status."""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"id": "1", "content": "x"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Be quiet."""
+
+
+def run(server, toots, cached):
+    """Post the toots, returning (seconds, connections)."""
+    bot = SimpleNamespace(
+        md_users={
+            i: {"access_token": f"{i}", "api_base_url": server}
+            for i in range(10)
+        },
+        md_clients=ClientCache(owns_sessions=False),
+        md_sessions=SessionPool(),
+    )
+
+    def _toot(i):
+        user_id = i % 10
+        if cached:
+            api = botutil.get_mastodon_client(bot, user_id)
+        else:
+            # what util.toot used to do
+            api = mastodon.Mastodon(
+                access_token=bot.md_users[user_id]["access_token"],
+                api_base_url=server,
+            )
+        api.status_post(status=f"{i}")
+
+    CONNECTIONS.clear()
+    sts = time.perf_counter()
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(_toot, range(toots)))
+    return time.perf_counter() - sts, len(CONNECTIONS)
+
+
+def main(argv):
+    """Go Main Go."""
+    toots = int(argv[1]) if len(argv) > 1 else 200
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    server = f"http://127.0.0.1:{httpd.server_port}"
+    for label, cached in [("fresh client", False), ("cached", True)]:
+        secs, conns = run(server, toots, cached)
+        print(
+            f"{label:12s}: {secs / toots * 1e3:.3f} ms per toot, "
+            f"{conns} connections for {toots} toots"
+        )
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
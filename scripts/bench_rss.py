@@ -0,0 +1,71 @@
+"""Benchmark RSS feed builds as new messages arrive in a full room.
+
+Compare regenerating the whole FeedGenerator for every new message against
+the incremental iembot.webservices.wfo_rss, which renders only the new item.
+
+    python bench_rss.py [messages]
+"""
+
+import sys
+import time
+from types import SimpleNamespace
+
+import iembot.util as botutil
+from feedgen.feed import FeedGenerator
+from iembot import webservices
+from iembot.chatlog import ROOM_LOG_ENTRY, RoomLog
+
+
+def make_entry(seqnum):
+    """Build a typical room log entry."""
+    body = f"DMX issues SVR #{seqnum} for Polk [IA] https://localhost/{seqnum}"
+    return ROOM_LOG_ENTRY(
+        seqnum=seqnum,
+        timestamp=1696334400 + seqnum,
+        log=f"<p>{body}</p>",
+        author="iembot",
+        product_id=f"202310031200-KDMX-WUUS53-SVRDMX-{seqnum}",
+        product_text="",
+        txtlog=body,
+    )
+
+
+def full(bot, rm):
+    """The pre-incremental build."""
+    rss = FeedGenerator()
+    rss.generator("iembot")
+    rss.title(f"{rm} IEMBot RSS Feed")
+    rss.link(href=f"https://weather.im/iembot-rss/room/{rm}.xml", rel="self")
+    rss.description(f"{rm} IEMBot RSS Feed")
+    lastts = time.gmtime(bot.chatlog[rm].newest().timestamp)
+    rss.lastBuildDate(time.strftime("%a, %d %b %Y %H:%M:%S GMT", lastts))
+    for entry in reversed(bot.chatlog[rm]):
+        botutil.add_entry_to_rss(entry, rss)
+    return rss.rss_str()
+
+
+def run(func, messages):
+    """Time a build after each new message."""
+    bot = SimpleNamespace(chatlog={"dmxchat": RoomLog()})
+    for seqnum in range(1, 42):
+        bot.chatlog["dmxchat"].append(make_entry(seqnum))
+    func(bot, "dmxchat")
+    sts = time.perf_counter()
+    for seqnum in range(42, 42 + messages):
+        bot.chatlog["dmxchat"].append(make_entry(seqnum))
+        xml = func(bot, "dmxchat")
+    return time.perf_counter() - sts, xml
+
+
+def main(argv):
+    """Go Main Go."""
+    messages = int(argv[1]) if len(argv) > 1 else 500
+    full_secs, full_xml = run(full, messages)
+    incr_secs, incr_xml = run(webservices.wfo_rss, messages)
+    assert full_xml == incr_xml
+    print(f"full rebuild: {full_secs / messages * 1e3:.3f} ms per message")
+    print(f"incremental:  {incr_secs / messages * 1e3:.3f} ms per message")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
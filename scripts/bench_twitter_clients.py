@@ -0,0 +1,88 @@
+"""Benchmark tweeting with fresh versus cached Twitter API clients.
+
+A local stub HTTP/1.1 server stands in for api.twitter.com.  With a fresh
+twitter.Api per tweet every post opens a new connection, while the cached
+client's session keeps its connection alive.  Against the real API the
+saving also includes the TLS handshake.
+
+    python bench_twitter_clients.py [tweets]
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import iembot.util as botutil
+from iembot.clients import ClientCache
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer every POST like the v2 tweets endpoint."""
+
+    protocol_version = "HTTP/1.1"
+    # the headers and body are separate writes, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        """Create the tweet."""
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"data": {"id": "1", "text": "x"}}).encode()
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Be quiet."""
+
+
+def make_bot():
+    """Just enough of a bot for get_twitter_client."""
+    return SimpleNamespace(
+        config={
+            "bot.twitter.consumerkey": "ck",
+            "bot.twitter.consumersecret": "cs",
+        },
+        tw_users={
+            1: {
+                "screen_name": "iembot",
+                "access_token": "at",
+                "access_token_secret": "ats",
+            }
+        },
+        tw_clients=ClientCache(),
+    )
+
+
+def run(url, tweets, cached):
+    """Time posting tweets."""
+    bot = make_bot()
+    sts = time.perf_counter()
+    for i in range(tweets):
+        if not cached:
+            bot.tw_clients.invalidate()
+        api, auth = botutil.get_twitter_client(bot, 1)
+        resp = api._session.post(url, auth=auth, json={"text": f"{i}"})
+        api._ParseAndCheckTwitter(resp.content.decode("utf-8"))
+    return time.perf_counter() - sts
+
+
+def main(argv):
+    """Go Main Go."""
+    tweets = int(argv[1]) if len(argv) > 1 else 500
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/2/tweets"
+    fresh = run(url, tweets, False)
+    cached = run(url, tweets, True)
+    server.shutdown()
+    print(f"fresh client: {fresh / tweets * 1e3:.3f} ms per tweet")
+    print(f"cached:       {cached / tweets * 1e3:.3f} ms per tweet")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
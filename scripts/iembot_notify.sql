@@ -0,0 +1,65 @@
+-- Send a NOTIFY for every row changed within the tables iembot routes by,
+-- see iembot.listener.  Run against the openfire database:
+--   psql -f iembot_notify.sql openfire
+-- A bot with a name other than iembot needs its tables added below.
+
+-- Only the columns identifying what changed are sent, as the payload is
+-- readable by any session that LISTENs and tokens must not end up there.
+-- The listener loads anything else it needs from the tables.
+CREATE OR REPLACE FUNCTION iembot_config_keys(r jsonb) RETURNS json AS $$
+    SELECT json_build_object(
+        'roomname', r -> 'roomname',
+        'channel', r -> 'channel',
+        'user_id', r -> 'user_id',
+        'id', r -> 'id',
+        'url', r -> 'url',
+        'batch_window_ms', r -> 'batch_window_ms',
+        'batch_size', r -> 'batch_size'
+    )
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION iembot_config_notify() RETURNS trigger AS $$
+DECLARE
+    payload text;
+BEGIN
+    payload := json_build_object(
+        'table', TG_TABLE_NAME,
+        'op', TG_OP,
+        'old', CASE WHEN TG_OP IN ('UPDATE', 'DELETE')
+            THEN iembot_config_keys(to_jsonb(OLD)) END,
+        'new', CASE WHEN TG_OP IN ('INSERT', 'UPDATE')
+            THEN iembot_config_keys(to_jsonb(NEW)) END
+    )::text;
+    -- pg_notify raises for 8000 bytes or more, which would abort the
+    -- write, so a huge row only says which table changed
+    IF octet_length(payload) >= 7900 THEN
+        payload := json_build_object(
+            'table', TG_TABLE_NAME, 'op', TG_OP)::text;
+    END IF;
+    PERFORM pg_notify('iembot_config', payload);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    tbl text;
+BEGIN
+    FOREACH tbl IN ARRAY ARRAY[
+        'iembot_room_subscriptions',
+        'iembot_rooms',
+        'iembot_webhooks',
+        'iembot_twitter_subs',
+        'iembot_twitter_oauth',
+        'iembot_mastodon_subs',
+        'iembot_mastodon_oauth'
+    ] LOOP
+        EXECUTE format(
+            'DROP TRIGGER IF EXISTS iembot_config_notify ON %I', tbl);
+        EXECUTE format(
+            'CREATE TRIGGER iembot_config_notify AFTER INSERT OR UPDATE '
+            'OR DELETE ON %I FOR EACH ROW '
+            'EXECUTE FUNCTION iembot_config_notify()', tbl);
+    END LOOP;
+END;
+$$;
@@ -1,52 +1,56 @@
 """ Basic iembot/nwsbot implementation. """
-import copy
 import datetime
 import os
-import pickle
 import random
 import re
 import traceback
-from collections import namedtuple
 from io import StringIO
 from xml.etree import ElementTree as ET
 
 from pyiem.util import utc
 from twisted.application import internet
-from twisted.internet import reactor, threads
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.python import log
-from twisted.python.logfile import DailyLogFile
 from twisted.words.protocols.jabber import client, error, jid, xmlstream
 from twisted.words.xish import domish, xpath
 from twisted.words.xish.xmlstream import STREAM_END_EVENT
 
 import iembot.util as botutil
+from iembot.chatlog import (
+    ROOM_LOG_ENTRY,
+    ChatlogJournal,
+    RoomLog,
+    RoomWatchers,
+    SharedStrings,
+)
+from iembot.clients import ClientCache, SessionPool
+from iembot.media import MediaCache
+from iembot.muc import JoinScheduler, PendingSends
+from iembot.outbound import OutboundQueue
+from iembot.posting import PostingScheduler
+from iembot.ratelimit import PRIORITY_NORMAL, RateLimiter
+from iembot.routing import FanoutPlanner, RoutingTable
+from iembot.webhooks import WebhookBatcher, WebhookClient
+from iembot.xmllog import XMLLogWriter
 
 DATADIR = os.sep.join([os.path.dirname(__file__), "data"])
-ROOM_LOG_ENTRY = namedtuple(
-    "ROOM_LOG_ENTRY",
-    [
-        "seqnum",
-        "timestamp",
-        "log",
-        "author",
-        "product_id",
-        "product_text",
-        "txtlog",
-    ],
-)
+__all__ = ["ROOM_LOG_ENTRY", "basicbot"]
 PRESENCE_MUC_ITEM = (
     "/presence/x[@xmlns='http://jabber.org/protocol/muc#user']/item"
 )
 PRESENCE_MUC_STATUS = (
     "/presence/x[@xmlns='http://jabber.org/protocol/muc#user']/status"
 )
+# Stand-in for the to attribute while building a broadcast template
+BROADCAST_PLACEHOLDER = "iembot-broadcast-to"
 
 
 class basicbot:
     """Here lies the Jabber Bot"""
 
     PICKLEFILE = "iembot_chatlog_v2.pickle"
+    JOURNALFILE = "iembot_chatlog.journal"
 
     def __init__(
         self, name, dbpool, memcache_client=None, xml_log_path="logs"
@@ -62,18 +66,48 @@ class basicbot:
         self.outstanding_pings = []
         self.rooms = {}
         self.chatlog = {}
+        self.chatlog_strings = SharedStrings()
+        self.chatlog_journal = ChatlogJournal(self.JOURNALFILE)
+        # Long-poll and streaming web clients waiting on room messages
+        self.chatlog_watchers = RoomWatchers()
         self.seqnum = 0
-        self.routingtable = {}
+        self.routingtable = RoutingTable()  # channel <=> room
         self.tw_users = {}  # Storage by user_id => {screen_name: ..., oauth:}
-        self.tw_routingtable = {}  # Storage by channel => [user_id, ]
+        self.tw_routingtable = RoutingTable()  # channel <=> user_id
+        self.tw_clients = ClientCache()  # user_id => (twitter.Api, OAuth1)
         # Storage by user_id => {access_token: ..., api_base_url: ...}
         self.md_users = {}
-        self.md_routingtable = {}  # Storage by channel => [user_id, ]
-        self.webhooks_routingtable = {}
+        self.md_routingtable = RoutingTable()  # channel <=> user_id
+        # user_id => mastodon.Mastodon, sharing a session per server
+        self.md_clients = ClientCache(owns_sessions=False)
+        self.md_sessions = SessionPool()
+        # twitter_media fetched once for all the accounts posting it
+        self.media = MediaCache()
+        # Queues the blocking tweet and toot calls per account
+        self.posting = PostingScheduler()
+        # Twitter budgets, fed by response headers, gate the scheduler
+        self.tw_limits = RateLimiter()
+        self.posting.gate = self.tw_limits.admit
+        reactor.callWhenRunning(self.posting.start)
+        self.webhooks_routingtable = RoutingTable()  # channel <=> url
+        # Storage by url => (batch window seconds, batch size)
+        self.webhooks_batching = {}
+        self.webhook_client = WebhookClient()
+        self.webhook_batcher = WebhookBatcher(self.webhook_client)
+        # Memoized channels => targets, invalidated by the loaders
+        self.fanout = FanoutPlanner(self)
+        # Paces the room joins after login
+        self.joins = JoinScheduler(self)
+        # Messages waiting on a room join
+        self.pending_sends = PendingSends()
+        # Batches writes to the xmlstream, IQ and presence first
+        self.outbound = OutboundQueue(self)
+        # iembot.listener.ConfigListener, when configured
+        self.listener = None
         self.xmlstream = None
         self.firstlogin = False
         self.syndication = {}
-        self.xmllog = DailyLogFile("xmllog", xml_log_path)
+        self.xmllog = XMLLogWriter("xmllog", xml_log_path)
         self.myjid = None
         self.ingestjid = None
         self.conference = None
@@ -85,15 +119,41 @@ class basicbot:
 
         lc2 = LoopingCall(botutil.purge_logs, self)
         lc2.start(60 * 60 * 24)
-        lc3 = LoopingCall(reactor.callInThread, self.save_chatlog)
-        lc3.start(600)  # Every 10 minutes
+        lc3 = LoopingCall(self.save_chatlog)
+        lc3.start(600, now=False)  # Every 10 minutes
+        reactor.addSystemEventTrigger("before", "shutdown", self.xmllog.stop)
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", self.chatlog_journal.close
+        )
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", self.webhook_client.close
+        )
 
     def save_chatlog(self):
-        """called from a thread"""
-        log.msg(f"Saving CHATLOG to {self.PICKLEFILE}")
-        with open(self.PICKLEFILE, "wb") as fh:
-            # unsure if deepcopy is necessary, but alas
-            pickle.dump(copy.deepcopy(self.chatlog), fh)
+        """Snapshot the room logs and compact the journal from a thread."""
+        if not self.chatlog_journal.rotate():
+            return
+        snapshot = {rm: list(roomlog) for rm, roomlog in self.chatlog.items()}
+        reactor.callInThread(self.chatlog_journal.compact, snapshot)
+
+    def append_chatlog(self, room, entry, journal=True):
+        """Add an entry to a room's chatlog.
+
+        Args:
+          room (str): the room name
+          entry (ROOM_LOG_ENTRY): the entry to log
+          journal (bool): should the entry be persisted to the journal
+        """
+        roomlog = self.chatlog.get(room)
+        if roomlog is None:
+            roomlog = self.chatlog[room] = RoomLog()
+        entry = self.chatlog_strings.share(entry)
+        dropped = roomlog.append(entry)
+        if dropped is not None:
+            self.chatlog_strings.release(dropped)
+        if journal:
+            self.chatlog_journal.append(room, entry)
+        self.chatlog_watchers.notify(room, entry)
 
     def authd(self, _xs=None):
         """callback when we are logged into the server!"""
@@ -130,14 +190,26 @@ class basicbot:
         support getting called at a later date for any changes
         """
         log.msg("load_chatrooms() called...")
-        df = self.dbpool.runInteraction(
-            botutil.load_chatrooms_from_db, self, always_join
-        )
+        df = self.dbpool.runInteraction(botutil.load_chatrooms_from_db, self)
+        df.addCallback(botutil.apply_chatrooms, self, always_join)
         # Send a presence update, which in the case of the first login will
         # provoke any offline messages to be sent.
         df.addCallback(self.send_presence)
+        df.addCallback(self.watch_joins)
         df.addErrback(botutil.email_error, self, "load_chatrooms() failure")
 
+    def watch_joins(self, _=None):
+        """Wait on the join scheduler to join all the rooms."""
+        df = self.joins.when_all_joined()
+        df.addCallback(self.all_rooms_joined, utc())
+
+    def all_rooms_joined(self, count, started):
+        """Callback once no room joins are outstanding."""
+        log.msg(
+            f"all_rooms_joined(): in {count} rooms after "
+            f"{(utc() - started).total_seconds():.1f}s"
+        )
+
     def load_twitter(self):
         """Load the twitter subscriptions and access tokens"""
         log.msg("load_twitter() called...")
@@ -156,6 +228,52 @@ class basicbot:
         df = self.dbpool.runInteraction(botutil.load_webhooks_from_db, self)
         df.addErrback(botutil.email_error, self, "load_webhooks() failure")
 
+    def reload_room(self, room):
+        """Reload a single room's configuration and subscriptions"""
+        log.msg(f"reload_room({room}) called...")
+        df = self.dbpool.runInteraction(botutil.load_room_from_db, self, room)
+        df.addCallback(botutil.apply_room_config, self, room)
+        df.addErrback(
+            botutil.email_error, self, f"reload_room({room}) failure"
+        )
+
+    def reload_channel(self, channel):
+        """Reload what is subscribed to a single channel"""
+        log.msg(f"reload_channel({channel}) called...")
+        df = self.dbpool.runInteraction(
+            botutil.load_channel_from_db, self, channel
+        )
+        df.addCallback(botutil.apply_channel_config, self, channel)
+        df.addErrback(
+            botutil.email_error, self, f"reload_channel({channel}) failure"
+        )
+
+    def reload_twitter_user(self, user_id):
+        """Reload a single Twitter account and its subscriptions"""
+        log.msg(f"reload_twitter_user({user_id}) called...")
+        df = self.dbpool.runInteraction(
+            botutil.load_twitter_user_from_db, self, user_id
+        )
+        df.addCallback(botutil.apply_twitter_user, self, user_id)
+        df.addErrback(
+            botutil.email_error,
+            self,
+            f"reload_twitter_user({user_id}) failure",
+        )
+
+    def reload_mastodon_user(self, user_id):
+        """Reload a single Mastodon account and its subscriptions"""
+        log.msg(f"reload_mastodon_user({user_id}) called...")
+        df = self.dbpool.runInteraction(
+            botutil.load_mastodon_user_from_db, self, user_id
+        )
+        df.addCallback(botutil.apply_mastodon_user, self, user_id)
+        df.addErrback(
+            botutil.email_error,
+            self,
+            f"reload_mastodon_user({user_id}) failure",
+        )
+
     def fire_client_with_config(self, res, serviceCollection):
         """Calledback once bot has loaded its database configuration"""
         log.msg("fire_client_with_config() called ...")
@@ -163,6 +281,12 @@ class basicbot:
         for row in res:
             self.config[row["propname"]] = row["propvalue"]
         log.msg(f"{len(self.config)} properties were loaded from the database")
+        self.xmllog.configure(self.config)
+        self.webhook_client.configure(self.config)
+        self.posting.configure(self.config)
+        self.joins.configure(self.config)
+        self.pending_sends.configure(self.config)
+        self.outbound.configure(self.config)
 
         self.myjid = jid.JID(
             f"{self.config['bot.username']}@{self.config['bot.xmppdomain']}/"
@@ -198,10 +322,12 @@ class basicbot:
         self.xmlstream.addObserver("/message", self.on_message)
         self.xmlstream.addObserver("/iq", self.on_iq)
         self.xmlstream.addObserver("/presence/x/item", self.on_presence)
+        self.outbound.attach(xs.transport)
 
     def disconnected(self, _xs=None):
         """disconnected callback"""
         log.msg("disconnected() was called...")
+        self.joins.reset()
 
     def get_fortune(self):
         """Get a random value from the array"""
@@ -210,24 +336,20 @@ class basicbot:
 
     def rawDataInFn(self, data):
         """write xmllog"""
-        self.xmllog.write(
-            f"{utc():%Y-%m-%d %H:%M:%S} RECV "
-            f"{data.decode('utf-8', 'ignore')}\n"
-        )
+        self.xmllog.write("RECV", data)
 
     def rawDataOutFn(self, data):
         """write xmllog"""
-        self.xmllog.write(
-            f"{utc():%Y-%m-%d %H:%M:%S} SEND "
-            f"{data.decode('utf-8', 'ignore')}\n"
-        )
+        self.xmllog.write("SEND", data)
 
     def housekeeping(self):
         """
         This gets exec'd every minute to keep up after ourselves
         1. XMPP Server Ping
         2. Update presence
+        3. Expire messages waiting on room joins
         """
+        self.pending_sends.expire()
         if self.outstanding_pings:
             log.msg(f"Currently unresponded pings: {self.outstanding_pings}")
         if len(self.outstanding_pings) > 5:
@@ -251,7 +373,7 @@ class basicbot:
         ping["id"] = pingid
         ping.addChild(domish.Element(("urn:xmpp:ping", "ping")))
         self.outstanding_pings.append(pingid)
-        self.xmlstream.send(ping)
+        self.outbound.send(ping, priority=True)
         # Update our presence every ten minutes with some debugging info
         if utcnow.minute % 10 == 0:
             self.send_presence()
@@ -279,7 +401,7 @@ class basicbot:
         else:
             p = body.addElement("p")
             p.addContent(mess)
-        self.xmlstream.send(message)
+        self.outbound.send(message)
 
     def send_groupchat(self, room, plain, htmlstr=None):
         """Send a groupchat message to a given room
@@ -317,8 +439,11 @@ class basicbot:
             self.send_groupchat_elem(message)
         return message
 
-    def send_groupchat_elem(self, elem, to=None, secondtrip=False):
-        """Wrapper for sending groupchat elements"""
+    def send_groupchat_elem(self, elem, to=None):
+        """Wrapper for sending groupchat elements
+
+        Messages for a room not yet joined wait in self.pending_sends
+        """
         if to is not None:
             elem["to"] = to
         room = jid.JID(elem["to"]).user
@@ -331,17 +456,46 @@ class basicbot:
             )
             return
         if not self.rooms[room]["joined"]:
-            if secondtrip:
-                log.msg(
-                    f"ABORT of send to room: {room}, msg: {elem}, not in room"
-                )
-                return
-            secs = random.randint(0, 10)
-            log.msg(f"delaying by {secs}s send to: {room}, not in room yet")
-            # Need to prevent elem['to'] object overwriting
-            reactor.callLater(secs, self.send_groupchat_elem, elem, elem["to"])
+            self.pending_sends.add(room, elem)
+            return
+        self.outbound.send(elem)
+
+    def broadcast_groupchat_elem(self, elem, rooms):
+        """Send a groupchat element to many rooms, serializing it once.
+
+        The element is rendered with a placeholder ``to`` attribute and only
+        the room JID is spliced into the resulting bytes for each room, so
+        the wire output is identical to calling send_groupchat_elem per room.
+        Rooms that are not yet joined go through send_groupchat_elem.
+
+        Args:
+          elem (domish.Element): the groupchat message to send
+          rooms (iterable): room names (without the conference service)
+        """
+        rooms = list(rooms)
+        if not rooms:
             return
-        self.xmlstream.send(elem)
+        elem["to"] = BROADCAST_PLACEHOLDER
+        xml = botutil.stanza_xml(self.xmlstream, elem)
+        needle = f" to='{BROADCAST_PLACEHOLDER}'".encode("utf-8")
+        template = xml.split(needle)
+        for room in rooms:
+            to = f"{room}@{self.conference}"
+            joined = self.rooms.get(room, {}).get("joined", False)
+            if not joined or len(template) != 2:
+                # slow path handles the queueing and error reporting
+                self.send_groupchat_elem(elem, to)
+                continue
+            self.outbound.send(
+                b"".join(
+                    (
+                        template[0],
+                        f" to='{domish.escapeToXml(to, 1)}'".encode("utf-8"),
+                        template[1],
+                    )
+                )
+            )
+        elem["to"] = to
 
     def send_presence(self, _=None):
         """
@@ -355,18 +509,20 @@ class basicbot:
         )
         presence.addElement("status").addContent(msg)
         if self.xmlstream is not None:
-            self.xmlstream.send(presence)
+            self.outbound.send(presence)
 
-    def tweet(self, user_id, twttxt, **kwargs):
+    def tweet(self, user_id, twttxt, priority=PRIORITY_NORMAL, **kwargs):
         """
         Tweet a message
         """
         twttxt = botutil.safe_twitter_text(twttxt)
-        df = threads.deferToThread(
+        df = self.posting.submit(
+            ("twitter", user_id),
             botutil.tweet,
             self,
             user_id,
             twttxt,
+            priority=priority,
             **kwargs,
         )
         df.addCallback(botutil.tweet_cb, self, twttxt, "", "", user_id)
@@ -383,16 +539,18 @@ class basicbot:
         )
         return df
 
-    def toot(self, user_id, twttxt, **kwargs):
+    def toot(self, user_id, twttxt, priority=PRIORITY_NORMAL, **kwargs):
         """
         Send a message to Mastodon
         """
         twttxt = botutil.safe_twitter_text(twttxt)
-        df = threads.deferToThread(
+        df = self.posting.submit(
+            ("mastodon", user_id),
             botutil.toot,
             self,
             user_id,
             twttxt,
+            priority=priority,
             **kwargs,
         )
         df.addCallback(botutil.toot_cb, self, twttxt, "", "", user_id)
@@ -476,6 +634,9 @@ class basicbot:
             if selfpres:
                 log.msg(f"MUC '{_room}' self presence left: {left}")
                 self.rooms[_room]["joined"] = not left
+                if not left:
+                    self.joins.on_joined(_room)
+                    self.pending_sends.drain(_room, self.outbound.send)
 
             self.rooms[_room]["occupants"][_handle] = {
                 "jid": _jid,
@@ -494,7 +655,7 @@ class basicbot:
             pong["to"] = elem["from"]
             pong["from"] = elem["to"]
             pong["id"] = elem["id"]
-            self.xmlstream.send(pong)
+            self.outbound.send(pong, priority=True)
         # We are getting a response to a request we sent, maybe.
         elif typ == "result":
             if elem.getAttribute("id") in self.outstanding_pings:
@@ -551,7 +712,7 @@ class basicbot:
                 "you."
             ),
         )
-        self.xmlstream.send(message)
+        self.outbound.send(message)
 
     def processMessageGC(self, elem):  # pylint: disable=unused-argument
         """override me please"""
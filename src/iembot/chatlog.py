@@ -0,0 +1,503 @@
+"""Room chatlog storage and persistence.
+
+Each room keeps its recent ROOM_LOG_ENTRYs within a fixed capacity RoomLog
+ring buffer, the strings shared between rooms logging the same product being
+held once by SharedStrings.  Each entry is also queued when it is logged and
+appended once, by a writer thread, to a journal file as a single JSON line.
+A periodic compaction rewrites the journal from a snapshot of the ring
+buffers.  Startup replays the journal line by line.
+"""
+import calendar
+import datetime
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+from twisted.python import log
+
+# The number of entries we keep per room
+CHATLOG_SIZE = 41
+# Queued by ChatlogJournal.rotate()
+ROTATE = object()
+ROOM_LOG_ENTRY = namedtuple(
+    "ROOM_LOG_ENTRY",
+    [
+        "seqnum",
+        "timestamp",
+        "log",
+        "author",
+        "product_id",
+        "product_text",
+        "txtlog",
+    ],
+)
+
+
+def _dumps(room, entry):
+    """Serialize a journal line."""
+    return json.dumps([room, *entry]) + "\n"
+
+
+def to_epoch(timestamp):
+    """Convert a legacy %Y%m%d%H%M%S timestamp string to epoch seconds."""
+    if isinstance(timestamp, str):
+        dt = datetime.datetime.strptime(timestamp, "%Y%m%d%H%M%S")
+        return calendar.timegm(dt.timetuple())
+    return int(timestamp)
+
+
+def make_entry(fields):
+    """Build a ROOM_LOG_ENTRY from journal or legacy fields.
+
+    The timestamp is normalized to integer epoch seconds and the author,
+    one of a few names, is interned.
+    """
+    entry = ROOM_LOG_ENTRY(*fields)
+    return entry._replace(
+        timestamp=to_epoch(entry.timestamp),
+        author=sys.intern(entry.author),
+    )
+
+
+def entry_json(entry):
+    """Render an entry as used by the iembot-json room service.
+
+    Returns:
+      bytes: the JSON object
+    """
+    return json.dumps(
+        {
+            "seqnum": entry.seqnum,
+            "ts": time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.gmtime(entry.timestamp)
+            ),
+            "author": entry.author,
+            "product_id": entry.product_id,
+            "message": entry.log,
+        }
+    ).encode("utf-8")
+
+
+class RoomLog:
+    """Fixed capacity ring buffer of a room's entries, oldest first.
+
+    Appends are O(1) and overwrite the oldest entry once full.  seqnums are
+    increasing, so lookups by seqnum are binary searches.  The JSON rendering
+    of each entry is cached alongside it.
+    """
+
+    __slots__ = ("capacity", "_slots", "_json", "_start", "_len")
+
+    def __init__(self, capacity=CHATLOG_SIZE):
+        """Constructor"""
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._json = [None] * capacity
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        """Number of entries held."""
+        return self._len
+
+    def __getitem__(self, idx):
+        """Entry by position, 0 being the oldest and -1 the newest."""
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError("RoomLog index out of range")
+        return self._slots[(self._start + idx) % self.capacity]
+
+    def __iter__(self):
+        """Iterate oldest to newest."""
+        for idx in range(self._len):
+            yield self._slots[(self._start + idx) % self.capacity]
+
+    def __reversed__(self):
+        """Iterate newest to oldest."""
+        for idx in range(self._len - 1, -1, -1):
+            yield self._slots[(self._start + idx) % self.capacity]
+
+    def append(self, entry):
+        """Add the newest entry, dropping the oldest when full.
+
+        Returns:
+          ROOM_LOG_ENTRY: the entry dropped or None
+        """
+        dropped = None
+        if self._len < self.capacity:
+            pos = (self._start + self._len) % self.capacity
+            self._len += 1
+        else:
+            pos = self._start
+            self._start = (self._start + 1) % self.capacity
+            dropped = self._slots[pos]
+        self._slots[pos] = entry
+        self._json[pos] = None
+        return dropped
+
+    def newest(self):
+        """The newest entry or None."""
+        if self._len == 0:
+            return None
+        return self[-1]
+
+    def _bisect(self, seqnum):
+        """Position of the first entry with a seqnum greater than given."""
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid].seqnum <= seqnum:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, seqnum):
+        """Find the entry with the given seqnum or None."""
+        idx = self._bisect(seqnum) - 1
+        if idx >= 0 and self[idx].seqnum == seqnum:
+            return self[idx]
+        return None
+
+    def since(self, seqnum):
+        """Entries with a seqnum greater than given, oldest first."""
+        return [self[idx] for idx in range(self._bisect(seqnum), self._len)]
+
+    def json_since(self, seqnum):
+        """JSON renderings of the entries since seqnum, oldest first.
+
+        Returns:
+          list: of bytes, see entry_json
+        """
+        res = []
+        for idx in range(self._bisect(seqnum), self._len):
+            pos = (self._start + idx) % self.capacity
+            frag = self._json[pos]
+            if frag is None:
+                frag = self._json[pos] = entry_json(self._slots[pos])
+            res.append(frag)
+        return res
+
+
+class SharedStrings:
+    """Reference counted table of the strings room log entries share.
+
+    Rooms receiving the same product log equal strings, which are kept
+    once.  Unlike sys.intern, a string leaves the table along with the last
+    entry using it, so large product texts are not held forever.
+    """
+
+    FIELDS = ("log", "product_id", "product_text", "txtlog")
+
+    def __init__(self):
+        """Constructor"""
+        # string => [the shared string, number of entries using it]
+        self._refs = {}
+
+    def __len__(self):
+        """Number of strings held."""
+        return len(self._refs)
+
+    def share(self, entry):
+        """Return the entry using the table's copies of its strings."""
+        shared = {}
+        for field in self.FIELDS:
+            value = getattr(entry, field)
+            if not value:
+                continue
+            ref = self._refs.get(value)
+            if ref is None:
+                ref = self._refs[value] = [value, 0]
+            ref[1] += 1
+            shared[field] = ref[0]
+        return entry._replace(**shared)
+
+    def release(self, entry):
+        """An entry given by share() left its RoomLog."""
+        for field in self.FIELDS:
+            value = getattr(entry, field)
+            if not value:
+                continue
+            ref = self._refs.get(value)
+            if ref is None:
+                continue
+            ref[1] -= 1
+            if ref[1] <= 0:
+                del self._refs[value]
+
+
+class ChatlogJournal:
+    """Append-only, compactable journal of room log entries.
+
+    Entries are queued by the reactor thread and written out by a writer
+    thread, as XMLLogWriter does for the wire log.
+    """
+
+    def __init__(self, path, keep=CHATLOG_SIZE, flush_interval=1.0):
+        """Constructor
+
+        Args:
+          path (str): the journal filename
+          keep (int): entries per room retained by compaction
+          flush_interval (float): seconds between writer thread flushes
+        """
+        self.path = path
+        self.keep = keep
+        self.flush_interval = flush_interval
+        # (room, entry) waiting to be written, or ROTATE markers
+        self._queue = deque()
+        self._fh = None
+        # journal offset of the last rotate(), see compact()
+        self._rotated = None
+        # held while the journal files are written
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    @property
+    def oldpath(self):
+        """Where an older version left a journal being compacted."""
+        return f"{self.path}.old"
+
+    def exists(self):
+        """Is there anything to replay?"""
+        return (
+            bool(self._queue)
+            or os.path.isfile(self.path)
+            or os.path.isfile(self.oldpath)
+        )
+
+    def _open(self):
+        """Open the journal for appending."""
+        self._fh = open(self.path, "a", encoding="utf-8")
+
+    def append(self, room, entry):
+        """Queue an entry for the writer thread, called from the reactor.
+
+        Args:
+          room (str): the room the entry was logged to
+          entry (ROOM_LOG_ENTRY): what was logged
+        """
+        self._queue.append((room, entry))
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        """Start the writer thread."""
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="chatlog", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        """Writer thread main loop."""
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as exp:
+                log.err(exp)
+
+    def flush(self):
+        """Write out everything that is queued."""
+        with self._lock:
+            lines = []
+            while self._queue:
+                item = self._queue.popleft()
+                if item is ROTATE:
+                    self._write(lines)
+                    lines = []
+                    self._rotated = (
+                        os.path.getsize(self.path)
+                        if os.path.isfile(self.path)
+                        else 0
+                    )
+                    continue
+                lines.append(_dumps(*item))
+            self._write(lines)
+
+    def _write(self, lines):
+        """Append lines to the journal, with the lock held."""
+        if not lines:
+            return
+        if self._fh is None:
+            self._open()
+        self._fh.write("".join(lines))
+        self._fh.flush()
+
+    def close(self):
+        """Stop the writer thread after a final flush."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def _read(self, path):
+        """Generate (room, fields) from a journal file."""
+        if not os.path.isfile(path):
+            return
+        with open(path, encoding="utf-8") as fh:
+            for linenum, line in enumerate(fh, start=1):
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # A crash may leave a partial final line
+                    log.msg(f"Skipping corrupt {path} line {linenum}")
+                    continue
+                yield row[0], row[1:]
+
+    def replay(self):
+        """Generate (room, fields) for every journaled entry, oldest first.
+
+        A compaction interrupted by an older version leaves its journal
+        aside, so it is replayed first.  Callers should skip duplicated
+        seqnums.
+        """
+        self.flush()
+        yield from self._read(self.oldpath)
+        yield from self._read(self.path)
+
+    def rotate(self):
+        """Mark the start of a compaction, called from the reactor thread.
+
+        Entries queued before the mark are covered by a snapshot taken at
+        the same time, those after it are kept by compact().
+
+        Returns:
+          bool: if there is anything to compact
+        """
+        if not self.exists():
+            return False
+        self._queue.append(ROTATE)
+        return True
+
+    def _copy(self, fh, offset):
+        """Copy the complete journal lines from offset on into fh.
+
+        Returns:
+          (int, int): the offset copied up to and the number of lines
+        """
+        if not os.path.isfile(self.path):
+            return offset, 0
+        with open(self.path, "rb") as fhin:
+            fhin.seek(offset)
+            data = fhin.read()
+        end = data.rfind(b"\n") + 1
+        fh.write(data[:end])
+        return offset + end, data.count(b"\n", 0, end)
+
+    def compact(self, snapshot):
+        """Replace the journal with a snapshot, called from a thread.
+
+        The entries journaled since rotate() are copied after the snapshot
+        without holding the lock, only those written meanwhile are copied
+        while the writer thread waits.
+
+        Args:
+          snapshot (dict): room => list of entries taken at rotate() time
+        """
+        self.flush()
+        if self._rotated is None:
+            return
+        tmppath = f"{self.path}.compact"
+        entries = 0
+        with open(tmppath, "wb") as fh:
+            for room, roomlog in snapshot.items():
+                for entry in roomlog:
+                    fh.write(_dumps(room, entry).encode("utf-8"))
+                    entries += 1
+            offset, count = self._copy(fh, self._rotated)
+            entries += count
+            with self._lock:
+                offset, count = self._copy(fh, offset)
+                entries += count
+                if self._fh is not None:
+                    self._fh.close()
+                    self._fh = None
+                fh.close()
+                os.replace(tmppath, self.path)
+                if os.path.isfile(self.oldpath):
+                    os.remove(self.oldpath)
+                self._rotated = None
+        log.msg(f"Compacted {self.path} to {entries} entries")
+
+    def import_pickle(self, picklefile):
+        """Journal the chatlog held by a legacy pickle file.
+
+        Args:
+          picklefile (str): the pickle saved by older versions of iembot
+
+        Returns:
+          int: the number of entries imported
+        """
+        with open(picklefile, "rb") as fh:
+            oldlog = pickle.load(fh)
+        count = 0
+        for room, rmlog in oldlog.items():
+            # The pickled lists are newest first
+            for entry in reversed(rmlog[: self.keep]):
+                self.append(room, entry)
+                count += 1
+        return count
+
+
+class RoomWatchers:
+    """Callbacks interested in new entries being logged to a room."""
+
+    def __init__(self):
+        """Constructor"""
+        self._watchers = {}
+        self.count = 0
+
+    def add(self, room, callback, limit):
+        """Register a callback(entry) for the room.
+
+        Args:
+          room (str): the room to watch
+          callback (callable): called with each new ROOM_LOG_ENTRY
+          limit (int): refuse the registration if this many are watching
+
+        Returns:
+          bool: if the callback was registered
+        """
+        if self.count >= limit:
+            return False
+        self._watchers.setdefault(room, set()).add(callback)
+        self.count += 1
+        return True
+
+    def remove(self, room, callback):
+        """Unregister a callback, which is fine to call more than once."""
+        callbacks = self._watchers.get(room)
+        if callbacks is None or callback not in callbacks:
+            return
+        callbacks.discard(callback)
+        self.count -= 1
+        if not callbacks:
+            self._watchers.pop(room)
+
+    def notify(self, room, entry):
+        """Tell the room's watchers about a new entry."""
+        callbacks = self._watchers.get(room)
+        if not callbacks:
+            return
+        # callbacks may remove themselves
+        for callback in list(callbacks):
+            try:
+                callback(entry)
+            except Exception as exp:
+                log.err(exp)
@@ -0,0 +1,148 @@
+"""Reusable social media API clients.
+
+Building a client per post pays for a new HTTP session, and so a new TCP
+and TLS handshake, every time.  The clients are instead cached per account
+and keyed by the credentials they were built with, so a changed token gets
+a fresh client.  Mastodon accounts on the same server share one pooled
+session.  Posting happens within threads, hence the locks.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ClientCache:
+    """Thread-safe cache of API clients by account id."""
+
+    def __init__(self, owns_sessions=True):
+        """Constructor
+
+        Args:
+          owns_sessions (bool): close a client's session when it is dropped,
+            which is not wanted for sessions shared via a SessionPool
+        """
+        self.owns_sessions = owns_sessions
+        # user_id => (credentials, client)
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """Number of cached clients."""
+        return len(self._clients)
+
+    def get(self, user_id, credentials, factory):
+        """Return the cached client, building it when needed.
+
+        Args:
+          user_id: the account the client posts as
+          credentials (tuple): what the client was built with
+          factory (callable): builds a new client
+
+        Returns:
+          the client
+        """
+        with self._lock:
+            entry = self._clients.get(user_id)
+            if entry is not None and entry[0] == credentials:
+                self.hits += 1
+                return entry[1]
+        # Building may do I/O, so do not hold the lock
+        client = factory()
+        with self._lock:
+            self.misses += 1
+            old = self._clients.get(user_id)
+            self._clients[user_id] = (credentials, client)
+        if old is not None and self.owns_sessions:
+            _close(old[1])
+        return client
+
+    def invalidate(self, user_id=None):
+        """Forget the client for user_id, or all clients when None."""
+        with self._lock:
+            if user_id is None:
+                dropped = list(self._clients.values())
+                self._clients = {}
+            else:
+                entry = self._clients.pop(user_id, None)
+                dropped = [] if entry is None else [entry]
+        if not self.owns_sessions:
+            return
+        for _credentials, client in dropped:
+            _close(client)
+
+    def retain(self, user_ids):
+        """Forget the clients of accounts that are no longer in user_ids.
+
+        Clients of accounts still around are kept, including any that are
+        in use by a posting thread.  Changed credentials are handled by get.
+        """
+        keep = set(user_ids)
+        with self._lock:
+            gone = [
+                user_id for user_id in self._clients if user_id not in keep
+            ]
+        for user_id in gone:
+            self.invalidate(user_id)
+
+
+class SessionPool:
+    """requests sessions shared by all the accounts on a server."""
+
+    def __init__(self, maxsize=4):
+        """Constructor
+
+        Args:
+          maxsize (int): connections kept alive per server
+        """
+        self.maxsize = maxsize
+        # server => requests.Session
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of servers with a session."""
+        return len(self._sessions)
+
+    def get(self, server):
+        """Return the session for the server, creating it when needed."""
+        with self._lock:
+            session = self._sessions.get(server)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.maxsize
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[server] = session
+            return session
+
+    def prune(self, servers):
+        """Close the sessions for servers no longer in use.
+
+        Args:
+          servers (iterable): the servers still having accounts
+        """
+        keep = set(servers)
+        with self._lock:
+            dropped = [
+                self._sessions.pop(server)
+                for server in list(self._sessions)
+                if server not in keep
+            ]
+        for session in dropped:
+            session.close()
+
+
+def _close(client):
+    """Close the HTTP session(s) held by a client, if any."""
+    clients = client if isinstance(client, tuple) else (client,)
+    for obj in clients:
+        session = getattr(obj, "_session", None) or getattr(
+            obj, "session", None
+        )
+        if session is not None and hasattr(session, "close"):
+            session.close()
@@ -1,6 +1,6 @@
 """ Chat bot implementation of IEMBot """
-import datetime
 import re
+import time
 
 from twisted.internet import reactor
 from twisted.mail.smtp import SMTPSenderFactory
@@ -9,6 +9,7 @@ from twisted.words.protocols.jabber import jid
 from twisted.words.xish import xpath
 
 from iembot import basicbot
+from iembot.ratelimit import stanza_priority
 from iembot.webhooks import route as webhooks_route
 
 # http://stackoverflow.com/questions/7016602
@@ -59,8 +60,7 @@ class JabberClient(basicbot.basicbot):
         if a is None or not a:
             return
 
-        roomlog = self.chatlog.setdefault(room, [])
-        ts = datetime.datetime.utcnow()
+        ts = int(time.time())
 
         product_id = ""
         if elem.x and elem.x.hasAttribute("product_id"):
@@ -71,18 +71,16 @@ class JabberClient(basicbot.basicbot):
         if html is not None:
             log_entry = html[0].toXml()
 
-        if len(roomlog) > 40:
-            roomlog.pop()
-
         def writelog(product_text=None):
             """Actually do what we want to do"""
             if product_text is None or product_text == "":
                 product_text = "Sorry, product text is unavailable."
-            roomlog.insert(
-                0,
+            self.append_chatlog(
+                room,
                 basicbot.ROOM_LOG_ENTRY(
                     seqnum=self.next_seqnum(),
-                    timestamp=ts.strftime("%Y%m%d%H%M%S"),
+                    timestamp=ts,
+                    # shared between rooms, see basicbot.append_chatlog
                     log=log_entry,
                     author=res,
                     product_id=product_id,
@@ -164,71 +162,52 @@ class JabberClient(basicbot.basicbot):
         elem["type"] = "groupchat"
         self.send_groupchat_elem(elem)
 
-        alertedRooms = []
-        alertedPages = []
-        for channel in channels:
-            for room in self.routingtable.get(channel, []):
-                if room in alertedRooms:
-                    continue
-                alertedRooms.append(room)
-                elem["to"] = f"{room}@{self.config['bot.mucservice']}"
-                self.send_groupchat_elem(elem)
-            for user_id in self.tw_routingtable.get(channel, []):
-                if user_id not in self.tw_users:
-                    log.msg(
-                        f"Failed to tweet due to no access_tokens {user_id}"
-                    )
-                    continue
-                # Require the x.twitter attribute to be set to prevent
-                # confusion with some ingestors still sending tweets themself
-                if not elem.x.hasAttribute("twitter"):
-                    continue
-                if user_id in alertedPages:
-                    continue
-                alertedPages.append(user_id)
-                lat = long = None
-                if (
-                    elem.x
-                    and elem.x.hasAttribute("lat")
-                    and elem.x.hasAttribute("long")
-                ):
-                    lat = elem.x["lat"]
-                    long = elem.x["long"]
-                # Finally, actually tweet, this is in basicbot
-                self.tweet(
-                    user_id,
-                    elem.x["twitter"],
-                    twitter_media=elem.x.getAttribute("twitter_media"),
-                    latitude=lat,
-                    longitude=long,
-                )
-            for user_id in self.md_routingtable.get(channel, []):
-                if user_id not in self.md_users:
-                    log.msg(
-                        f"Failed to send to Mastodon due to no access_tokens {user_id}"
-                    )
-                    continue
-                # Require the x.twitter attribute to be set to prevent
-                # confusion with some ingestors still sending tweets themselfs
-                if not elem.x.hasAttribute("twitter"):
-                    continue
-                if user_id in alertedPages:
-                    continue
-                alertedPages.append(user_id)
-                lat = long = None
-                if (
-                    elem.x
-                    and elem.x.hasAttribute("lat")
-                    and elem.x.hasAttribute("long")
-                ):
-                    lat = elem.x["lat"]
-                    long = elem.x["long"]
-                # Finally, actually post to Mastodon, this is in basicbot
-                self.toot(
-                    user_id,
-                    elem.x["twitter"],
-                    twitter_media=elem.x.getAttribute("twitter_media"),
-                    latitude=lat,  # TODO: unused
-                    longitude=long,  # TODO: unused
+        plan = self.fanout.plan(channels)
+        self.broadcast_groupchat_elem(elem, plan.rooms)
+        lat = long = None
+        if (
+            elem.x
+            and elem.x.hasAttribute("lat")
+            and elem.x.hasAttribute("long")
+        ):
+            lat = elem.x["lat"]
+            long = elem.x["long"]
+        # warnings ahead of statements when social media budgets run low
+        priority = stanza_priority(elem.x)
+        for user_id in plan.twitter:
+            if user_id not in self.tw_users:
+                log.msg(f"Failed to tweet due to no access_tokens {user_id}")
+                continue
+            # Require the x.twitter attribute to be set to prevent
+            # confusion with some ingestors still sending tweets themself
+            if not elem.x.hasAttribute("twitter"):
+                continue
+            # Finally, actually tweet, this is in basicbot
+            self.tweet(
+                user_id,
+                elem.x["twitter"],
+                twitter_media=elem.x.getAttribute("twitter_media"),
+                latitude=lat,
+                longitude=long,
+                priority=priority,
+            )
+        for user_id in plan.mastodon:
+            if user_id not in self.md_users:
+                log.msg(
+                    f"Failed to send to Mastodon due to no access_tokens {user_id}"
                 )
+                continue
+            # Require the x.twitter attribute to be set to prevent
+            # confusion with some ingestors still sending tweets themselfs
+            if not elem.x.hasAttribute("twitter"):
+                continue
+            # Finally, actually post to Mastodon, this is in basicbot
+            self.toot(
+                user_id,
+                elem.x["twitter"],
+                twitter_media=elem.x.getAttribute("twitter_media"),
+                latitude=lat,  # TODO: unused
+                longitude=long,  # TODO: unused
+                priority=priority,
+            )
         webhooks_route(self, channels, elem)
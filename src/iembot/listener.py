@@ -0,0 +1,172 @@
+"""Live configuration updates via PostgreSQL LISTEN/NOTIFY.
+
+Triggers installed by scripts/iembot_notify.sql send a JSON payload for
+every row changed within the subscription tables.  The payload only has
+the columns identifying the row, never the oauth tokens, so changed
+accounts are reloaded from the database.  A dedicated connection,
+owned by a thread, LISTENs for them and hands each payload to the reactor,
+where subscription changes are patched straight into the routing tables.
+Changes that need more than the row, like a new room to join, use the
+scoped reloads.  Whenever the connection is (re)established, and so might
+have missed notifications, a full reload is done instead.
+"""
+import json
+import threading
+
+import psycopg
+from twisted.internet import reactor
+from twisted.python import log
+
+import iembot.util as botutil
+
+CHANNEL = "iembot_config"
+
+
+def _swap(table, channel, target, add):
+    """Add or remove a RoutingTable subscription."""
+    if channel is None or target is None:
+        # the loaders skip such rows as well
+        return
+    if add:
+        table.add(channel, target)
+    else:
+        table.remove(channel, target)
+
+
+def apply_notification(bot, payload):
+    """Apply a change notification to the running bot, on the reactor.
+
+    Args:
+      bot (basicbot): the running bot instance
+      payload (dict): with table, op, old and new keys
+
+    Returns:
+      bool: if the change was understood, a payload without rows is not
+    """
+    table = payload["table"]
+    if table.startswith(f"{bot.name}_"):
+        table = table[len(bot.name) + 1 :]
+    elif table.startswith("iembot_"):
+        table = table[len("iembot_") :]
+    rows = [(payload.get("old"), False), (payload.get("new"), True)]
+    rows = [(row, add) for row, add in rows if row]
+    if not rows:
+        # the row was too large to describe, see iembot_notify.sql
+        return False
+    if table == "room_subscriptions":
+        for row, add in rows:
+            _swap(bot.routingtable, row["channel"], row["roomname"], add)
+    elif table == "twitter_subs":
+        # Twitter routing is disabled, see load_twitter_from_db
+        pass
+    elif table == "mastodon_subs":
+        for row, add in rows:
+            _swap(bot.md_routingtable, row["channel"], row["user_id"], add)
+    elif table == "webhooks":
+        for row, add in rows:
+            if not row.get("url") or not row.get("channel"):
+                continue
+            _swap(bot.webhooks_routingtable, row["channel"], row["url"], add)
+            batching = botutil.webhook_batching(row) if add else None
+            if batching is not None:
+                bot.webhooks_batching[row["url"]] = batching
+    elif table == "rooms":
+        for row, _add in rows:
+            bot.reload_room(row["roomname"])
+        return True
+    elif table == "twitter_oauth":
+        for row, _add in rows:
+            bot.reload_twitter_user(row["user_id"])
+        return True
+    elif table == "mastodon_oauth":
+        for row, _add in rows:
+            bot.reload_mastodon_user(row["id"])
+        return True
+    else:
+        return False
+    bot.fanout.invalidate()
+    return True
+
+
+class ConfigListener:
+    """A thread LISTENing for configuration changes."""
+
+    def __init__(self, bot, conninfo, channel=CHANNEL, timeout=5, backoff=10):
+        """Constructor
+
+        Args:
+          bot (basicbot): the running bot instance
+          conninfo (dict): psycopg.connect keyword arguments
+          channel (str): the NOTIFY channel
+          timeout (float): seconds between checks for being stopped
+          backoff (float): seconds to wait before reconnecting
+        """
+        self.bot = bot
+        self.conninfo = conninfo
+        self.channel = channel
+        self.timeout = timeout
+        self.backoff = backoff
+        self.received = 0
+        self.connects = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the listening thread."""
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="listener", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening."""
+        self._stopping.set()
+
+    def _run(self):
+        """Thread main loop, reconnecting after any failure."""
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception as exp:
+                log.msg(f"ConfigListener connection failed: {exp}")
+            self._stopping.wait(self.backoff)
+
+    def _listen(self):
+        """Hold the connection until it fails or we are stopped."""
+        with psycopg.connect(autocommit=True, **self.conninfo) as conn:
+            conn.execute(f"LISTEN {self.channel}")
+            self.connects += 1
+            # Whatever changed while we were not listening is unknown
+            reactor.callFromThread(self.full_reload)
+            while not self._stopping.is_set():
+                for notify in conn.notifies(timeout=self.timeout):
+                    self.received += 1
+                    reactor.callFromThread(self.dispatch, notify.payload)
+                    if self._stopping.is_set():
+                        break
+
+    def full_reload(self):
+        """Reload everything, as /iembot-json/reload does."""
+        if self.bot.xmlstream is None:
+            # the initial load happens once we are logged in
+            return
+        log.msg("ConfigListener (re)connected, doing a full reload")
+        self.bot.load_chatrooms(False)
+        self.bot.load_twitter()
+        self.bot.load_mastodon()
+        self.bot.load_webhooks()
+
+    def dispatch(self, payload):
+        """Apply a notification payload, on the reactor thread."""
+        if self.bot.xmlstream is None:
+            return
+        try:
+            if not apply_notification(self.bot, json.loads(payload)):
+                log.msg(f"ConfigListener could not apply {payload}")
+                self.full_reload()
+                return
+        except Exception as exp:
+            log.err(exp)
+            # Fall back to getting everything right
+            self.full_reload()
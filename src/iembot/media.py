@@ -0,0 +1,163 @@
+"""Fetch-once cache of the media attached to social media posts.
+
+A product fans out to many accounts, each posting from its own thread with
+the same twitter_media URL.  The first caller downloads it while concurrent
+callers wait for that download, and the bytes are then kept for a while in
+a size-bounded LRU.
+"""
+import mimetypes
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from io import BytesIO
+
+import requests
+
+MEDIA = namedtuple("MEDIA", ["data", "mime_type"])
+# Leading bytes => MIME type
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def sniff_mime(data, fallback="application/octet-stream"):
+    """Determine the MIME type from the content itself.
+
+    Args:
+      data (bytes): the media
+      fallback (str): returned when the content is not recognized
+
+    Returns:
+      str
+    """
+    for signature, mime_type in SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp":
+        return "video/mp4"
+    return fallback
+
+
+class MediaFile(BytesIO):
+    """In-memory media with the attributes python-twitter wants to see."""
+
+    mode = "rb"
+
+    def __init__(self, media):
+        """Constructor
+
+        Args:
+          media (MEDIA): the cached media
+        """
+        BytesIO.__init__(self, media.data)
+        self.mime_type = media.mime_type
+        ext = mimetypes.guess_extension(media.mime_type) or ""
+        self.name = f"media{ext}"
+
+
+class _Fetch:
+    """A download in progress that other callers can wait on."""
+
+    def __init__(self):
+        """Constructor"""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MediaCache:
+    """Thread-safe LRU of downloaded media with in-flight de-duplication."""
+
+    def __init__(self, maxbytes=64 * 1024 * 1024, ttl=600, timeout=30):
+        """Constructor
+
+        Args:
+          maxbytes (int): total size of the media kept
+          ttl (float): seconds to keep media
+          timeout (float): download timeout in seconds
+        """
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        # url => (expires, MEDIA)
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.fetches = 0
+
+    def __len__(self):
+        """Number of cached media."""
+        return len(self._cache)
+
+    def fetch(self, url):
+        """Return the MEDIA for the url, downloading it at most once.
+
+        Raises:
+          requests.RequestException: when the download fails
+        """
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._cache.move_to_end(url)
+                    self.hits += 1
+                    return entry[1]
+                self._evict(url)
+            pending = self._inflight.get(url)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[url] = _Fetch()
+                self.fetches += 1
+        if not owner:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            with self._lock:
+                self.hits += 1
+            return pending.result
+        try:
+            pending.result = self._download(url)
+        except Exception as exp:
+            pending.error = exp
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(url, None)
+                if pending.result is not None:
+                    self._store(url, pending.result)
+            pending.done.set()
+        return pending.result
+
+    def open(self, url):
+        """Return the media for the url as a file-like MediaFile."""
+        return MediaFile(self.fetch(url))
+
+    def _download(self, url):
+        """Make the request."""
+        resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        header = resp.headers.get("Content-Type", "").split(";")[0].strip()
+        data = resp.content
+        return MEDIA(data, sniff_mime(data, header or "image/png"))
+
+    def _store(self, url, media):
+        """Cache media, called with the lock held."""
+        if len(media.data) > self.maxbytes:
+            return
+        self._cache[url] = (time.monotonic() + self.ttl, media)
+        self.size += len(media.data)
+        while self.size > self.maxbytes:
+            self._evict(next(iter(self._cache)))
+
+    def _evict(self, url):
+        """Drop media, called with the lock held."""
+        _expires, media = self._cache.pop(url)
+        self.size -= len(media.data)
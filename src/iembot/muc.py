@@ -0,0 +1,338 @@
+"""Rate controlled joining of multi-user chat rooms.
+
+After login the bot joins thousands of rooms.  Rather than bursting those
+presences at the server, joins are queued, more important rooms first, and
+sent as a token bucket allows.  A room counts as joined once its status 110
+self-presence comes back, which also gives us the join latency.
+
+Messages for a room we are not in yet wait in a bounded per-room queue,
+sent in order once that self-presence arrives.  They only start to age
+once the room's join is sent, so a long join backlog does not expire them.
+"""
+import heapq
+import itertools
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.words.xish import domish
+
+from iembot.ratelimit import TokenBucket
+
+# Join priorities, lower goes first
+JOIN_BOTSTALK = 0
+JOIN_SUBSCRIBED = 1
+JOIN_IDLE = 2
+
+QUEUED = "queued"
+JOINING = "joining"
+JOINED = "joined"
+FAILED = "failed"
+
+
+def join_priority(room, routingtable):
+    """Join priority for a room, those routed to go first.
+
+    Args:
+      room (str): the room
+      routingtable (RoutingTable): the room subscriptions
+    """
+    if room == "botstalk":
+        return JOIN_BOTSTALK
+    if routingtable.channels(room):
+        return JOIN_SUBSCRIBED
+    return JOIN_IDLE
+
+
+class JoinScheduler:
+    """Queue of room joins drained by a joins/second token bucket."""
+
+    def __init__(
+        self, bot, clock=reactor, rate=5, burst=10, timeout=60, max_rate=20
+    ):
+        """Constructor
+
+        Args:
+          bot (basicbot): the bot doing the joining
+          clock (IReactorTime): schedules the joins
+          rate (float): joins per second
+          burst (int): joins allowed back to back
+          timeout (float): seconds to wait for the self-presence
+          max_rate (float): joins per second the rate may never exceed
+        """
+        self.bot = bot
+        self.clock = clock
+        self.max_rate = max_rate
+        self.rate = min(rate, max_rate)
+        self.timeout = timeout
+        self.bucket = TokenBucket(burst, burst / rate)
+        # heap of (priority, seq, room)
+        self._queue = []
+        self._seq = itertools.count()
+        self._timer = None
+        # room => QUEUED, JOINING, JOINED or FAILED
+        self.state = {}
+        # room => (when the join was sent, timeout IDelayedCall)
+        self._joining = {}
+        # room => when the join was sent, for those that timed out
+        self._late = {}
+        self._waiters = []
+        self.sent = 0
+        self.joined = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def configure(self, config):
+        """Apply settings from the bot's properties table."""
+        self.max_rate = float(
+            config.get("bot.muc_join_max_rate", self.max_rate)
+        )
+        self.rate = min(
+            float(config.get("bot.muc_join_rate", self.rate)), self.max_rate
+        )
+        burst = int(config.get("bot.muc_join_burst", self.bucket.capacity))
+        self.bucket.capacity = burst
+        self.bucket.window = burst / self.rate
+        self.timeout = float(config.get("bot.muc_join_timeout", self.timeout))
+
+    @property
+    def pending(self):
+        """Number of rooms queued or waiting on their self-presence."""
+        return len(self._queue) + len(self._joining)
+
+    def request(self, room, priority=JOIN_IDLE):
+        """Queue a join of the room, unless one is already underway."""
+        if self.state.get(room) in (QUEUED, JOINING):
+            return
+        self.state[room] = QUEUED
+        self._late.pop(room, None)
+        heapq.heappush(self._queue, (priority, next(self._seq), room))
+        self._pump()
+
+    def forget(self, room):
+        """Stop tracking a room that we have left or no longer want."""
+        state = self.state.pop(room, None)
+        self._late.pop(room, None)
+        if state == QUEUED:
+            self._queue = [e for e in self._queue if e[2] != room]
+            heapq.heapify(self._queue)
+        elif state == JOINING:
+            self._joining.pop(room)[1].cancel()
+        self._check_done()
+
+    def reset(self):
+        """Forget everything, as after a disconnect."""
+        for _sent, timer in self._joining.values():
+            timer.cancel()
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self._queue = []
+        self._joining = {}
+        self._late = {}
+        self.state = {}
+
+    def when_all_joined(self):
+        """Deferred firing once no joins are queued or outstanding.
+
+        Returns:
+          Deferred: fires with the number of joined rooms
+        """
+        df = defer.Deferred()
+        self._waiters.append(df)
+        self._check_done()
+        return df
+
+    def _pump(self):
+        """Send the joins the bucket allows."""
+        if self._timer is not None and self._timer.active():
+            return
+        self._timer = None
+        while self._queue:
+            now = self.clock.seconds()
+            wait = self.bucket.wait(now)
+            if wait > 0:
+                self._timer = self.clock.callLater(wait, self._pump)
+                return
+            self.bucket.take(now)
+            room = heapq.heappop(self._queue)[2]
+            self._send(room, now)
+
+    def _send(self, room, now):
+        """Send the join presence."""
+        presence = domish.Element(("jabber:client", "presence"))
+        presence["to"] = f"{room}@{self.bot.conference}/{self.bot.myjid.user}"
+        self.state[room] = JOINING
+        self._joining[room] = (
+            now,
+            self.clock.callLater(self.timeout, self._timed_out, room),
+        )
+        self.sent += 1
+        self.bot.pending_sends.join_sent(room)
+        self.bot.outbound.send(presence, priority=True)
+
+    def on_joined(self, room):
+        """The room's self-presence says we are in, see presence_processor"""
+        entry = self._joining.pop(room, None)
+        previous = self.state.get(room)
+        self.state[room] = JOINED
+        if entry is not None:
+            sent, timer = entry
+            timer.cancel()
+        elif previous == FAILED and room in self._late:
+            # the self-presence came after we gave up on it
+            sent = self._late.pop(room)
+            self.failed -= 1
+        else:
+            return
+        latency = self.clock.seconds() - sent
+        self.joined += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self._check_done()
+
+    def _timed_out(self, room):
+        """No self-presence came back in time."""
+        self._late[room] = self._joining.pop(room)[0]
+        self.state[room] = FAILED
+        self.failed += 1
+        log.msg(f"JoinScheduler: no self-presence from {room}")
+        self._check_done()
+
+    def _check_done(self):
+        """Fire the all joined waiters when there is nothing pending."""
+        if self.pending or not self._waiters:
+            return
+        waiters, self._waiters = self._waiters, []
+        joined = sum(1 for state in self.state.values() if state == JOINED)
+        for df in waiters:
+            df.callback(joined)
+
+    def status(self):
+        """Join state for the status page."""
+        return {
+            "muc.queued": len(self._queue),
+            "muc.joining": len(self._joining),
+            "muc.joins_sent": self.sent,
+            "muc.joined": self.joined,
+            "muc.join_failed": self.failed,
+            "muc.join_latency_avg_ms": round(
+                1000.0 * self.latency_total / self.joined if self.joined else 0
+            ),
+            "muc.join_latency_max_ms": round(1000.0 * self.latency_max),
+        }
+
+
+class PendingSends:
+    """Bounded per-room queues of messages waiting on a room join."""
+
+    def __init__(self, clock=reactor, maxlen=100, max_age=300):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): provides the time
+          maxlen (int): messages kept per room, the oldest are dropped
+          max_age (float): seconds after which a message is not worth
+            sending, counted from when the room's join is sent
+        """
+        self.clock = clock
+        self.maxlen = maxlen
+        self.max_age = max_age
+        # room => deque of (queued time, to, element)
+        self._rooms = {}
+        # room => when its join was sent, messages age from then on
+        self._join_sent = {}
+        self.queued = 0
+        self.delivered = 0
+        self.overflow = 0
+        self.expired = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def __len__(self):
+        """Number of messages waiting."""
+        return sum(len(queue) for queue in self._rooms.values())
+
+    def configure(self, config):
+        """Apply settings from the bot's properties table."""
+        self.maxlen = int(config.get("bot.muc_pending_max", self.maxlen))
+        self.max_age = float(
+            config.get("bot.muc_pending_max_age", self.max_age)
+        )
+
+    def add(self, room, elem):
+        """Queue a groupchat element until the room is joined.
+
+        The to attribute is kept aside, as the element may be reused for
+        other rooms, see basicbot.broadcast_groupchat_elem
+        """
+        queue = self._rooms.setdefault(room, deque())
+        if len(queue) >= self.maxlen:
+            queue.popleft()
+            self.overflow += 1
+        queue.append((self.clock.seconds(), elem["to"], elem))
+        self.queued += 1
+
+    def join_sent(self, room):
+        """The room's join went out, see JoinScheduler._send"""
+        self._join_sent[room] = self.clock.seconds()
+
+    def _expired(self, room, queued, now):
+        """If a message has waited too long since its room's join was sent"""
+        started = self._join_sent.get(room)
+        if started is None:
+            return False
+        return now - max(queued, started) > self.max_age
+
+    def drain(self, room, send):
+        """Send a room's waiting messages in order.
+
+        Args:
+          room (str): the room now joined
+          send (callable): sends an element, see OutboundQueue.send
+        """
+        now = self.clock.seconds()
+        for queued, to, elem in self._rooms.pop(room, ()):
+            if self._expired(room, queued, now):
+                self.expired += 1
+                continue
+            age = now - queued
+            elem["to"] = to
+            send(elem)
+            self.delivered += 1
+            self.latency_total += age
+            self.latency_max = max(self.latency_max, age)
+        self._join_sent.pop(room, None)
+
+    def discard(self, room):
+        """Drop a room's waiting messages, as we have left it."""
+        self._join_sent.pop(room, None)
+        self.expired += len(self._rooms.pop(room, ()))
+
+    def expire(self):
+        """Drop messages that waited too long, call this periodically."""
+        now = self.clock.seconds()
+        for room in list(self._rooms):
+            queue = self._rooms[room]
+            while queue and self._expired(room, queue[0][0], now):
+                queue.popleft()
+                self.expired += 1
+            if not queue:
+                del self._rooms[room]
+
+    def status(self):
+        """Queue state for the status page."""
+        return {
+            "muc.pending": len(self),
+            "muc.pending_rooms": len(self._rooms),
+            "muc.pending_delivered": self.delivered,
+            "muc.pending_overflow": self.overflow,
+            "muc.pending_expired": self.expired,
+            "muc.pending_latency_avg_ms": round(
+                1000.0 * self.latency_total / self.delivered
+                if self.delivered
+                else 0
+            ),
+            "muc.pending_latency_max_ms": round(1000.0 * self.latency_max),
+        }
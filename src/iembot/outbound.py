@@ -0,0 +1,188 @@
+"""Outbound stanza pipeline for the XMPP connection.
+
+Rather than each stanza being written to the transport on its own, stanzas
+are queued and written together once per reactor tick.  The queue registers
+as a streaming producer with the transport, so when the TCP write buffer
+fills up the bulk groupchat traffic waits until it drains.  IQ pings and
+join presences are small and keep the session alive, so they go first and
+are never held back.  Leaving a room is bulk, so that it follows the
+messages already queued for the room.  The bulk queue is unbounded unless
+bot.outbound_max_queued is set, in which case each dropped stanza is logged.
+"""
+import re
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.words.xish import domish
+
+from iembot.util import stanza_xml
+
+# What is logged of a dropped stanza
+TO_RE = re.compile(rb"""\sto=['"]([^'"@/]*)""")
+PRODUCT_RE = re.compile(rb"""\sproduct_id=['"]([^'"]*)""")
+
+
+def _attr(regex, data):
+    """An attribute value from serialized stanza, or None."""
+    match = regex.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode("utf-8", "ignore")
+
+
+def serialize(stanza, xs=None):
+    """Return the stanza as bytes.
+
+    Elements are serialized when queued, as callers may reuse them, see
+    basicbot.broadcast_groupchat_elem
+
+    Args:
+      stanza (domish.Element, str or bytes): what to write
+      xs (jabber.xmlstream.XmlStream): the stream whose namespaces are in
+        scope, the same bytes as its send then result
+    """
+    if isinstance(stanza, bytes):
+        return stanza
+    if isinstance(stanza, domish.Element):
+        if xs is not None:
+            return stanza_xml(xs, stanza)
+        stanza = stanza.toXml()
+    return stanza.encode("utf-8")
+
+
+class OutboundQueue:
+    """Tick batched, producer/consumer aware writes to the bot's xmlstream."""
+
+    def __init__(self, bot, clock=reactor, max_bytes=65536, max_queued=0):
+        """Constructor
+
+        Args:
+          bot (basicbot): the bot whose xmlstream is written to
+          clock (IReactorTime): schedules the flushes
+          max_bytes (int): bulk bytes written per flush
+          max_queued (int): bulk stanzas queued, beyond which the oldest are
+            dropped, 0 for no limit
+        """
+        self.bot = bot
+        self.clock = clock
+        self.max_bytes = max_bytes
+        self.max_queued = max_queued
+        self._priority = deque()
+        self._bulk = deque()
+        self._call = None
+        self.paused = False
+        self.stanzas = 0
+        self.flushes = 0
+        self.flush_size = 0
+        self.flush_size_max = 0
+        self.flush_bytes = 0
+        self.pauses = 0
+        self.dropped = 0
+
+    def __len__(self):
+        """Number of stanzas waiting."""
+        return len(self._priority) + len(self._bulk)
+
+    def configure(self, config):
+        """Apply settings from the bot's properties table."""
+        self.max_bytes = int(
+            config.get("bot.outbound_max_bytes", self.max_bytes)
+        )
+        self.max_queued = int(
+            config.get("bot.outbound_max_queued", self.max_queued)
+        )
+
+    def attach(self, transport):
+        """Watch the buffer of a newly connected transport."""
+        self.paused = False
+        transport.registerProducer(self, True)
+
+    def send(self, stanza, priority=False):
+        """Queue a stanza for the next flush.
+
+        Args:
+          stanza (domish.Element, str or bytes): what to write
+          priority (bool): pings and joins, sent ahead of the bulk
+        """
+        data = serialize(stanza, self.bot.xmlstream)
+        if priority:
+            self._priority.append(data)
+        else:
+            if 0 < self.max_queued <= len(self._bulk):
+                self._drop(self._bulk.popleft())
+            self._bulk.append(data)
+        self._schedule()
+
+    def _drop(self, data):
+        """Account for a bulk stanza that will never be sent."""
+        self.dropped += 1
+        log.msg(
+            f"OutboundQueue full, dropped stanza to {_attr(TO_RE, data)} "
+            f"product_id: {_attr(PRODUCT_RE, data)}"
+        )
+
+    def _schedule(self):
+        """Flush within the next reactor tick."""
+        if self._call is None:
+            self._call = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        """Write what is queued, bulk only while the transport keeps up."""
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self.bot.xmlstream is None:
+            return
+        chunks = list(self._priority)
+        self._priority.clear()
+        size = 0
+        while self._bulk and not self.paused and size < self.max_bytes:
+            data = self._bulk.popleft()
+            size += len(data)
+            chunks.append(data)
+        if not chunks:
+            return
+        data = b"".join(chunks)
+        self.stanzas += len(chunks)
+        self.flushes += 1
+        self.flush_size = len(chunks)
+        self.flush_size_max = max(self.flush_size_max, len(chunks))
+        self.flush_bytes = len(data)
+        self.bot.xmlstream.send(data)
+        if self._bulk and not self.paused:
+            self._schedule()
+
+    def pauseProducing(self):
+        """The transport's write buffer is full."""
+        self.paused = True
+        self.pauses += 1
+
+    def resumeProducing(self):
+        """The transport's write buffer has drained."""
+        self.paused = False
+        if self._bulk:
+            self._schedule()
+
+    def stopProducing(self):
+        """The connection is gone, what is queued goes nowhere."""
+        if self._bulk:
+            log.msg(f"OutboundQueue dropping {len(self._bulk)} stanzas")
+        self.dropped += len(self._bulk)
+        self._bulk.clear()
+        self._priority.clear()
+        self.paused = False
+
+    def status(self):
+        """Queue state for the status page."""
+        return {
+            "outbound.queued": len(self),
+            "outbound.paused": self.paused,
+            "outbound.stanzas": self.stanzas,
+            "outbound.flushes": self.flushes,
+            "outbound.flush_size": self.flush_size,
+            "outbound.flush_size_max": self.flush_size_max,
+            "outbound.flush_bytes": self.flush_bytes,
+            "outbound.pauses": self.pauses,
+            "outbound.dropped": self.dropped,
+        }
@@ -0,0 +1,270 @@
+"""Social media posting scheduler.
+
+Posting is blocking I/O done within threads.  Rather than each post holding
+a reactor thread, including while it sleeps before a retry, posts are
+queued per account and run on a small dedicated thread pool.  A post that
+wants another try raises PostRetry and is rescheduled with callLater, so
+no thread is held during the backoff.  Each account has at most one post
+in progress and runs its more important posts first, otherwise in order.
+
+The queues are bounded.  A full account queue sheds its least important,
+oldest post, and posts that waited too long to be useful are expired.
+"""
+import heapq
+import itertools
+from collections import deque
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from iembot.ratelimit import PRIORITY_HIGH, PRIORITY_NORMAL
+
+
+class PostRetry(Exception):
+    """Raised by a posting function to be called again later."""
+
+    def __init__(self, cause, delay=10, reraise=True, **overrides):
+        """Constructor
+
+        Args:
+          cause (Exception): what went wrong
+          delay (float): seconds to wait before the retry
+          reraise (bool): fail with the cause once out of retries, otherwise
+            the post quietly results in None
+          **overrides: keyword arguments replaced for the retry
+        """
+        Exception.__init__(self, str(cause))
+        self.cause = cause
+        self.delay = delay
+        self.reraise = reraise
+        self.overrides = overrides
+
+
+class _Job:
+    """A queued post."""
+
+    __slots__ = (
+        "func",
+        "args",
+        "kwargs",
+        "priority",
+        "seq",
+        "created",
+        "deferred",
+        "attempt",
+    )
+
+    def __init__(self, func, args, kwargs, priority, seq, created):
+        """Constructor"""
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.created = created
+        self.deferred = defer.Deferred()
+        self.attempt = 0
+
+    def key(self):
+        """Heap ordering within an account's queue."""
+        return (self.priority, self.seq, self)
+
+
+def _shed_order(key):
+    """The least important and then oldest job sorts last."""
+    return (key[0], -key[1])
+
+
+class PostingScheduler:
+    """Per-account queues feeding a fixed size thread pool."""
+
+    def __init__(
+        self,
+        clock=reactor,
+        workers=8,
+        max_retries=1,
+        max_depth=50,
+        max_queued=10000,
+        max_age=1800,
+    ):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): schedules the retries
+          workers (int): threads doing the posting
+          max_retries (int): retries allowed per post
+          max_depth (int): queued posts per account
+          max_queued (int): queued posts in total, beyond which only high
+            priority posts are accepted
+          max_age (float): seconds after which a queued post is discarded
+        """
+        self.clock = clock
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_depth = max_depth
+        self.max_queued = max_queued
+        self.max_age = max_age
+        self.pool = ThreadPool(
+            minthreads=0, maxthreads=workers, name="posting"
+        )
+        # account => heap of _Job.key()
+        self._queues = {}
+        self._seq = itertools.count()
+        # callable(account, priority) returning 0 to run a job now, seconds
+        # to defer it or None to drop it, see iembot.ratelimit.RateLimiter
+        self.gate = None
+        # accounts with a job in a thread or waiting out a backoff
+        self._busy = set()
+        # accounts with queued jobs and nothing busy, in turn order
+        self._ready = deque()
+        self.queued = 0
+        self.inflight = 0
+        self.backoff = 0
+        self.retries = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.shed = 0
+        self.expired = 0
+
+    def start(self):
+        """Start the thread pool, stopping it at reactor shutdown."""
+        self.pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.pool.stop)
+
+    def configure(self, config):
+        """Apply settings from the bot's properties table."""
+        self.workers = int(config.get("bot.posting_workers", self.workers))
+        self.max_retries = int(
+            config.get("bot.posting_retries", self.max_retries)
+        )
+        self.max_depth = int(
+            config.get("bot.posting_max_depth", self.max_depth)
+        )
+        self.max_queued = int(
+            config.get("bot.posting_max_queued", self.max_queued)
+        )
+        self.max_age = float(config.get("bot.posting_max_age", self.max_age))
+        self.pool.adjustPoolsize(maxthreads=self.workers)
+
+    def submit(self, account, func, *args, priority=PRIORITY_NORMAL, **kwargs):
+        """Queue a blocking posting call.
+
+        Args:
+          account (tuple): the queue, ie (medium, user_id)
+          func (callable): called within a thread with args and kwargs
+          priority (int): see iembot.ratelimit, lower runs first
+
+        Returns:
+          Deferred: fires with the result of func, or None if dropped
+        """
+        job = _Job(
+            func, args, kwargs, priority, next(self._seq), self.clock.seconds()
+        )
+        if self.queued >= self.max_queued and priority > PRIORITY_HIGH:
+            self.shed += 1
+            self._discard(job)
+            return job.deferred
+        queue = self._queues.get(account)
+        if queue is None:
+            queue = self._queues[account] = []
+            if account not in self._busy:
+                self._ready.append(account)
+        if len(queue) >= self.max_depth:
+            worst = max(queue, key=_shed_order)
+            self.shed += 1
+            if _shed_order(job.key()) >= _shed_order(worst):
+                self._discard(job)
+                return job.deferred
+            queue.remove(worst)
+            heapq.heapify(queue)
+            self.queued -= 1
+            self._discard(worst[2])
+        heapq.heappush(queue, job.key())
+        self.queued += 1
+        self._pump()
+        return job.deferred
+
+    def _discard(self, job):
+        """Give up on a job, its deferred fires with None."""
+        job.deferred.callback(None)
+
+    def _defer(self, func, *args, **kwargs):
+        """Run within the posting thread pool."""
+        return threads.deferToThreadPool(
+            reactor, self.pool, func, *args, **kwargs
+        )
+
+    def _pump(self):
+        """Start jobs while there are free workers."""
+        while self._ready and self.inflight < self.workers:
+            account = self._ready.popleft()
+            job = heapq.heappop(self._queues[account])[2]
+            self.queued -= 1
+            self._busy.add(account)
+            if self.clock.seconds() - job.created > self.max_age:
+                self.expired += 1
+                self._release(account, pump=False)
+                self._discard(job)
+                continue
+            delay = (
+                0 if self.gate is None else self.gate(account, job.priority)
+            )
+            if delay is None:
+                self.dropped += 1
+                self._release(account, pump=False)
+                self._discard(job)
+                continue
+            if delay > 0:
+                self.deferred += 1
+                self.backoff += 1
+                self.clock.callLater(delay, self._requeue, account, job)
+                continue
+            self.inflight += 1
+            df = self._defer(job.func, *job.args, **job.kwargs)
+            df.addBoth(self._done, account, job)
+
+    def _done(self, result, account, job):
+        """A job's thread has finished."""
+        self.inflight -= 1
+        if isinstance(result, Failure) and result.check(PostRetry):
+            retry = result.value
+            if job.attempt < self.max_retries:
+                job.attempt += 1
+                job.kwargs.update(retry.overrides)
+                self.retries += 1
+                self.backoff += 1
+                log.msg(f"{account} retrying in {retry.delay}s: {retry}")
+                self.clock.callLater(retry.delay, self._requeue, account, job)
+                self._pump()
+                return None
+            result = Failure(retry.cause) if retry.reraise else None
+            if not retry.reraise:
+                log.err(retry.cause)
+        if isinstance(result, Failure):
+            job.deferred.errback(result)
+        else:
+            job.deferred.callback(result)
+        self._release(account)
+        return None
+
+    def _requeue(self, account, job):
+        """A backoff is over, the job keeps its place in its queue."""
+        self.backoff -= 1
+        heapq.heappush(self._queues.setdefault(account, []), job.key())
+        self.queued += 1
+        self._busy.discard(account)
+        self._ready.append(account)
+        self._pump()
+
+    def _release(self, account, pump=True):
+        """The account can run its next job."""
+        self._busy.discard(account)
+        queue = self._queues.get(account)
+        if queue:
+            self._ready.append(account)
+        else:
+            self._queues.pop(account, None)
+        if pump:
+            self._pump()
@@ -0,0 +1,234 @@
+"""Twitter rate limiting fed by the API's response headers.
+
+Each tweet's response tells us the remaining per-user and per-app budget
+along with when it resets.  Token buckets track that budget between
+responses.  They gate the posting scheduler so that we stop making calls
+that would only come back over quota.  When the budget runs low, the posts
+of less important products are deferred or dropped first.
+"""
+from twisted.internet import reactor
+
+# Posting priorities, lower goes first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = {
+    "high": PRIORITY_HIGH,
+    "normal": PRIORITY_NORMAL,
+    "low": PRIORITY_LOW,
+}
+# Fraction of a bucket kept in reserve for more important posts
+RESERVE = {PRIORITY_HIGH: 0.0, PRIORITY_NORMAL: 0.1, PRIORITY_LOW: 0.25}
+# AFOS PIL prefixes of warnings
+HIGH_PILS = {"TOR", "SVR", "FFW", "EWW", "SMW", "SQW", "DSW", "TSU", "BZW"}
+# AFOS PIL prefixes of statements and other routine products
+LOW_PILS = {"SPS", "PNS", "RVS", "HWO", "AFD", "ZFP", "RWR", "LSR", "CLI"}
+
+
+def product_priority(product_id):
+    """Posting priority for a product.
+
+    Args:
+      product_id (str): ie 202310031200-KDMX-WUUS53-SVRDMX
+
+    Returns:
+      int: one of the PRIORITY_ constants
+    """
+    if not product_id:
+        return PRIORITY_NORMAL
+    pil = product_id.rsplit("-", 1)[-1][:3]
+    if pil in HIGH_PILS:
+        return PRIORITY_HIGH
+    if pil in LOW_PILS:
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
+
+
+def stanza_priority(x):
+    """Posting priority for an ingest stanza's x element.
+
+    An explicit priority attribute of high, normal or low wins over the
+    product_id based default.
+
+    Args:
+      x (domish.Element): the x element, or None
+    """
+    if x is None:
+        return PRIORITY_NORMAL
+    explicit = PRIORITIES.get(x.getAttribute("priority", "").lower())
+    if explicit is not None:
+        return explicit
+    return product_priority(x.getAttribute("product_id"))
+
+
+class TokenBucket:
+    """Token bucket refilled over a window and synced from headers."""
+
+    def __init__(self, capacity, window):
+        """Constructor
+
+        Args:
+          capacity (int): calls allowed per window
+          window (float): seconds for an empty bucket to refill
+        """
+        self.capacity = capacity
+        self.window = window
+        self.tokens = float(capacity)
+        self.stamp = None
+        # when an exhausted budget resets
+        self.blocked_until = 0
+
+    @property
+    def rate(self):
+        """Tokens added per second."""
+        return self.capacity / self.window
+
+    def _refill(self, now):
+        """Add the tokens accrued since the last look."""
+        if self.stamp is not None:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.stamp) * self.rate
+            )
+        self.stamp = now
+
+    def wait(self, now, reserve=0.0):
+        """Seconds until a call fits while keeping the reserve, 0 if now."""
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        self._refill(now)
+        needed = 1 + reserve * self.capacity
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, now):
+        """Spend a token."""
+        self._refill(now)
+        self.tokens -= 1
+
+    def sync(self, now, limit, remaining, reset):
+        """Adopt what the API says about this budget.
+
+        Args:
+          now (float): current epoch seconds
+          limit (int): calls allowed per window, or None
+          remaining (int): calls left in the window
+          reset (float): epoch seconds when the window resets, or None
+        """
+        if limit:
+            self.capacity = limit
+        self._refill(now)
+        self.tokens = min(float(remaining), self.capacity)
+        if remaining <= 0 and reset:
+            self.blocked_until = reset
+
+
+def _header_ints(headers, prefix):
+    """Parse the limit, remaining and reset headers sharing a prefix."""
+    res = []
+    for name in ("limit", "remaining", "reset"):
+        try:
+            res.append(int(headers.get(f"{prefix}-{name}")))
+        except (TypeError, ValueError):
+            res.append(None)
+    return res
+
+
+class RateLimiter:
+    """Per-user and per-app Twitter budgets gating the posting scheduler."""
+
+    def __init__(
+        self,
+        clock=reactor,
+        user_capacity=200,
+        user_window=900,
+        app_capacity=10000,
+        app_window=86400,
+    ):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): provides the time
+          user_capacity (int): initial tweets per user per window
+          user_window (float): seconds of the per-user window
+          app_capacity (int): initial tweets per app per window
+          app_window (float): seconds of the per-app window
+        """
+        self.clock = clock
+        self.user_capacity = user_capacity
+        self.user_window = user_window
+        self.app = TokenBucket(app_capacity, app_window)
+        # user_id => TokenBucket
+        self.users = {}
+        self.deferred = 0
+        self.dropped = 0
+
+    def _user(self, user_id):
+        """The user's bucket."""
+        bucket = self.users.get(user_id)
+        if bucket is None:
+            bucket = self.users[user_id] = TokenBucket(
+                self.user_capacity, self.user_window
+            )
+        return bucket
+
+    def admit(self, account, priority):
+        """Decide if a post may go now, see PostingScheduler.gate
+
+        Args:
+          account (tuple): (medium, user_id)
+          priority (int): one of the PRIORITY_ constants
+
+        Returns:
+          0 to post now, seconds to defer it, or None to drop it
+        """
+        medium, user_id = account
+        if medium != "twitter":
+            return 0
+        now = self.clock.seconds()
+        buckets = (self.app, self._user(user_id))
+        reserve = RESERVE.get(priority, 0)
+        wait = max(bucket.wait(now, reserve) for bucket in buckets)
+        if wait == 0:
+            for bucket in buckets:
+                bucket.take(now)
+            return 0
+        if priority >= PRIORITY_LOW:
+            self.dropped += 1
+            return None
+        self.deferred += 1
+        return wait
+
+    def update(self, user_id, headers):
+        """Sync the buckets from a response's headers, on the reactor thread.
+
+        Args:
+          user_id: who tweeted
+          headers (Mapping): the response headers
+        """
+        now = self.clock.seconds()
+        limit, remaining, reset = _header_ints(headers, "x-rate-limit")
+        if remaining is not None:
+            self._user(user_id).sync(now, limit, remaining, reset)
+        limit, remaining, reset = _header_ints(headers, "x-app-limit-24hour")
+        if remaining is not None:
+            self.app.sync(now, limit, remaining, reset)
+
+    def forget(self, user_id):
+        """Drop a user's bucket."""
+        self.users.pop(user_id, None)
+
+    def status(self):
+        """Limiter state for the status page."""
+        now = self.clock.seconds()
+        return {
+            "ratelimit.app.tokens": round(self.app.tokens, 1),
+            "ratelimit.app.capacity": self.app.capacity,
+            "ratelimit.app.wait": round(self.app.wait(now), 1),
+            "ratelimit.users": len(self.users),
+            "ratelimit.users_waiting": sum(
+                1 for bucket in self.users.values() if bucket.wait(now) > 0
+            ),
+            "ratelimit.deferred": self.deferred,
+            "ratelimit.dropped": self.dropped,
+        }
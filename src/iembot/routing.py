@@ -0,0 +1,205 @@
+"""Precompiled channel fan-out plans.
+
+An ingest stanza carries a handful of channels and each channel maps to
+rooms, social media accounts and webhooks via the bot's routing tables.  The
+same channel combinations repeat constantly, so we compile the de-duplicated
+targets once and memoize them until the routing tables are reloaded.
+"""
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+
+FANOUT_PLAN = namedtuple(
+    "FANOUT_PLAN", ["rooms", "twitter", "mastodon", "webhooks"]
+)
+
+
+class RoutingTable(Mapping):
+    """Channel <=> target subscriptions, indexed in both directions.
+
+    As a Mapping it reads as channel => tuple of targets.  Both directions
+    are dicts used as ordered sets, so targets keep subscription order.
+    """
+
+    def __init__(self, subscriptions=None):
+        """Constructor
+
+        Args:
+          subscriptions (Mapping): optional channel => iterable of targets
+        """
+        # channel => {target: None}
+        self._targets = {}
+        # target => {channel: None}
+        self._channels = {}
+        for channel, targets in (subscriptions or {}).items():
+            for target in targets:
+                self.add(channel, target)
+
+    def __getitem__(self, channel):
+        """The targets subscribed to the channel."""
+        return tuple(self._targets[channel])
+
+    def __contains__(self, channel):
+        """Does the channel have subscriptions."""
+        return channel in self._targets
+
+    def __iter__(self):
+        """Iterate the channels having subscriptions."""
+        return iter(self._targets)
+
+    def __len__(self):
+        """Number of channels having subscriptions."""
+        return len(self._targets)
+
+    def __repr__(self):
+        """Representation"""
+        return f"RoutingTable({dict(self.items())!r})"
+
+    def subscribed(self, channel, target):
+        """Is target subscribed to channel."""
+        return target in self._targets.get(channel, ())
+
+    def channels(self, target):
+        """The channels target is subscribed to, in subscription order."""
+        return tuple(self._channels.get(target, ()))
+
+    def targets(self):
+        """The targets having subscriptions."""
+        return self._channels.keys()
+
+    def add(self, channel, target):
+        """Subscribe target to channel.
+
+        Returns:
+          bool: False if it already was
+        """
+        targets = self._targets.setdefault(channel, {})
+        if target in targets:
+            return False
+        targets[target] = None
+        self._channels.setdefault(target, {})[channel] = None
+        return True
+
+    def remove(self, channel, target):
+        """Unsubscribe target from channel.
+
+        Returns:
+          bool: False if it was not subscribed
+        """
+        targets = self._targets.get(channel)
+        if targets is None or target not in targets:
+            return False
+        del targets[target]
+        if not targets:
+            del self._targets[channel]
+        channels = self._channels[target]
+        del channels[channel]
+        if not channels:
+            del self._channels[target]
+        return True
+
+    def set_channels(self, target, channels):
+        """Make target subscribe to exactly these channels."""
+        wanted = dict.fromkeys(channels)
+        for channel in self.channels(target):
+            if channel not in wanted:
+                self.remove(channel, target)
+        for channel in wanted:
+            self.add(channel, target)
+
+    def set_targets(self, channel, targets):
+        """Make channel have exactly these targets."""
+        wanted = dict.fromkeys(targets)
+        for target in self._targets.get(channel, {}).copy():
+            if target not in wanted:
+                self.remove(channel, target)
+        for target in wanted:
+            self.add(channel, target)
+
+    def check(self):
+        """Verify both directions agree.
+
+        Raises:
+          ValueError: describing the first inconsistency found
+        """
+        for name, index, other in [
+            ("channel", self._targets, self._channels),
+            ("target", self._channels, self._targets),
+        ]:
+            for key, values in index.items():
+                if not values:
+                    raise ValueError(f"{name} {key!r} has an empty entry")
+                for value in values:
+                    if key not in other.get(value, ()):
+                        raise ValueError(
+                            f"{name} {key!r} => {value!r} is not indexed "
+                            "the other way"
+                        )
+
+
+def compile_plan(bot, channels):
+    """Build the fan-out targets for the given channels.
+
+    Args:
+      bot (basicbot): the running bot instance
+      channels (iterable): channels found on the stanza
+
+    Returns:
+      FANOUT_PLAN: tuples of de-duplicated targets, ordered by sorted
+        channel name and then subscription order
+    """
+    rooms = {}
+    twitter = {}
+    md = {}
+    hooks = {}
+    # sorted so that a plan does not depend on the stanza's channel order
+    for channel in sorted(channels):
+        rooms.update(dict.fromkeys(bot.routingtable.get(channel, [])))
+        twitter.update(dict.fromkeys(bot.tw_routingtable.get(channel, [])))
+        md.update(dict.fromkeys(bot.md_routingtable.get(channel, [])))
+        hooks.update(dict.fromkeys(bot.webhooks_routingtable.get(channel, [])))
+    return FANOUT_PLAN(tuple(rooms), tuple(twitter), tuple(md), tuple(hooks))
+
+
+class FanoutPlanner:
+    """LRU memoization of compiled fan-out plans."""
+
+    def __init__(self, bot, maxsize=4096):
+        """Constructor
+
+        Args:
+          bot (basicbot): the bot whose routing tables we compile
+          maxsize (int): number of channel combinations to remember
+        """
+        self.bot = bot
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        """Number of memoized plans."""
+        return len(self._cache)
+
+    def invalidate(self):
+        """Forget all plans, call this after any routing table changes.
+
+        The loaders run within database threads, so we swap in a new dict
+        rather than mutate the one the reactor may be iterating.
+        """
+        self._cache = OrderedDict()
+
+    def plan(self, channels):
+        """Return the FANOUT_PLAN for the given channels."""
+        key = frozenset(channels)
+        cache = self._cache
+        res = cache.get(key)
+        if res is not None:
+            self.hits += 1
+            cache.move_to_end(key)
+            return res
+        self.misses += 1
+        res = compile_plan(self.bot, key)
+        cache[key] = res
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return res
@@ -1,23 +1,20 @@
 """Utility functions for IEMBot"""
 # pylint: disable=protected-access
-import copy
 import datetime
 import glob
 import json
 import os
-import pickle
 import pwd
 import re
 import socket
-import time
 import traceback
+from collections import namedtuple
 from email.mime.text import MIMEText
 from html import unescape
 from io import BytesIO
 from zoneinfo import ZoneInfo
 
 import mastodon
-import requests
 import twitter
 from pyiem.reference import TWEET_CHARS
 from pyiem.util import utc
@@ -30,8 +27,14 @@ from twitter.error import TwitterError
 
 # local
 import iembot
+from iembot.chatlog import make_entry
+from iembot.muc import join_priority
+from iembot.posting import PostRetry
+from iembot.routing import RoutingTable
 
 TWEET_API = "https://api.twitter.com/2/tweets"
+# A load_chatrooms_from_db result, rooms is roomname => twitter
+CHATROOMS = namedtuple("CHATROOMS", ["routingtable", "syndication", "rooms"])
 
 
 def tweet(bot, user_id, twttxt, **kwargs):
@@ -39,19 +42,7 @@ def tweet(bot, user_id, twttxt, **kwargs):
     if user_id not in bot.tw_users:
         log.msg(f"tweet() called with unknown user_id: {user_id}")
         return None
-    api = twitter.Api(
-        consumer_key=bot.config["bot.twitter.consumerkey"],
-        consumer_secret=bot.config["bot.twitter.consumersecret"],
-        access_token_key=bot.tw_users[user_id]["access_token"],
-        access_token_secret=bot.tw_users[user_id]["access_token_secret"],
-    )
-    # Le Sigh, api.__auth is private
-    auth = OAuth1(
-        bot.config["bot.twitter.consumerkey"],
-        bot.config["bot.twitter.consumersecret"],
-        bot.tw_users[user_id]["access_token"],
-        bot.tw_users[user_id]["access_token_secret"],
-    )
+    api, auth = get_twitter_client(bot, user_id)
     log.msg(
         f"Tweeting {bot.tw_users[user_id]['screen_name']}({user_id}) "
         f"'{twttxt}' media:{kwargs.get('twitter_media')}"
@@ -67,6 +58,7 @@ def tweet(bot, user_id, twttxt, **kwargs):
             f"x-rate-limit-limit {resp.headers.get('x-rate-limit-limit')} + "
             f"{hh} {resp.headers.get(hh)}"
         )
+        reactor.callFromThread(bot.tw_limits.update, user_id, resp.headers)
         return api._ParseAndCheckTwitter(resp.content.decode("utf-8"))
 
     res = None
@@ -76,7 +68,7 @@ def tweet(bot, user_id, twttxt, **kwargs):
         }
         # If we have media, we have some work to do!
         if media is not None:
-            media_id = api.UploadMediaSimple(media)
+            media_id = api.UploadMediaSimple(bot.media.open(media))
             # string required
             params["media"] = {"media_ids": [f"{media_id}"]}
             res = _helper(params)
@@ -95,27 +87,68 @@ def tweet(bot, user_id, twttxt, **kwargs):
             res = _helper(params)
         else:
             log.err(exp)
-            # Since this called from a thread, sleeping should not jam us up
-            time.sleep(10)
-            res = _helper(params)
+            # The posting scheduler calls us again later
+            raise PostRetry(exp, kwargs.get("sleep", 10)) from exp
     except Exception as exp:
         log.err(exp)
-        # Since this called from a thread, sleeping should not jam us up
-        time.sleep(10)
-        params.pop("media", None)
-        res = _helper(params)
+        # Try again later without media
+        raise PostRetry(
+            exp, kwargs.get("sleep", 10), twitter_media=None
+        ) from exp
     return res
 
 
+def get_twitter_client(bot, user_id):
+    """Return the cached (twitter.Api, OAuth1) for this user_id.
+
+    The api's session keeps its connections alive between tweets.
+    """
+    credentials = (
+        bot.config["bot.twitter.consumerkey"],
+        bot.config["bot.twitter.consumersecret"],
+        bot.tw_users[user_id]["access_token"],
+        bot.tw_users[user_id]["access_token_secret"],
+    )
+
+    def _build():
+        api = twitter.Api(
+            consumer_key=credentials[0],
+            consumer_secret=credentials[1],
+            access_token_key=credentials[2],
+            access_token_secret=credentials[3],
+        )
+        # Le Sigh, api.__auth is private
+        return api, OAuth1(*credentials)
+
+    return bot.tw_clients.get(user_id, credentials, _build)
+
+
+def get_mastodon_client(bot, user_id):
+    """Return the cached mastodon.Mastodon for this user_id.
+
+    Clients for accounts on the same server share a pooled session.
+    """
+    credentials = (
+        bot.md_users[user_id]["access_token"],
+        bot.md_users[user_id]["api_base_url"],
+    )
+
+    def _build():
+        return mastodon.Mastodon(
+            access_token=credentials[0],
+            api_base_url=credentials[1],
+            session=bot.md_sessions.get(credentials[1]),
+        )
+
+    return bot.md_clients.get(user_id, credentials, _build)
+
+
 def toot(bot, user_id, twttxt, **kwargs):
     """Blocking Mastodon toot method."""
     if user_id not in bot.md_users:
         log.msg(f"toot() called with unknown Mastodon user_id: {user_id}")
         return None
-    api = mastodon.Mastodon(
-        access_token=bot.md_users[user_id]["access_token"],
-        api_base_url=bot.md_users[user_id]["api_base_url"],
-    )
+    api = get_mastodon_client(bot, user_id)
     log.msg(
         f"Sending to Mastodon {bot.md_users[user_id]['screen_name']}({user_id}) "
         f"'{twttxt}' media:{kwargs.get('twitter_media')}"
@@ -130,34 +163,28 @@ def toot(bot, user_id, twttxt, **kwargs):
         }
         # If we have media, we have some work to do!
         if media is not None:
-            req = requests.get(media, timeout=30, stream=True)
-            # TODO: Is this always image/png?
-            media_id = api.media_post(req.raw, mime_type="image/png")
+            fh = bot.media.open(media)
+            media_id = api.media_post(fh, mime_type=fh.mime_type)
             params["media_ids"] = [media_id]
         res = api.status_post(**params)
     except mastodon.errors.MastodonRatelimitError as exp:
-        # Submitted too quickly
+        # Submitted too quickly, the posting scheduler calls us again later
         log.err(exp)
-        # Since this called from a thread, sleeping should not jam us up
-        time.sleep(kwargs.get("sleep", 10))
-        res = api.status_post(**params)
+        raise PostRetry(exp, kwargs.get("sleep", 10)) from exp
     except mastodon.errors.MastodonError as exp:
         # Something else bad happened when submitting this to the Mastodon server
         log.err(exp)
-        params.pop("media_ids", None)  # Try again without media
-        # Since this called from a thread, sleeping should not jam us up
-        time.sleep(kwargs.get("sleep", 10))
-        try:
-            res = api.status_post(**params)
-        except mastodon.errors.MastodonError as exp2:
-            log.err(exp2)
+        # Try again without media, only logging a second failure
+        raise PostRetry(
+            exp, kwargs.get("sleep", 10), reraise=False, twitter_media=None
+        ) from exp
     except Exception as exp:
         # Something beyond Mastodon went wrong
         log.err(exp)
-        params.pop("media_ids", None)  # Try again without media
-        # Since this called from a thread, sleeping should not jam us up
-        time.sleep(kwargs.get("sleep", 10))
-        res = api.status_post(**params)
+        # Try again later without media
+        raise PostRetry(
+            exp, kwargs.get("sleep", 10), twitter_media=None
+        ) from exp
     return res
 
 
@@ -166,10 +193,7 @@ def channels_room_list(bot, room):
     Send a listing of channels that the room is subscribed to...
     @param room to list
     """
-    channels = []
-    for channel in bot.routingtable.keys():
-        if room in bot.routingtable[channel]:
-            channels.append(channel)
+    channels = list(bot.routingtable.channels(room))
 
     # Need to add a space in the channels listing so that the string does
     # not get so long that it causes chat clients to bail
@@ -197,10 +221,8 @@ def channels_room_add(txn, bot, room, channel):
         return
     # Allow channels to be comma delimited
     for ch in channel.split(","):
-        if ch not in bot.routingtable:
-            bot.routingtable[ch] = []
         # If we are already subscribed, let em know!
-        if room in bot.routingtable[ch]:
+        if bot.routingtable.subscribed(ch, room):
             bot.send_groupchat(
                 room,
                 "Error adding subscription, your room is already subscribed "
@@ -220,7 +242,8 @@ def channels_room_add(txn, bot, room, channel):
             )
 
         # Add to routing table
-        bot.routingtable[ch].append(room)
+        bot.routingtable.add(ch, room)
+        bot.fanout.invalidate()
         # Add to database
         txn.execute(
             f"INSERT into {bot.name}_room_subscriptions "
@@ -250,12 +273,13 @@ def channels_room_del(txn, bot, room, channel):
             bot.send_groupchat(room, f"Unknown channel: '{ch}'")
             continue
 
-        if room not in bot.routingtable[ch]:
+        if not bot.routingtable.subscribed(ch, room):
             bot.send_groupchat(room, f"Room not subscribed to channel: '{ch}'")
             continue
 
         # Remove from routing table
-        bot.routingtable[ch].remove(room)
+        bot.routingtable.remove(ch, room)
+        bot.fanout.invalidate()
         # Remove from database
         txn.execute(
             f"DELETE from {bot.name}_room_subscriptions WHERE "
@@ -272,8 +296,15 @@ def purge_logs(bot):
     basets = utc() - datetime.timedelta(
         days=int(bot.config.get("bot.purge_xmllog_days", 7))
     )
-    for fn in glob.glob("logs/xmllog.*"):
-        ts = datetime.datetime.strptime(fn, "logs/xmllog.%Y_%m_%d")
+    for fn in glob.glob(os.path.join(bot.xmllog.directory, "xmllog.*")):
+        # rotated logs may have been compressed, see iembot.xmllog
+        m = re.match(
+            r"xmllog\.(\d{4}_\d{1,2}_\d{1,2})(\.gz|\.zst)?$",
+            os.path.basename(fn),
+        )
+        if m is None:
+            continue
+        ts = datetime.datetime.strptime(m.group(1), "%Y_%m_%d")
         ts = ts.replace(tzinfo=ZoneInfo("UTC"))
         if ts < basets:
             log.msg(f"Purging logfile {fn}")
@@ -368,6 +399,8 @@ def disable_twitter_user(bot, user_id, errcode=0):
         log.msg(f"Skipping disabling of twitter for {user_id} ({screen_name})")
         return False
     bot.tw_users.pop(user_id, None)
+    bot.tw_clients.invalidate(user_id)
+    bot.tw_limits.forget(user_id)
     log.msg(
         f"Removing twitter access token for user: {user_id} ({screen_name}) "
         f"errcode: {errcode}"
@@ -463,6 +496,7 @@ def disable_mastodon_user(bot, user_id, errcode=0):
         )
         return False
     bot.md_users.pop(user_id, None)
+    bot.md_clients.invalidate(user_id)
     log.msg(
         f"Removing Mastodon access token for user: {user_id} ({screen_name}) "
         f"errcode: {errcode}"
@@ -523,33 +557,30 @@ def mastodon_errback(err, bot, user_id, tweettext):
         email_error(err, bot, msg)
 
 
-def load_chatrooms_from_db(txn, bot, always_join):
-    """Load database configuration and do work
+def load_chatrooms_from_db(txn, bot):
+    """Load the chatroom configuration, see apply_chatrooms
+
+    This runs within a database thread, so it only reads from the database
+    and builds a new snapshot, leaving the running bot alone.
 
     Args:
       txn (dbtransaction): database cursor
       bot (basicbot): the running bot instance
-      always_join (boolean): do we force joining each room, regardless
+
+    Returns:
+      CHATROOMS: the snapshot
     """
     # Load up the routingtable for bot products
-    rt = {}
+    rt = RoutingTable()
     txn.execute(
         f"SELECT roomname, channel from {bot.name}_room_subscriptions "
         "WHERE roomname is not null and channel is not null"
     )
-    rooms = []
     for row in txn.fetchall():
-        rm = row["roomname"]
-        channel = row["channel"]
-        if channel not in rt:
-            rt[channel] = []
-        rt[channel].append(rm)
-        if rm not in rooms:
-            rooms.append(rm)
-    bot.routingtable = rt
+        rt.add(row["channel"], row["roomname"])
     log.msg(
         f"... loaded {txn.rowcount} channel subscriptions for "
-        f"{len(rooms)} rooms"
+        f"{len(rt.targets())} rooms"
     )
 
     # Now we need to load up the syndication
@@ -559,12 +590,7 @@ def load_chatrooms_from_db(txn, bot, always_join):
         "WHERE roomname is not null and endpoint is not null"
     )
     for row in txn.fetchall():
-        rm = row["roomname"]
-        endpoint = row["endpoint"]
-        if rm not in synd:
-            synd[rm] = []
-        synd[rm].append(endpoint)
-    bot.syndication = synd
+        synd.setdefault(row["roomname"], []).append(row["endpoint"])
     log.msg(
         f"... loaded {txn.rowcount} room syndications for {len(synd)} rooms"
     )
@@ -574,10 +600,26 @@ def load_chatrooms_from_db(txn, bot, always_join):
         f"SELECT roomname, twitter from {bot.name}_rooms "
         "WHERE roomname is not null ORDER by roomname ASC"
     )
-    oldrooms = list(bot.rooms.keys())
+    rooms = {row["roomname"]: row["twitter"] for row in txn.fetchall()}
+    log.msg(f"... loaded {len(rooms)} chatrooms")
+    return CHATROOMS(rt, synd, rooms)
+
+
+def apply_chatrooms(snapshot, bot, always_join):
+    """Swap a chatroom snapshot into the running bot, on the reactor thread
+
+    Args:
+      snapshot (CHATROOMS): from load_chatrooms_from_db
+      bot (basicbot): the running bot instance
+      always_join (boolean): do we force joining each room, regardless
+    """
+    bot.routingtable = snapshot.routingtable
+    bot.syndication = snapshot.syndication
+    bot.fanout.invalidate()
+
+    oldrooms = set(bot.rooms)
     joined = 0
-    for i, row in enumerate(txn.fetchall()):
-        rm = row["roomname"]
+    for rm, twitter_name in snapshot.rooms.items():
         # Setup Room Config Dictionary
         if rm not in bot.rooms:
             bot.rooms[rm] = {
@@ -585,54 +627,64 @@ def load_chatrooms_from_db(txn, bot, always_join):
                 "occupants": {},
                 "joined": False,
             }
-        bot.rooms[rm]["twitter"] = row["twitter"]
+        bot.rooms[rm]["twitter"] = twitter_name
 
         if always_join or rm not in oldrooms:
-            presence = domish.Element(("jabber:client", "presence"))
-            presence["to"] = f"{rm}@{bot.conference}/{bot.myjid.user}"
-            # Some jitter to prevent overloading
-            jitter = (
-                0
-                if rm
-                in [
-                    "botstalk",
-                ]
-                else i % 30
-            )
-            reactor.callLater(jitter, bot.xmlstream.send, presence)
+            # Paced by the join scheduler to prevent overloading
+            bot.joins.request(rm, join_priority(rm, snapshot.routingtable))
             joined += 1
-        if rm in oldrooms:
-            oldrooms.remove(rm)
 
     # Check old rooms for any rooms we need to vacate!
-    for rm in oldrooms:
+    vacate = oldrooms.difference(snapshot.rooms)
+    for rm in vacate:
         presence = domish.Element(("jabber:client", "presence"))
         presence["to"] = f"{rm}@{bot.conference}/{bot.myjid.user}"
         presence["type"] = "unavailable"
-        bot.xmlstream.send(presence)
+        # behind the room's queued messages, which would bounce once left
+        bot.outbound.send(presence)
+        bot.joins.forget(rm)
+        bot.pending_sends.discard(rm)
 
         del bot.rooms[rm]
     log.msg(
-        f"... loaded {txn.rowcount} chatrooms, joined {joined} of them, "
-        f"left {len(oldrooms)} of them"
+        f"apply_chatrooms(): {len(snapshot.rooms)} chatrooms, joined "
+        f"{joined} of them, left {len(vacate)} of them"
     )
 
 
+def webhook_batching(row):
+    """The (window seconds, batch size) of a webhooks row, or None"""
+    window = row.get("batch_window_ms")
+    if not window or window <= 0:
+        return None
+    return window / 1000.0, max(row.get("batch_size") or 20, 1)
+
+
 def load_webhooks_from_db(txn, bot):
-    """Load twitter config from database"""
+    """Load webhooks config from database
+
+    The optional batch_window_ms and batch_size columns enable batching of
+    the url's messages, see iembot.webhooks.WebhookBatcher.
+    """
+    # SELECT * as the batching columns may not exist on older databases
     txn.execute(
-        f"SELECT channel, url from {bot.name}_webhooks "
+        f"SELECT * from {bot.name}_webhooks "
         "WHERE channel is not null and url is not null"
     )
-    table = {}
+    table = RoutingTable()
+    batching = {}
     for row in txn.fetchall():
         url = row["url"]
         channel = row["channel"]
         if url == "" or channel == "":
             continue
-        res = table.setdefault(channel, [])
-        res.append(url)
+        table.add(channel, url)
+        urlbatching = webhook_batching(row)
+        if urlbatching is not None:
+            batching[url] = urlbatching
     bot.webhooks_routingtable = table
+    bot.webhooks_batching = batching
+    bot.fanout.invalidate()
     log.msg(f"load_webhooks_from_db(): {txn.rowcount} subs found")
 
 
@@ -645,12 +697,9 @@ def load_twitter_from_db(txn, bot):
         "WHERE s.user_id is not null and s.channel is not null "
         "and o.access_token is not null and not o.disabled"
     )
-    twrt = {}
+    twrt = RoutingTable()
     for row in txn.fetchall():
-        user_id = row["user_id"]
-        channel = row["channel"]
-        d = twrt.setdefault(channel, [])
-        d.append(user_id)
+        twrt.add(row["channel"], row["user_id"])
     # bot.tw_routingtable = twrt
     log.msg(f"load_twitter_from_db(): {txn.rowcount} subs found")
 
@@ -671,15 +720,17 @@ def load_twitter_from_db(txn, bot):
             "iem_owned": row["iem_owned"],
         }
     bot.tw_users = twusers
+    bot.tw_clients.retain(twusers)
+    bot.fanout.invalidate()
     log.msg(f"load_twitter_from_db(): {txn.rowcount} oauth tokens found")
 
 
 def load_mastodon_from_db(txn, bot):
     """Load Mastodon config from database"""
     txn.execute("select channel, user_id from iembot_mastodon_subs")
-    mdrt = {}
+    mdrt = RoutingTable()
     for row in txn.fetchall():
-        mdrt.setdefault(row["channel"], []).append(row["user_id"])
+        mdrt.add(row["channel"], row["user_id"])
     bot.md_routingtable = mdrt
     log.msg(f"load_mastodon_from_db(): {txn.rowcount} subs found")
 
@@ -700,29 +751,233 @@ def load_mastodon_from_db(txn, bot):
             "iem_owned": row["iem_owned"],
         }
     bot.md_users = mdusers
+    bot.md_clients.invalidate()
+    bot.md_sessions.prune(u["api_base_url"] for u in mdusers.values())
+    bot.fanout.invalidate()
     log.msg(f"load_mastodon_from_db(): {txn.rowcount} access tokens found")
 
 
+def load_room_from_db(txn, bot, room):
+    """Fetch a single room's configuration, see apply_room_config
+
+    Returns:
+      dict: None when the room no longer exists
+    """
+    txn.execute(
+        f"SELECT twitter from {bot.name}_rooms WHERE roomname = %s", (room,)
+    )
+    row = txn.fetchone()
+    if row is None:
+        return None
+    config = {"twitter": row["twitter"]}
+    txn.execute(
+        f"SELECT channel from {bot.name}_room_subscriptions "
+        "WHERE roomname = %s and channel is not null",
+        (room,),
+    )
+    config["channels"] = [row["channel"] for row in txn.fetchall()]
+    txn.execute(
+        f"SELECT endpoint from {bot.name}_room_syndications "
+        "WHERE roomname = %s and endpoint is not null",
+        (room,),
+    )
+    config["syndication"] = [row["endpoint"] for row in txn.fetchall()]
+    return config
+
+
+def apply_room_config(config, bot, room):
+    """Patch one room into the running bot, on the reactor thread
+
+    Args:
+      config (dict): from load_room_from_db
+      bot (basicbot): the running bot instance
+      room (str): the room
+    """
+    bot.routingtable.set_channels(
+        room, [] if config is None else config["channels"]
+    )
+    if config is not None and config["syndication"]:
+        bot.syndication[room] = config["syndication"]
+    else:
+        bot.syndication.pop(room, None)
+    if config is None:
+        if bot.rooms.pop(room, None) is not None:
+            presence = domish.Element(("jabber:client", "presence"))
+            presence["to"] = f"{room}@{bot.conference}/{bot.myjid.user}"
+            presence["type"] = "unavailable"
+            # behind the room's queued messages, see apply_chatrooms
+            bot.outbound.send(presence)
+            bot.joins.forget(room)
+            bot.pending_sends.discard(room)
+    else:
+        if room not in bot.rooms:
+            bot.rooms[room] = {
+                "twitter": None,
+                "occupants": {},
+                "joined": False,
+            }
+            bot.joins.request(room, join_priority(room, bot.routingtable))
+        bot.rooms[room]["twitter"] = config["twitter"]
+    bot.fanout.invalidate()
+    log.msg(f"apply_room_config(): reloaded room {room}")
+
+
+def load_channel_from_db(txn, bot, channel):
+    """Fetch everything subscribed to one channel, see apply_channel_config
+
+    Twitter routing is left alone, as load_twitter_from_db does.
+
+    Returns:
+      dict: of rooms, mastodon and webhooks lists
+    """
+    config = {}
+    txn.execute(
+        f"SELECT roomname from {bot.name}_room_subscriptions "
+        "WHERE channel = %s and roomname is not null",
+        (channel,),
+    )
+    config["rooms"] = [row["roomname"] for row in txn.fetchall()]
+    txn.execute(
+        "select user_id from iembot_mastodon_subs WHERE channel = %s",
+        (channel,),
+    )
+    config["mastodon"] = [row["user_id"] for row in txn.fetchall()]
+    txn.execute(
+        f"SELECT * from {bot.name}_webhooks "
+        "WHERE channel = %s and url is not null and url != ''",
+        (channel,),
+    )
+    rows = txn.fetchall()
+    config["webhooks"] = [row["url"] for row in rows]
+    config["webhooks_batching"] = {
+        row["url"]: webhook_batching(row) for row in rows
+    }
+    return config
+
+
+def apply_channel_config(config, bot, channel):
+    """Patch one channel into the routing tables, on the reactor thread"""
+    for table, key in [
+        (bot.routingtable, "rooms"),
+        (bot.md_routingtable, "mastodon"),
+        (bot.webhooks_routingtable, "webhooks"),
+    ]:
+        table.set_targets(channel, config[key])
+    for url, batching in config["webhooks_batching"].items():
+        if batching is None:
+            bot.webhooks_batching.pop(url, None)
+        else:
+            bot.webhooks_batching[url] = batching
+    bot.fanout.invalidate()
+    log.msg(f"apply_channel_config(): reloaded channel {channel}")
+
+
+def load_twitter_user_from_db(txn, bot, user_id):
+    """Fetch one Twitter account's tokens, see apply_twitter_user
+
+    Its subscriptions are not loaded, as load_twitter_from_db does not
+    route to Twitter either.
+
+    Returns:
+      dict: None when the account is no longer usable
+    """
+    txn.execute(
+        "SELECT access_token, access_token_secret, screen_name, iem_owned "
+        f"from {bot.name}_twitter_oauth WHERE user_id = %s and "
+        "access_token is not null and access_token_secret is not null and "
+        "screen_name is not null and not disabled",
+        (user_id,),
+    )
+    row = txn.fetchone()
+    if row is None:
+        return None
+    return {
+        "user": {
+            "screen_name": row["screen_name"],
+            "access_token": row["access_token"],
+            "access_token_secret": row["access_token_secret"],
+            "iem_owned": row["iem_owned"],
+        },
+    }
+
+
+def apply_twitter_user(config, bot, user_id):
+    """Patch one Twitter account into the running bot, on the reactor"""
+    if config is None:
+        bot.tw_users.pop(user_id, None)
+    else:
+        bot.tw_users[user_id] = config["user"]
+    bot.tw_clients.invalidate(user_id)
+    bot.fanout.invalidate()
+    log.msg(f"apply_twitter_user(): reloaded twitter user {user_id}")
+
+
+def load_mastodon_user_from_db(txn, bot, user_id):
+    """Fetch one Mastodon account, see apply_mastodon_user
+
+    Returns:
+      dict: None when the account is no longer usable
+    """
+    txn.execute(
+        """
+        select server, o.access_token, o.screen_name, o.iem_owned
+        from iembot_mastodon_apps a JOIN iembot_mastodon_oauth o
+            on (a.id = o.appid) WHERE o.id = %s and
+        o.access_token is not null and not o.disabled
+        """,
+        (user_id,),
+    )
+    row = txn.fetchone()
+    if row is None:
+        return None
+    txn.execute(
+        "select channel from iembot_mastodon_subs WHERE user_id = %s",
+        (user_id,),
+    )
+    return {
+        "user": {
+            "screen_name": row["screen_name"],
+            "access_token": row["access_token"],
+            "api_base_url": row["server"],
+            "iem_owned": row["iem_owned"],
+        },
+        "channels": [row["channel"] for row in txn.fetchall()],
+    }
+
+
+def apply_mastodon_user(config, bot, user_id):
+    """Patch one Mastodon account into the running bot, on the reactor"""
+    if config is None:
+        bot.md_users.pop(user_id, None)
+        bot.md_routingtable.set_channels(user_id, [])
+    else:
+        bot.md_users[user_id] = config["user"]
+        bot.md_routingtable.set_channels(user_id, config["channels"])
+    bot.md_clients.invalidate(user_id)
+    bot.fanout.invalidate()
+    log.msg(f"apply_mastodon_user(): reloaded Mastodon user {user_id}")
+
+
 def load_chatlog(bot):
-    """load up our pickled chatlog"""
-    if not os.path.isfile(bot.PICKLEFILE):
-        log.msg(f"pickfile not found: {bot.PICKLEFILE}")
-        return
+    """replay our chatlog journal, importing the legacy pickle once"""
+    journal = bot.chatlog_journal
     try:
-        with open(bot.PICKLEFILE, "rb") as fh:
-            oldlog = pickle.load(fh)
-        for rm in oldlog:
-            rmlog = oldlog[rm]
-            bot.chatlog[rm] = copy.deepcopy(rmlog)
-            if not rmlog:
+        if not journal.exists():
+            if not os.path.isfile(bot.PICKLEFILE):
+                log.msg(f"pickfile not found: {bot.PICKLEFILE}")
+                return
+            count = journal.import_pickle(bot.PICKLEFILE)
+            log.msg(f"Imported {count} entries from {bot.PICKLEFILE}")
+        for room, fields in journal.replay():
+            entry = make_entry(fields)
+            roomlog = bot.chatlog.get(room)
+            # Replays may repeat entries we already have
+            if roomlog and entry.seqnum <= roomlog.newest().seqnum:
                 continue
-            # First message in list is the newest :/
-            seq = rmlog[0].seqnum
-            if seq is not None and int(seq) > bot.seqnum:
-                bot.seqnum = int(seq)
-        log.msg(
-            f"Loaded CHATLOG pickle: {bot.PICKLEFILE}, seqnum: {bot.seqnum}"
-        )
+            bot.append_chatlog(room, entry, journal=False)
+            if entry.seqnum is not None and int(entry.seqnum) > bot.seqnum:
+                bot.seqnum = int(entry.seqnum)
+        log.msg(f"Loaded CHATLOG {journal.path}, seqnum: {bot.seqnum}")
     except Exception as exp:
         log.err(exp)
 
@@ -784,6 +1039,26 @@ def html_encode(s):
     return s
 
 
+def stanza_xml(xs, elem):
+    """Serialize a stanza exactly as the jabber XmlStream.send would.
+
+    The stream's default namespace and prefixes are in scope, so the root
+    element does not repeat xmlns='jabber:client'.
+
+    Args:
+      xs (jabber.xmlstream.XmlStream): the stream the stanza is for
+      elem (domish.Element): a direct child of the stream's root
+
+    Returns:
+      bytes
+    """
+    return elem.toXml(
+        prefixes=xs.prefixes,
+        defaultUri=xs.namespace,
+        prefixesInScope=list(xs.prefixes.values()),
+    ).encode("utf-8")
+
+
 def htmlentities(text):
     """Escape chars in the text for HTML presentation
 
@@ -816,11 +1091,21 @@ def add_entry_to_rss(entry, rss):
 
     Args:
       entry(iembot.basicbot.CHAT_LOG_ENTRY): entry
+      rss(feedgen.feed.FeedGenerator): feed to append the entry to
+    """
+    fill_rss_entry(entry, rss.add_entry(order="append"))
 
-    Returns:
-      PyRSSGen.RSSItem
+
+def fill_rss_entry(entry, fe):
+    """Populate a feed entry from a room log entry
+
+    Args:
+      entry(iembot.basicbot.CHAT_LOG_ENTRY): entry
+      fe(feedgen.entry.FeedEntry): feed entry to populate
     """
-    ts = datetime.datetime.strptime(entry.timestamp, "%Y%m%d%H%M%S")
+    ts = datetime.datetime.fromtimestamp(
+        entry.timestamp, datetime.timezone.utc
+    )
     txt = entry.txtlog
     m = re.search(r"https?://", txt)
     urlpos = -1
@@ -831,7 +1116,6 @@ def add_entry_to_rss(entry, rss):
     ltxt = txt[urlpos:].replace("&amp;", "&").strip()
     if ltxt == "":
         ltxt = "https://mesonet.agron.iastate.edu/projects/iembot/"
-    fe = rss.add_entry(order="append")
     fe.title(txt[:urlpos].strip())
     fe.link(link=dict(href=ltxt))
     txt = remove_control_characters(entry.product_text)
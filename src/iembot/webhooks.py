@@ -1,12 +1,299 @@
 """Send content to various webhooks."""
+import hashlib
 import json
 from io import BytesIO
+from urllib.parse import urlparse
 
-from twisted.internet import reactor
+from twisted.internet import defer, error, reactor
 from twisted.python import log
-from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    RequestNotSent,
+    readBody,
+)
 from twisted.web.http_headers import Headers
 
+# Failures where the POST never reached the server, so a retry can not
+# deliver it twice.  A timed out response may well have been accepted.
+NOT_DELIVERED = (
+    error.ConnectError,
+    error.ConnectingCancelledError,
+    error.DNSLookupError,
+    RequestNotSent,
+)
+
+
+class WebhookError(Exception):
+    """A webhook answered with an HTTP error status."""
+
+    def __init__(self, code, body):
+        """Constructor"""
+        Exception.__init__(self, f"HTTP {code}: {body[:200]!r}")
+        self.code = code
+
+    @property
+    def retryable(self):
+        """Only server errors and rate limiting are worth another try."""
+        return self.code >= 500 or self.code == 429
+
+
+def _label(url):
+    """How a webhook is identified on the status page.
+
+    Webhook URLs usually embed their secret, so only the host and a digest
+    of the full URL are shown.
+    """
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+    return f"{urlparse(url).netloc}#{digest}"
+
+
+class WebhookClient:
+    """Persistent, per-host limited HTTP client with retries."""
+
+    def __init__(
+        self,
+        clock=reactor,
+        agent=None,
+        max_per_host=4,
+        connect_timeout=10,
+        timeout=30,
+        retries=3,
+        backoff=2.0,
+    ):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): used for timeouts and retry scheduling
+          agent (IAgent): overrides the pooled Agent, for testing
+          max_per_host (int): concurrent requests allowed to a single host
+          connect_timeout (float): seconds to establish a connection
+          timeout (float): seconds for a request to complete
+          retries (int): extra attempts made after a connection failure or
+            a 429/5xx response
+          backoff (float): seconds before the first retry, doubling after
+        """
+        self.clock = clock
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = HTTPConnectionPool(clock, persistent=True)
+        self.pool.maxPersistentPerHost = max_per_host
+        self._agent = agent
+        self.agent = agent or self._build_agent()
+        # host => DeferredSemaphore
+        self._semaphores = {}
+        # label => counters
+        self.stats = {}
+
+    def _build_agent(self):
+        """Create the pooled Agent."""
+        return Agent(
+            self.clock, connectTimeout=self.connect_timeout, pool=self.pool
+        )
+
+    def configure(self, config):
+        """Apply settings from the bot's properties table."""
+        self.max_per_host = int(
+            config.get("bot.webhook_max_per_host", self.max_per_host)
+        )
+        self.connect_timeout = float(
+            config.get("bot.webhook_connect_timeout", self.connect_timeout)
+        )
+        self.timeout = float(config.get("bot.webhook_timeout", self.timeout))
+        self.retries = int(config.get("bot.webhook_retries", self.retries))
+        self.backoff = float(config.get("bot.webhook_backoff", self.backoff))
+        self.pool.maxPersistentPerHost = self.max_per_host
+        if self._agent is None:
+            self.agent = self._build_agent()
+        # Hosts pick up the new limit on their next request
+        self._semaphores = {}
+
+    def close(self):
+        """Drop the cached connections."""
+        return self.pool.closeCachedConnections()
+
+    def _semaphore(self, url):
+        """The concurrency limit for the url's host."""
+        host = urlparse(url).netloc
+        sem = self._semaphores.get(host)
+        if sem is None:
+            sem = self._semaphores[host] = defer.DeferredSemaphore(
+                self.max_per_host
+            )
+        return sem
+
+    def _stats(self, url):
+        """Counters for the url."""
+        label = _label(url)
+        stats = self.stats.get(label)
+        if stats is None:
+            stats = self.stats[label] = {
+                "success": 0,
+                "failure": 0,
+                "retries": 0,
+                "latency_ms": 0.0,
+            }
+        return stats
+
+    def post(self, url, postdata):
+        """POST JSON to the url, retrying with exponential backoff.
+
+        Args:
+          url (str): the webhook
+          postdata (bytes): the JSON document
+
+        Returns:
+          Deferred: fires with the response body, or the last failure
+        """
+        result = defer.Deferred()
+        self._attempt(url, postdata, 0, result)
+        return result
+
+    def _attempt(self, url, postdata, attempt, result):
+        """Make one request once the host has capacity."""
+        stats = self._stats(url)
+
+        def _ok(res):
+            body, latency = res
+            # Running mean of successful request latency
+            stats["success"] += 1
+            stats["latency_ms"] += (
+                latency * 1000.0 - stats["latency_ms"]
+            ) / stats["success"]
+            result.callback(body)
+
+        def _fail(failure):
+            if failure.check(WebhookError):
+                retryable = failure.value.retryable
+            else:
+                retryable = failure.check(*NOT_DELIVERED) is not None
+            if retryable and attempt < self.retries:
+                stats["retries"] += 1
+                self.clock.callLater(
+                    self.backoff * 2**attempt,
+                    self._attempt,
+                    url,
+                    postdata,
+                    attempt + 1,
+                    result,
+                )
+                return
+            stats["failure"] += 1
+            result.errback(failure)
+
+        d = self._semaphore(url).run(self._request, url, postdata)
+        d.addCallbacks(_ok, _fail)
+
+    def _request(self, url, postdata):
+        """Make the request, the deferred is cancelled on timeout."""
+        sts = self.clock.seconds()
+        d = self.agent.request(
+            method=b"POST",
+            uri=url.encode("ascii"),
+            headers=Headers({"Content-type": ["application/json"]}),
+            bodyProducer=FileBodyProducer(BytesIO(postdata)),
+        )
+        d.addCallback(self._read_response)
+        d.addCallback(lambda body: (body, self.clock.seconds() - sts))
+        d.addTimeout(self.timeout, self.clock)
+        return d
+
+    def _read_response(self, response):
+        """Read the body, failing on an HTTP error status."""
+
+        def _check(body):
+            if response.code >= 400:
+                raise WebhookError(response.code, body)
+            return body
+
+        return readBody(response).addCallback(_check)
+
+
+class WebhookBatcher:
+    """Coalesce bursts of messages bound for the same webhook.
+
+    The first message for a hook opens a window, and everything gathered
+    is sent as one post when the window closes or the batch is full.  A
+    hook has at most one batch in flight so its messages stay in order.
+    """
+
+    def __init__(self, client, clock=reactor):
+        """Constructor
+
+        Args:
+          client (WebhookClient): sends the batches
+          clock (IReactorTime): used to schedule the windows
+        """
+        self.client = client
+        self.clock = clock
+        # url => list of pending texts
+        self._pending = {}
+        # url => messages that fill a batch
+        self._maxsize = {}
+        # url => IDelayedCall closing the window
+        self._timers = {}
+        self._inflight = set()
+        self.batches = 0
+        self.messages = 0
+
+    def add(self, url, text, window, maxsize):
+        """Queue a message for the hook.
+
+        Args:
+          url (str): the webhook
+          text (str): the message
+          window (float): seconds to wait for more messages
+          maxsize (int): messages that fill a batch
+        """
+        pending = self._pending.setdefault(url, [])
+        pending.append(text)
+        self._maxsize[url] = maxsize
+        self.messages += 1
+        if len(pending) >= maxsize:
+            self._close_window(url)
+        elif url not in self._timers and url not in self._inflight:
+            self._timers[url] = self.clock.callLater(
+                window, self._close_window, url
+            )
+
+    def _close_window(self, url):
+        """Send now, unless the previous batch is still in flight."""
+        timer = self._timers.pop(url, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        if url not in self._inflight:
+            self.flush(url)
+
+    def flush(self, url):
+        """Post the pending messages for the hook."""
+        pending = self._pending.get(url)
+        if not pending:
+            return
+        # Anything beyond a full batch waits for this one to be sent
+        maxsize = self._maxsize[url]
+        texts = pending[:maxsize]
+        if len(pending) > maxsize:
+            self._pending[url] = pending[maxsize:]
+        else:
+            self._pending.pop(url)
+        self.batches += 1
+        self._inflight.add(url)
+        postdata = json.dumps({"text": "\n\n".join(texts)})
+        df = self.client.post(url, postdata.encode("utf-8", "ignore"))
+        df.addCallback(_cbBody)
+        df.addErrback(_eb, url)
+        df.addBoth(self._sent, url)
+
+    def _sent(self, _res, url):
+        """Send what gathered while the last batch was in flight."""
+        self._inflight.discard(url)
+        if url not in self._timers:
+            self.flush(url)
+
 
 def route(bot, channels, elem):
     """Route messages found in provided elem.
@@ -16,39 +303,26 @@ def route(bot, channels, elem):
       channels (list): channels for this message.
       elem: xish element.
     """
-    # {'DMX': [url, url, ...]}
-    subs = [
-        bot.webhooks_routingtable[channel]
-        for channel in channels
-        if channel in bot.webhooks_routingtable
-    ]
-    if not subs:
+    # de-duplicated urls for these channels, see iembot.routing
+    hooks = bot.fanout.plan(channels).webhooks
+    if not hooks:
         return
-    data = {"text": str(elem.body)}
-    postdata = json.dumps(data).encode("utf-8", "ignore")
-    for hooks in subs:
-        for hook in hooks:
-            log.msg(hook)
-            bp = FileBodyProducer(BytesIO(postdata))
-            defer = Agent(reactor).request(
-                method=b"POST",
-                uri=hook.encode("ascii"),
-                headers=Headers({"Content-type": ["application/json"]}),
-                bodyProducer=bp,
-            )
-            defer.addCallback(_cb)
-            defer.addErrback(_eb)
+    text = str(elem.body)
+    postdata = json.dumps({"text": text}).encode("utf-8", "ignore")
+    for hook in hooks:
+        log.msg(hook)
+        batching = bot.webhooks_batching.get(hook)
+        if batching is not None:
+            bot.webhook_batcher.add(hook, text, *batching)
+            continue
+        df = bot.webhook_client.post(hook, postdata)
+        df.addCallback(_cbBody)
+        df.addErrback(_eb, hook)
 
 
-def _eb(*args):
+def _eb(failure, hook):
     """errback."""
-    log.msg(str(args))
-
-
-def _cb(*args):
-    d = readBody(args[0])
-    d.addCallback(_cbBody)
-    return d
+    log.msg(f"webhook {_label(hook)} failed: {failure.getErrorMessage()}")
 
 
 def _cbBody(body):
@@ -1,34 +1,138 @@
 """Our web services"""
 import datetime
+import gzip
 import json
+import math
 import re
+import time
 
+from feedgen.entry import FeedEntry
 from feedgen.feed import FeedGenerator
+from lxml import etree
 from pyiem.util import utc
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.web import resource
+from twisted.web import http, resource, server
 
 # Local
 import iembot.util as botutil
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 XML_CACHE = {}
+# Precompressed XML_CACHE variants by room and then content-coding
+XML_CACHE_ENCODED = {}
 XML_CACHE_EXPIRES = {}
+# Rendered RSS <item> elements by room and then seqnum
+RSS_ITEM_CACHE = {}
+# content-codings we can serve, in order of preference
+ENCODINGS = ["gzip"] if brotli is None else ["br", "gzip"]
+# Defaults for the long-poll and streaming room services, these can be
+# overridden by bot.json_* properties
+LONGPOLL_TIMEOUT = 30
+STREAM_TIMEOUT = 300
+MAX_WATCHERS = 5000
+
+
+def not_modified(request, etag, lastmod):
+    """Set the cache validators and check a conditional request.
+
+    If-None-Match takes precedence over If-Modified-Since.  Last-Modified
+    only has one second resolution, so If-Modified-Since is not trusted for
+    a lastmod within the past second, as more could be logged within it.
+
+    Args:
+      request (twisted.web.server.Request): the request
+      etag (str): strong entity tag, including the quotes
+      lastmod (int): epoch seconds of the last change
+
+    Returns:
+      bool: if the client's copy is current and a 304 was set
+    """
+    request.setHeader("ETag", etag)
+    request.setHeader("Last-Modified", http.datetimeToString(lastmod))
+    inm = request.getHeader(b"if-none-match")
+    if inm is not None:
+        tags = [
+            tag.strip() for tag in inm.decode("ascii", "ignore").split(",")
+        ]
+        current = "*" in tags or etag in tags or f"W/{etag}" in tags
+    else:
+        ims = request.getHeader(b"if-modified-since")
+        current = False
+        if ims and lastmod < time.time() - 1:
+            try:
+                current = http.stringToDatetime(ims.split(b";")[0]) >= lastmod
+            except ValueError:
+                current = False
+    if current:
+        request.setResponseCode(http.NOT_MODIFIED)
+    return current
+
+
+def negotiate_encoding(request, available):
+    """Pick the content-coding to use for the response.
+
+    Args:
+      request (twisted.web.server.Request): the request
+      available (list): codings we have, in order of our preference
+
+    Returns:
+      str or None: the coding to use, None for identity
+    """
+    header = request.getHeader(b"accept-encoding")
+    if not header:
+        return None
+    accepted = {}
+    for token in header.decode("ascii", "ignore").lower().split(","):
+        name, _, params = token.strip().partition(";")
+        qvalue = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                qvalue = float(params[2:])
+            except ValueError:
+                qvalue = 0
+        accepted[name.strip()] = qvalue
+    for encoding in available:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def rss_item_xml(entry):
+    """Render the RSS <item> for a room log entry.
+
+    Returns:
+      bytes: the same serialization as FeedGenerator.rss_str() uses
+    """
+    fe = FeedEntry()
+    botutil.fill_rss_entry(entry, fe)
+    return etree.tostring(fe.rss_entry())
+
+
+def room_key(rm):
+    """Map the legacy 3 and 4 character WFO feed names to the room."""
+    if len(rm) == 4 and rm[0] == "k":
+        return f"{rm[-3:]}chat"
+    if len(rm) == 3:
+        return f"k{rm}chat"
+    return rm
 
 
 def wfo_rss(iembot, rm):
     """build a RSS for the given room"""
-    if len(rm) == 4 and rm[0] == "k":
-        rm = f"{rm[-3:]}chat"
-    elif len(rm) == 3:
-        rm = f"k{rm}chat"
+    rm = room_key(rm)
     if rm not in XML_CACHE:
         XML_CACHE[rm] = ""
         XML_CACHE_EXPIRES[rm] = -2
     if rm not in iembot.chatlog:
         return ""
     # should not be empty given the caller
-    lastID = iembot.chatlog[rm][0].seqnum
+    lastID = iembot.chatlog[rm].newest().seqnum
     if lastID == XML_CACHE_EXPIRES[rm]:
         return XML_CACHE[rm]
 
@@ -37,14 +141,26 @@ def wfo_rss(iembot, rm):
     rss.title(f"{rm} IEMBot RSS Feed")
     rss.link(href=f"https://weather.im/iembot-rss/room/{rm}.xml", rel="self")
     rss.description(f"{rm} IEMBot RSS Feed")
-    rss.lastBuildDate(f"{utc():%a, %d %b %Y %H:%M:%S} GMT")
-
-    for entry in iembot.chatlog[rm]:
-        botutil.add_entry_to_rss(entry, rss)
-
-    XML_CACHE[rm] = rss.rss_str()
+    # The newest entry's time so the document only changes with the seqnum
+    lastts = time.gmtime(iembot.chatlog[rm].newest().timestamp)
+    rss.lastBuildDate(time.strftime("%a, %d %b %Y %H:%M:%S GMT", lastts))
+    # Only entries new since the last build get rendered
+    cached = RSS_ITEM_CACHE.get(rm, {})
+    items = {}
+    for entry in reversed(iembot.chatlog[rm]):
+        item = cached.get(entry.seqnum)
+        items[entry.seqnum] = rss_item_xml(entry) if item is None else item
+    RSS_ITEM_CACHE[rm] = items
+    head, tail = rss.rss_str().rsplit(b"</channel>", 1)
+    xml = b"".join([head, *items.values(), b"</channel>", tail])
+    XML_CACHE[rm] = xml
+    # Compress once per change, mtime=0 keeps the bytes reproducible
+    encoded = {"gzip": gzip.compress(xml, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(xml)
+    XML_CACHE_ENCODED[rm] = encoded
     XML_CACHE_EXPIRES[rm] = lastID
-    return rss.rss_str()
+    return xml
 
 
 class RSSService(resource.Resource):
@@ -72,12 +188,8 @@ class RSSService(resource.Resource):
         if not tokens:
             return b"ERROR!"
 
-        rm = tokens[0]
-        if uri.startswith("/wfo/"):
-            if len(rm) == 4 and rm[0] == "k":
-                rm = f"{rm[-3:]}chat"
-            elif len(rm) == 3:
-                rm = f"k{rm}chat"
+        # The validators and caches all need the same key as wfo_rss
+        rm = room_key(tokens[0])
         if not self.iembot.chatlog.get(rm, []):
             rss = FeedGenerator()
             rss.generator("iembot")
@@ -101,7 +213,19 @@ class RSSService(resource.Resource):
             )
             xml = rss.rss_str()
         else:
+            newest = self.iembot.chatlog[rm].newest()
+            encoding = negotiate_encoding(request, ENCODINGS)
+            request.setHeader("Vary", "Accept-Encoding")
+            # Each representation needs its own strong entity tag
+            etag = f"{rm}-{newest.seqnum}"
+            if encoding is not None:
+                etag = f"{etag}-{encoding}"
+            if not_modified(request, f'"{etag}"', newest.timestamp):
+                return b""
             xml = wfo_rss(self.iembot, rm)
+            if encoding is not None:
+                xml = XML_CACHE_ENCODED[rm][encoding]
+                request.setHeader("Content-Encoding", encoding)
         request.setHeader("Content-Length", f"{len(xml)}")
         request.setHeader("Content-Type", "text/xml")
         request.setResponseCode(200)
@@ -136,10 +260,13 @@ class RoomChannel(resource.Resource):
 
     def wrap(self, request, j):
         """Support specification of a JSONP callback"""
+        if isinstance(j, str):
+            j = j.encode("utf-8")
         if "callback" in request.args:
             request.setHeader("Content-type", "application/javascript")
-            return (f"{request.args['callback'][0]}({j});").encode("utf-8")
-        return j.encode("utf-8")
+            callback = f"{request.args['callback'][0]}"
+            return callback.encode("utf-8") + b"(" + j + b");"
+        return j
 
     def render(self, request):
         """Process the request that we got, it should look something like:
@@ -158,25 +285,147 @@ class RoomChannel(resource.Resource):
             return self.wrap(request, json.dumps("ERROR"))
         seqnum = int(seqnum[0])
 
-        r = dict(messages=[])
         if room not in self.iembot.chatlog:
             log.msg(f"No CHATLOG |{room}|")
             return self.wrap(request, json.dumps("ERROR"))
-        for entry in self.iembot.chatlog[room][::-1]:
-            if entry.seqnum <= seqnum:
-                continue
-            ts = datetime.datetime.strptime(entry.timestamp, "%Y%m%d%H%M%S")
-            r["messages"].append(
-                {
-                    "seqnum": entry.seqnum,
-                    "ts": ts.strftime("%Y-%m-%d %H:%M:%S"),
-                    "author": entry.author,
-                    "product_id": entry.product_id,
-                    "message": entry.log,
-                }
+        # Long-poll clients provide how many seconds they are willing to wait
+        wait = request.args.get(b"wait")
+        if wait is not None:
+            try:
+                wait = float(wait[0]) if len(wait) == 1 else math.nan
+            except ValueError:
+                wait = math.nan
+            if math.isnan(wait):
+                log.msg(f"Bad URI: {request.uri} wait problem")
+                return self.wrap(request, json.dumps("ERROR"))
+            timeout = float(
+                self.iembot.config.get(
+                    "bot.json_longpoll_timeout", LONGPOLL_TIMEOUT
+                )
             )
+            wait = min(max(wait, 0), timeout)
+        if wait and self.iembot.chatlog[room].newest().seqnum <= seqnum:
+            if self.park(request, room, seqnum, wait):
+                return server.NOT_DONE_YET
+        newest = self.iembot.chatlog[room].newest()
+        if not_modified(
+            request, f'"{room}-{newest.seqnum}"', newest.timestamp
+        ):
+            return b""
+        return self.respond(request, room, seqnum)
+
+    def respond(self, request, room, seqnum):
+        """Build the response with the room's messages since seqnum."""
+        # Same as json.dumps({"messages": [...]}) using cached renderings
+        frags = self.iembot.chatlog[room].json_since(seqnum)
+        return self.wrap(
+            request, b'{"messages": [' + b", ".join(frags) + b"]}"
+        )
+
+    def park(self, request, room, seqnum, wait):
+        """Hold the request until the room gets a message or we time out.
+
+        Returns:
+          bool: if the request was parked, False when at the watcher limit
+        """
+        watchers = self.iembot.chatlog_watchers
+        timer = []
+
+        def _complete(_entry=None):
+            """Answer the request."""
+            watchers.remove(room, _complete)
+            if timer[0].active():
+                timer[0].cancel()
+            request.write(self.respond(request, room, seqnum))
+            request.finish()
+
+        def _gone(_err):
+            """The client went away."""
+            watchers.remove(room, _complete)
+            if timer[0].active():
+                timer[0].cancel()
+
+        limit = int(
+            self.iembot.config.get("bot.json_max_watchers", MAX_WATCHERS)
+        )
+        if not watchers.add(room, _complete, limit):
+            return False
+        timer.append(reactor.callLater(wait, _complete))
+        request.notifyFinish().addErrback(_gone)
+        return True
+
+
+class RoomStream(resource.Resource):
+    """Server-Sent Events stream of a room's messages
+
+    /stream/dmxchat?seqnum=1, with browsers resuming by Last-Event-ID
+    """
+
+    def isLeaf(self):
+        """allow uri calling"""
+        return True
 
-        return self.wrap(request, json.dumps(r))
+    def __init__(self, iembot):
+        """Constructor"""
+        resource.Resource.__init__(self)
+        self.iembot = iembot
+
+    def render(self, request):
+        """Start the stream."""
+        uri = request.uri.decode("utf-8")
+        tokens = re.findall("/stream/([a-z_0-9]+)", uri.lower())
+        if not tokens:
+            log.msg(f"Bad URI: {uri} len(tokens) is 0")
+            request.setResponseCode(404)
+            return b""
+        room = tokens[0]
+        seqnum = request.getHeader("last-event-id")
+        if seqnum is None:
+            seqnum = request.args.get(b"seqnum", [b"0"])[0]
+        try:
+            last = [int(seqnum)]
+        except ValueError:
+            request.setResponseCode(400)
+            return b""
+        watchers = self.iembot.chatlog_watchers
+        config = self.iembot.config
+
+        def _push(_entry=None):
+            """Send what is new."""
+            roomlog = self.iembot.chatlog.get(room)
+            if roomlog is None:
+                return
+            for entry, frag in zip(
+                roomlog.since(last[0]), roomlog.json_since(last[0])
+            ):
+                request.write(f"id: {entry.seqnum}\ndata: ".encode("utf-8"))
+                request.write(frag + b"\n\n")
+                last[0] = entry.seqnum
+
+        def _close():
+            """Stream has been open long enough, the client reconnects."""
+            watchers.remove(room, _push)
+            request.finish()
+
+        def _gone(_err):
+            """The client went away."""
+            watchers.remove(room, _push)
+            if timer.active():
+                timer.cancel()
+
+        limit = int(config.get("bot.json_max_watchers", MAX_WATCHERS))
+        if not watchers.add(room, _push, limit):
+            request.setResponseCode(503)
+            return b""
+        request.setHeader("Content-Type", "text/event-stream")
+        request.setHeader("Cache-Control", "no-cache")
+        _push()
+        timer = reactor.callLater(
+            float(config.get("bot.json_stream_timeout", STREAM_TIMEOUT)),
+            _close,
+        )
+        request.notifyFinish().addErrback(_gone)
+        return server.NOT_DONE_YET
 
 
 class ReloadChannel(resource.Resource):
@@ -192,6 +441,25 @@ class ReloadChannel(resource.Resource):
         self.iembot = iembot
 
     def render(self, request):
+        """Answer the call."""
+        # A reload may be scoped to rooms, channels or accounts
+        calls = []
+        for arg, func, conv in [
+            (b"room", self.iembot.reload_room, str),
+            (b"channel", self.iembot.reload_channel, str),
+            (b"twitter", self.iembot.reload_twitter_user, int),
+            (b"mastodon", self.iembot.reload_mastodon_user, int),
+        ]:
+            for value in request.args.get(arg, []):
+                try:
+                    calls.append((func, conv(value.decode("utf-8"))))
+                except ValueError:
+                    request.setResponseCode(400)
+                    return json.dumps(f"Invalid {arg.decode()}").encode()
+        if calls:
+            for func, value in calls:
+                func(value)
+            return json.dumps("OK").encode("utf-8")
         log.msg("Reloading iembot room configuration....")
         self.iembot.load_chatrooms(False)
         self.iembot.load_twitter()
@@ -215,7 +483,30 @@ class StatusChannel(resource.Resource):
             "threadpool.max": tp.max,
             "threadpool.waiters": len(tp.waiters),
             "threadpool.working": len(tp.working),
+            "xmllog.queued": len(self.iembot.xmllog.buffer),
+            "xmllog.dropped": self.iembot.xmllog.dropped,
+            "xmllog.written": self.iembot.xmllog.written,
+            "json.watchers": self.iembot.chatlog_watchers.count,
+            "chatlog.shared_strings": len(self.iembot.chatlog_strings),
         }
+        res["posting.queued"] = self.iembot.posting.queued
+        res["posting.inflight"] = self.iembot.posting.inflight
+        res["posting.backoff"] = self.iembot.posting.backoff
+        res["posting.retries"] = self.iembot.posting.retries
+        res["posting.shed"] = self.iembot.posting.shed
+        res["posting.expired"] = self.iembot.posting.expired
+        res.update(self.iembot.tw_limits.status())
+        res.update(self.iembot.joins.status())
+        res.update(self.iembot.pending_sends.status())
+        res.update(self.iembot.outbound.status())
+        if self.iembot.listener is not None:
+            res["listener.connects"] = self.iembot.listener.connects
+            res["listener.received"] = self.iembot.listener.received
+        res["webhook.batches"] = self.iembot.webhook_batcher.batches
+        res["webhook.batched_messages"] = self.iembot.webhook_batcher.messages
+        for label, stats in self.iembot.webhook_client.stats.items():
+            for key, val in stats.items():
+                res[f"webhook.{label}.{key}"] = val
         return json.dumps(res).encode("utf-8")
 
 
@@ -226,5 +517,6 @@ class JSONRootResource(resource.Resource):
         """Constructor"""
         resource.Resource.__init__(self)
         self.putChild(b"room", RoomChannel(iembot))
+        self.putChild(b"stream", RoomStream(iembot))
         self.putChild(b"reload", ReloadChannel(iembot))
         self.putChild(b"status", StatusChannel(iembot))
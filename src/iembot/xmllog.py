@@ -0,0 +1,179 @@
+"""Buffered XMPP wire logging.
+
+The raw data callbacks fire on the reactor thread for every chunk sent and
+received, so they only append to a bounded in-memory ring buffer.  A
+background thread formats and writes the buffer to a daily rotated log file
+in large batches, optionally compressing the files it rotates out.
+"""
+import gzip
+import os
+import random
+import shutil
+import threading
+import time
+from collections import deque
+
+from twisted.python import log
+from twisted.python.logfile import DailyLogFile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def compress_file(path, compression):
+    """Compress ``path`` in place, returning the new filename.
+
+    Args:
+      path (str): file to compress, it is removed on success
+      compression (str): either gzip or zstd
+
+    Returns:
+      str: the compressed filename, or ``path`` when nothing was done
+    """
+    if compression not in COMPRESSION_SUFFIXES:
+        return path
+    newpath = f"{path}{COMPRESSION_SUFFIXES[compression]}"
+    with open(path, "rb") as fhin, open(newpath, "wb") as fhout:
+        if compression == "gzip":
+            with gzip.GzipFile(fileobj=fhout, mode="wb") as gz:
+                shutil.copyfileobj(fhin, gz)
+        else:
+            zstandard.ZstdCompressor().copy_stream(fhin, fhout)
+    os.remove(path)
+    return newpath
+
+
+class CompressingDailyLogFile(DailyLogFile):
+    """A DailyLogFile that optionally compresses the rotated file."""
+
+    compression = None
+
+    def rotate(self):
+        """Rotate, then compress what was rotated out."""
+        newpath = f"{self.path}.{self.suffix(self.lastDate)}"
+        existed = os.path.exists(newpath)
+        DailyLogFile.rotate(self)
+        if existed or not os.path.exists(newpath):
+            return
+        try:
+            compress_file(newpath, self.compression)
+        except Exception as exp:
+            log.err(exp)
+
+
+class XMLLogWriter:
+    """Ring buffer of wire traffic flushed by a writer thread."""
+
+    def __init__(self, name, directory, maxlen=100_000, flush_interval=1.0):
+        """Constructor
+
+        Args:
+          name (str): log file basename
+          directory (str): where the log files live
+          maxlen (int): number of chunks to buffer before dropping the oldest
+          flush_interval (float): seconds between writer thread flushes
+        """
+        self.logfile = CompressingDailyLogFile(name, directory)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=maxlen)
+        # direction => fraction of chunks to log, 0 disables
+        self.sample = {"RECV": 1.0, "SEND": 1.0}
+        self.dropped = 0
+        self.written = 0
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._flushlock = threading.Lock()
+
+    def configure(self, config):
+        """Apply settings from the bot's properties table."""
+        self.sample["RECV"] = float(config.get("bot.xmllog_sample_recv", 1))
+        self.sample["SEND"] = float(config.get("bot.xmllog_sample_send", 1))
+        compression = config.get("bot.xmllog_compression") or None
+        if compression == "zstd" and zstandard is None:
+            log.msg("zstandard is not installed, using gzip for xmllog")
+            compression = "gzip"
+        self.logfile.compression = compression
+        maxlen = int(config.get("bot.xmllog_buffer", self.buffer.maxlen))
+        if maxlen != self.buffer.maxlen:
+            self.buffer = deque(self.buffer, maxlen=maxlen)
+
+    def write(self, direction, data):
+        """Queue a chunk of wire data, called from the reactor thread.
+
+        Args:
+          direction (str): RECV or SEND
+          data (bytes): what went over the wire
+        """
+        rate = self.sample.get(direction, 1.0)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return
+        buf = self.buffer
+        if len(buf) == buf.maxlen:
+            # the deque drops the oldest entry for us
+            self.dropped += 1
+        buf.append((time.time(), direction, data))
+        if self._thread is None:
+            self.start()
+        elif len(buf) > buf.maxlen // 2:
+            # do not wait out the flush interval when filling up
+            self._wakeup.set()
+
+    def start(self):
+        """Start the writer thread."""
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="xmllog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the writer thread after a final flush."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        """Writer thread main loop."""
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as exp:
+                log.err(exp)
+
+    def flush(self):
+        """Write out everything that is buffered."""
+        with self._flushlock:
+            buf = self.buffer
+            lines = []
+            lastts = None
+            stamp = ""
+            while buf:
+                try:
+                    ts, direction, data = buf.popleft()
+                except IndexError:
+                    break
+                sec = int(ts)
+                if sec != lastts:
+                    stamp = time.strftime(
+                        "%Y-%m-%d %H:%M:%S", time.gmtime(sec)
+                    )
+                    lastts = sec
+                lines.append(
+                    f"{stamp} {direction} {data.decode('utf-8', 'ignore')}\n"
+                )
+            if not lines:
+                return
+            self.logfile.write("".join(lines))
+            self.logfile.flush()
+            self.written += len(lines)
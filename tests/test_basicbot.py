@@ -12,3 +12,27 @@ def test_authd_api():
     xs = Mock()
     bot.connected(xs)
     bot.authd()
+
+
+def test_broadcast_groupchat_elem(xmlstream):
+    """Broadcast writes the same bytes as XmlStream.send per room."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.conference = "conference.localhost"
+    bot.rooms = {
+        "dmxchat": {"joined": True, "occupants": {}},
+        "botstalk": {"joined": True, "occupants": {}},
+    }
+    bot.xmlstream = xmlstream
+    elem = bot.send_groupchat("dmxchat", "Hello & <World>", "<p>Hi</p>")
+    bot.outbound.flush()
+    xmlstream.transport.clear()
+    for room in bot.rooms:
+        elem["to"] = f"{room}@{bot.conference}"
+        xmlstream.send(elem)
+    legacy = xmlstream.transport.value()
+    assert legacy.startswith(b"<message to='dmxchat@conference.localhost'")
+    xmlstream.transport.clear()
+    bot.broadcast_groupchat_elem(elem, list(bot.rooms))
+    bot.outbound.flush()
+    assert xmlstream.transport.value() == legacy
+    assert elem["to"] == f"botstalk@{bot.conference}"
@@ -0,0 +1,130 @@
+"""Test chatlog persistence."""
+
+import json
+import os
+import pickle
+import tempfile
+
+import iembot.util as botutil
+from iembot.basicbot import ROOM_LOG_ENTRY, basicbot
+from iembot.chatlog import (
+    ChatlogJournal,
+    RoomLog,
+    SharedStrings,
+    make_entry,
+)
+
+
+def _entry(seqnum):
+    """Make an entry."""
+    return ROOM_LOG_ENTRY(
+        seqnum=seqnum,
+        timestamp=1696334400,
+        log="<p>Hi</p>",
+        author="iembot",
+        product_id="",
+        product_text="Hi",
+        txtlog="Hi",
+    )
+
+
+def test_journal_compact_and_replay():
+    """Compaction writes the snapshot plus entries appended since."""
+    path = os.path.join(tempfile.mkdtemp(), "journal")
+    journal = ChatlogJournal(path)
+    for seqnum in range(1, 11):
+        journal.append("dmxchat" if seqnum % 2 else "botstalk", _entry(seqnum))
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.chatlog_journal = journal
+    botutil.load_chatlog(bot)
+    assert journal.rotate()
+    journal.append("dmxchat", _entry(11))
+    journal.compact({"dmxchat": list(bot.chatlog["dmxchat"])[-2:]})
+    assert not os.path.isfile(journal.oldpath)
+    seqnums = [fields[0] for room, fields in journal.replay()]
+    assert seqnums == [7, 9, 11]
+    journal.close()
+
+    botutil.load_chatlog(bot)
+    assert bot.seqnum == 11
+    assert bot.chatlog["dmxchat"].newest() == _entry(11)
+    # Replaying again did not duplicate entries
+    assert [e.seqnum for e in bot.chatlog["dmxchat"]] == [1, 3, 5, 7, 9, 11]
+
+
+def test_journal_writer_thread():
+    """Appends are queued and written by the writer thread."""
+    path = os.path.join(tempfile.mkdtemp(), "journal")
+    journal = ChatlogJournal(path, flush_interval=60)
+    journal.append("dmxchat", _entry(1))
+    assert not os.path.isfile(path)
+    # left aside by a compaction of an older version
+    with open(journal.oldpath, "w", encoding="utf-8") as fh:
+        fh.write(json.dumps(["botstalk", *_entry(0)]) + "\n")
+    assert journal.rotate()
+    journal.append("dmxchat", _entry(2))
+    journal.compact({"dmxchat": [_entry(1)]})
+    assert not os.path.isfile(journal.oldpath)
+    assert [fields[0] for _room, fields in journal.replay()] == [1, 2]
+    journal.close()
+    assert journal._thread is None
+
+
+def test_import_pickle():
+    """The legacy pickle is imported when there is no journal."""
+    tmpdir = tempfile.mkdtemp()
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.PICKLEFILE = os.path.join(tmpdir, "chatlog.pickle")
+    with open(bot.PICKLEFILE, "wb") as fh:
+        pickle.dump({"dmxchat": [_entry(2), _entry(1)]}, fh)
+    bot.chatlog_journal = ChatlogJournal(os.path.join(tmpdir, "journal"))
+    botutil.load_chatlog(bot)
+    assert bot.seqnum == 2
+    assert [e.seqnum for e in bot.chatlog["dmxchat"]] == [1, 2]
+    assert bot.chatlog_journal.exists()
+
+
+def test_roomlog():
+    """Test the ring buffer."""
+    roomlog = RoomLog(capacity=3)
+    assert roomlog.newest() is None
+    for seqnum in [2, 4, 6, 8]:
+        roomlog.append(_entry(seqnum))
+    assert len(roomlog) == 3
+    assert [e.seqnum for e in roomlog] == [4, 6, 8]
+    assert [e.seqnum for e in reversed(roomlog)] == [8, 6, 4]
+    assert roomlog.get(6).seqnum == 6
+    assert roomlog.get(5) is None
+    assert roomlog.get(2) is None
+    assert [e.seqnum for e in roomlog.since(5)] == [6, 8]
+    assert roomlog.since(8) == []
+    assert len(roomlog.since(0)) == 3
+
+
+def test_make_entry():
+    """Legacy string timestamps become epoch seconds."""
+    entry = make_entry(_entry(1)._replace(timestamp="20231003120000"))
+    assert entry.timestamp == 1696334400
+
+
+def test_shared_strings():
+    """Equal strings are held once, until the last entry using them goes."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    text = "".join(["SVR"] * 100)
+    for seqnum, room in enumerate(["dmxchat", "botstalk"], start=1):
+        entry = _entry(seqnum)._replace(product_text="".join(["SVR"] * 100))
+        bot.append_chatlog(room, entry, journal=False)
+    first = bot.chatlog["dmxchat"].newest().product_text
+    assert first == text
+    assert bot.chatlog["botstalk"].newest().product_text is first
+    assert len(bot.chatlog_strings) == 3
+    strings = SharedStrings()
+    entry = strings.share(_entry(1))
+    # product_text and txtlog are both Hi
+    assert len(strings) == 2
+    strings.release(entry)
+    assert len(strings) == 0
+    # the ring buffer hands back what it drops
+    roomlog = RoomLog(capacity=1)
+    assert roomlog.append(_entry(1)) is None
+    assert roomlog.append(_entry(2)) == _entry(1)
@@ -0,0 +1,85 @@
+"""Test the API client caches."""
+
+import iembot.util as botutil
+from iembot.clients import ClientCache
+
+
+class FakeSession:
+    """Records being closed."""
+
+    closed = False
+
+    def close(self):
+        """Close it."""
+        self.closed = True
+
+
+class FakeClient:
+    """Something holding a session."""
+
+    def __init__(self):
+        """Constructor"""
+        self.session = FakeSession()
+
+
+def test_client_cache():
+    """Clients are reused until the credentials change or invalidation."""
+    cache = ClientCache()
+    first = cache.get(1, ("a",), FakeClient)
+    assert cache.get(1, ("a",), FakeClient) is first
+    second = cache.get(1, ("b",), FakeClient)
+    assert second is not first
+    assert first.session.closed
+    cache.invalidate(1)
+    assert second.session.closed
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_client_cache_retain():
+    """A reload only closes the clients of accounts that went away."""
+    cache = ClientCache()
+    kept = cache.get(1, ("a",), FakeClient)
+    gone = cache.get(2, ("b",), FakeClient)
+    cache.retain({1: {}})
+    assert not kept.session.closed
+    assert gone.session.closed
+    assert cache.get(1, ("a",), FakeClient) is kept
+
+
+def test_twitter_client_reuse(bot):
+    """Tweets for the same user share the api and session."""
+    bot.config["bot.twitter.consumerkey"] = "ck"
+    bot.config["bot.twitter.consumersecret"] = "cs"
+    bot.tw_users[123] = {
+        "screen_name": "iembot",
+        "access_token": "at",
+        "access_token_secret": "ats",
+        "iem_owned": False,
+    }
+    api, auth = botutil.get_twitter_client(bot, 123)
+    assert botutil.get_twitter_client(bot, 123)[0] is api
+    bot.tw_clients.invalidate(123)
+    assert botutil.get_twitter_client(bot, 123)[0] is not api
+
+
+def test_mastodon_shared_session(bot):
+    """Accounts on one server share a session that survives reloads."""
+    bot.md_users = {
+        i: {
+            "screen_name": f"iembot{i}",
+            "access_token": f"{i}",
+            "api_base_url": "https://localhost",
+            "iem_owned": False,
+        }
+        for i in range(2)
+    }
+    api0 = botutil.get_mastodon_client(bot, 0)
+    api1 = botutil.get_mastodon_client(bot, 1)
+    assert api0 is not api1
+    assert api0.session is api1.session
+    assert botutil.get_mastodon_client(bot, 0) is api0
+    bot.md_clients.invalidate()
+    assert botutil.get_mastodon_client(bot, 0).session is api0.session
+    bot.md_sessions.prune([])
+    assert len(bot.md_sessions) == 0
@@ -0,0 +1,101 @@
+"""Test the LISTEN/NOTIFY configuration listener."""
+
+import json
+import os
+from unittest import mock
+
+import psycopg
+import pytest
+from iembot.listener import CHANNEL, ConfigListener, apply_notification
+from iembot.routing import RoutingTable
+
+SQLFN = os.path.join(
+    os.path.dirname(__file__), "..", "scripts", "iembot_notify.sql"
+)
+
+
+def test_apply_notification(bot):
+    """Row changes patch the routing tables."""
+    bot.routingtable = RoutingTable({"A": ["botstalk"]})
+    bot.fanout.plan(["A"])
+    assert apply_notification(
+        bot,
+        {
+            "table": "iembot_room_subscriptions",
+            "op": "UPDATE",
+            "old": {"roomname": "botstalk", "channel": "A"},
+            "new": {"roomname": "botstalk", "channel": "B"},
+        },
+    )
+    assert bot.routingtable == {"B": ("botstalk",)}
+    assert len(bot.fanout) == 0
+    bot.tw_users[1] = {"screen_name": "a"}
+    assert apply_notification(
+        bot,
+        {
+            "table": "iembot_twitter_subs",
+            "op": "INSERT",
+            "new": {"user_id": 1, "channel": "A"},
+        },
+    )
+    # Twitter routing is disabled, even for users with tokens
+    assert bot.tw_routingtable == {}
+    apply_notification(
+        bot,
+        {
+            "table": "iembot_webhooks",
+            "op": "INSERT",
+            "new": {"url": "http://localhost", "channel": "A"},
+        },
+    )
+    assert bot.webhooks_routingtable == {"A": ("http://localhost",)}
+    bot.reload_room = mock.Mock()
+    apply_notification(
+        bot,
+        {"table": "iembot_rooms", "op": "DELETE", "old": {"roomname": "x"}},
+    )
+    bot.reload_room.assert_called_once_with("x")
+    assert not apply_notification(bot, {"table": "iembot_unknown"})
+    # too large a row only names the table
+    assert not apply_notification(
+        bot, {"table": "iembot_webhooks", "op": "UPDATE"}
+    )
+
+
+def test_dispatch_falls_back(bot):
+    """A payload that can not be applied causes a full reload."""
+    bot.xmlstream = mock.Mock()
+    bot.load_chatrooms = mock.Mock()
+    bot.load_twitter = mock.Mock()
+    bot.load_mastodon = mock.Mock()
+    bot.load_webhooks = mock.Mock()
+    listener = ConfigListener(bot, {})
+    listener.dispatch(json.dumps({"table": "iembot_rooms", "new": {"x": 1}}))
+    bot.load_chatrooms.assert_called_once_with(False)
+    listener.dispatch(json.dumps({"table": "iembot_webhooks", "op": "x"}))
+    assert bot.load_chatrooms.call_count == 2
+
+
+@pytest.mark.parametrize("database", ["mesosite"])
+def test_triggers(bot, dbcursor):
+    """The triggers notify with the changed rows."""
+    with open(SQLFN, encoding="utf-8") as fh:
+        dbcursor.execute(fh.read())
+    dbcursor.connection.commit()
+    conninfo = psycopg.conninfo.conninfo_to_dict(dbcursor.connection.info.dsn)
+    with psycopg.connect(autocommit=True, **conninfo) as conn:
+        conn.execute(f"LISTEN {CHANNEL}")
+        dbcursor.execute(
+            "INSERT into iembot_room_subscriptions(roomname, channel) "
+            "VALUES ('listenchat', 'LISTENTEST')"
+        )
+        dbcursor.connection.commit()
+        notify = next(conn.notifies(timeout=10))
+    payload = json.loads(notify.payload)
+    assert payload["op"] == "INSERT"
+    assert apply_notification(bot, payload)
+    assert bot.routingtable["LISTENTEST"] == ("listenchat",)
+    dbcursor.execute(
+        "DELETE from iembot_room_subscriptions where channel = 'LISTENTEST'"
+    )
+    dbcursor.connection.commit()
@@ -0,0 +1,79 @@
+"""Test the media cache."""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+from iembot.media import MediaCache, sniff_mime
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+
+class FakeSession:
+    """Serve PNG bytes once released."""
+
+    def __init__(self):
+        """Constructor"""
+        self.calls = 0
+        self.release = threading.Event()
+
+    def get(self, url, timeout):
+        """Make the request."""
+        self.calls += 1
+        self.release.wait(5)
+        if url.endswith("404"):
+            raise OSError("not found")
+        return SimpleNamespace(
+            content=PNG,
+            headers={"Content-Type": "text/html"},
+            raise_for_status=lambda: None,
+        )
+
+
+def test_sniff_mime():
+    """The content wins over what the server claims."""
+    assert sniff_mime(PNG) == "image/png"
+    assert sniff_mime(b"\xff\xd8\xff\xe0") == "image/jpeg"
+    assert sniff_mime(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert sniff_mime(b"hello", "text/plain") == "text/plain"
+
+
+def test_fetch_once():
+    """Concurrent callers share one download."""
+    cache = MediaCache()
+    cache.session = FakeSession()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.fetch("a")))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    cache.session.release.set()
+    for thread in threads:
+        thread.join()
+    assert cache.session.calls == 1
+    assert len(results) == 10
+    assert results[0].mime_type == "image/png"
+    fh = cache.open("a")
+    assert fh.name == "media.png"
+    assert fh.read() == PNG
+    assert cache.hits == 10
+
+
+def test_failure_and_bounds():
+    """Failures are not cached and the LRU is bounded by size."""
+    cache = MediaCache(maxbytes=len(PNG) * 2)
+    cache.session = FakeSession()
+    cache.session.release.set()
+    with pytest.raises(OSError):
+        cache.fetch("404")
+    assert len(cache) == 0
+    for url in "abc":
+        cache.fetch(url)
+    assert len(cache) == 2
+    assert cache.size == len(PNG) * 2
+    cache.ttl = -1
+    cache.fetch("d")
+    cache.fetch("d")
+    assert cache.session.calls == 6
@@ -0,0 +1,195 @@
+"""Test the room join scheduler."""
+
+from unittest import mock
+
+from iembot.basicbot import basicbot
+from iembot.muc import (
+    FAILED,
+    JOIN_BOTSTALK,
+    JOIN_IDLE,
+    JOIN_SUBSCRIBED,
+    JOINED,
+    JoinScheduler,
+    PendingSends,
+    join_priority,
+)
+from iembot.routing import RoutingTable
+from twisted.internet.task import Clock
+from twisted.words.xish.domish import Element
+
+
+def _scheduler(**kwargs):
+    """A scheduler with a fake bot and clock."""
+    bot = mock.Mock(conference="conference.localhost")
+    bot.myjid.user = "iembot"
+    clock = Clock()
+    return JoinScheduler(bot, clock=clock, **kwargs), clock
+
+
+def _sent(scheduler):
+    """Rooms joined, in order."""
+    return [
+        call[0][0]["to"].split("@")[0]
+        for call in scheduler.bot.outbound.send.call_args_list
+    ]
+
+
+def test_join_priority():
+    """Rooms with subscriptions go first."""
+    table = RoutingTable({"A": ["dmxchat"]})
+    assert join_priority("botstalk", table) == JOIN_BOTSTALK
+    assert join_priority("dmxchat", table) == JOIN_SUBSCRIBED
+    assert join_priority("idlechat", table) == JOIN_IDLE
+
+
+def test_rate_and_priority():
+    """Joins beyond the burst are paced, more important rooms first."""
+    scheduler, clock = _scheduler(rate=2, burst=2)
+    for i in range(4):
+        scheduler.request(f"idle{i}", JOIN_IDLE)
+    assert _sent(scheduler) == ["idle0", "idle1"]
+    scheduler.request("dmxchat", JOIN_SUBSCRIBED)
+    # requesting again does not queue it twice
+    scheduler.request("dmxchat", JOIN_SUBSCRIBED)
+    clock.advance(0.5)
+    assert _sent(scheduler)[2:] == ["dmxchat"]
+    clock.advance(0.5)
+    clock.advance(0.5)
+    assert _sent(scheduler)[3:] == ["idle2", "idle3"]
+    assert scheduler.status()["muc.joins_sent"] == 5
+
+
+def test_backlog_joins_before_expiry():
+    """Waiting messages age from their room's join, not from queueing."""
+    scheduler, clock = _scheduler(rate=5, burst=10)
+    pending = PendingSends(clock=clock, max_age=10)
+    scheduler.bot.pending_sends = pending
+    for room in ("room0199", "room0198"):
+        msg = Element(("jabber:client", "message"))
+        msg["to"] = f"{room}@conference.localhost"
+        pending.add(room, msg)
+    for i in range(200):
+        scheduler.request(f"room{i:04d}")
+    # the last joins go out after 38 seconds at 5 per second
+    clock.pump([0.5] * 80)
+    assert _sent(scheduler)[-1] == "room0199"
+    pending.expire()
+    clock.advance(5)
+    sent = []
+    pending.drain("room0199", sent.append)
+    assert len(sent) == 1
+    clock.advance(10)
+    pending.expire()
+    status = pending.status()
+    assert status["muc.pending_delivered"] == 1
+    assert status["muc.pending_expired"] == 1
+
+
+def test_max_rate():
+    """The configured join rate can not exceed the maximum."""
+    scheduler, _clock = _scheduler(rate=50, max_rate=20)
+    assert scheduler.rate == 20
+    scheduler.configure({"bot.muc_join_rate": "100"})
+    assert scheduler.rate == 20
+    assert scheduler.bucket.rate == 20
+    scheduler.configure(
+        {"bot.muc_join_rate": "100", "bot.muc_join_max_rate": "40"}
+    )
+    assert scheduler.rate == 40
+
+
+def test_late_join():
+    """A self-presence after the timeout still counts as a join."""
+    scheduler, clock = _scheduler(timeout=30)
+    scheduler.request("dmxchat")
+    clock.advance(31)
+    assert scheduler.status()["muc.join_failed"] == 1
+    scheduler.on_joined("dmxchat")
+    status = scheduler.status()
+    assert status["muc.join_failed"] == 0
+    assert status["muc.joined"] == 1
+    assert status["muc.join_latency_max_ms"] == 31000
+    # a repeated self-presence is not counted again
+    scheduler.on_joined("dmxchat")
+    assert scheduler.status()["muc.joined"] == 1
+
+
+def test_all_joined():
+    """The all joined event waits on the self-presences."""
+    scheduler, clock = _scheduler(timeout=30)
+    done = []
+    scheduler.when_all_joined().addCallback(done.append)
+    assert done == [0]
+    scheduler.request("dmxchat")
+    scheduler.request("botstalk")
+    scheduler.request("gone")
+    scheduler.when_all_joined().addCallback(done.append)
+    clock.advance(2)
+    scheduler.on_joined("dmxchat")
+    scheduler.forget("gone")
+    assert done == [0]
+    clock.advance(30)
+    assert scheduler.state == {"dmxchat": JOINED, "botstalk": FAILED}
+    assert done == [0, 1]
+    status = scheduler.status()
+    assert status["muc.join_latency_max_ms"] == 2000
+    assert status["muc.join_failed"] == 1
+    scheduler.reset()
+    assert scheduler.pending == 0
+
+
+def test_pending_sends():
+    """Messages wait in order for the join, within bounds."""
+    clock = Clock()
+    pending = PendingSends(clock=clock, maxlen=2, max_age=60)
+    elem = Element(("jabber:client", "message"))
+    for i in range(3):
+        msg = Element(("jabber:client", "message"))
+        msg["to"] = "dmxchat@conference.localhost"
+        msg["id"] = str(i)
+        pending.add("dmxchat", msg)
+    # reused for another room afterwards
+    elem["to"] = "botstalk@conference.localhost"
+    pending.add("botstalk", elem)
+    elem["to"] = "other@conference.localhost"
+    clock.advance(5)
+    sent = []
+    pending.drain("dmxchat", sent.append)
+    assert [msg["id"] for msg in sent] == ["1", "2"]
+    pending.drain("botstalk", sent.append)
+    assert sent[-1]["to"] == "botstalk@conference.localhost"
+    pending.add("gone", elem)
+    # not aged until the join is sent
+    clock.advance(61)
+    pending.expire()
+    assert len(pending) == 1
+    pending.join_sent("gone")
+    clock.advance(61)
+    pending.expire()
+    status = pending.status()
+    assert status["muc.pending"] == 0
+    assert status["muc.pending_overflow"] == 1
+    assert status["muc.pending_expired"] == 1
+    assert status["muc.pending_delivered"] == 3
+    assert status["muc.pending_latency_max_ms"] == 5000
+
+
+def test_bot_flushes_on_join(xmlstream):
+    """The status 110 self-presence sends the waiting messages."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.conference = "conference.localhost"
+    bot.xmlstream = xmlstream
+    bot.rooms = {"dmxchat": {"joined": False, "occupants": {}}}
+    bot.send_groupchat("dmxchat", "Hello")
+    assert len(bot.pending_sends) == 1
+    presence = Element(("jabber:client", "presence"))
+    presence["from"] = "dmxchat@conference.localhost/iembot"
+    x = presence.addElement(("http://jabber.org/protocol/muc#user", "x"))
+    item = x.addElement("item")
+    item["affiliation"] = "owner"
+    item["role"] = "moderator"
+    x.addElement("status")["code"] = "110"
+    bot.presence_processor(presence)
+    assert bot.rooms["dmxchat"]["joined"]
+    bot.outbound.flush()
+    assert b"type='groupchat'" in xmlstream.transport.value()
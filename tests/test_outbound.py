@@ -0,0 +1,113 @@
+"""Test the outbound stanza pipeline."""
+
+from unittest import mock
+
+from iembot.outbound import OutboundQueue
+from twisted.internet.task import Clock
+from twisted.words.xish.domish import Element
+
+
+def _queue(**kwargs):
+    """A queue writing to a mock xmlstream."""
+    bot = mock.Mock()
+    bot.xmlstream.prefixes = {}
+    bot.xmlstream.namespace = "jabber:client"
+    clock = Clock()
+    return OutboundQueue(bot, clock=clock, **kwargs), clock
+
+
+def _writes(queue):
+    """The bytes of each write."""
+    return [call[0][0] for call in queue.bot.xmlstream.send.call_args_list]
+
+
+def test_tick_batching_and_priority():
+    """Stanzas queued within a tick go out together, IQ first."""
+    queue, clock = _queue()
+    queue.send(b"<message id='1'/>")
+    queue.send("<message id='2'/>")
+    ping = Element((None, "iq"))
+    ping["id"] = "ping"
+    queue.send(ping, priority=True)
+    # serialized when queued
+    ping["id"] = "changed"
+    assert _writes(queue) == []
+    clock.advance(0)
+    assert _writes(queue) == [
+        b"<iq id='ping'/><message id='1'/><message id='2'/>"
+    ]
+    status = queue.status()
+    assert status["outbound.flush_size"] == 3
+    assert status["outbound.queued"] == 0
+
+
+def test_stream_bytes(xmlstream):
+    """Flushed elements match what the XmlStream itself would write."""
+    bot = mock.Mock(xmlstream=xmlstream)
+    queue = OutboundQueue(bot, clock=Clock())
+    message = Element(("jabber:client", "message"))
+    message["to"] = "dmxchat@conference.localhost"
+    message["type"] = "groupchat"
+    message.addElement("body", content="Hello")
+    x = message.addElement(("nwschat:nwsbot", "x"))
+    x["channels"] = "DMX"
+    presence = Element(("jabber:client", "presence"))
+    presence.addElement(("http://jabber.org/protocol/muc", "x"))
+    queue.send(message)
+    queue.send(presence, priority=True)
+    queue.flush()
+    transport = xmlstream.transport
+    flushed = transport.value()
+    transport.clear()
+    xmlstream.send(presence)
+    xmlstream.send(message)
+    assert flushed == transport.value()
+    assert b"jabber:client" not in flushed
+
+
+def test_backpressure():
+    """A paused transport holds back the bulk but not presence."""
+    queue, clock = _queue(max_bytes=10)
+    transport = mock.Mock()
+    queue.attach(transport)
+    transport.registerProducer.assert_called_once_with(queue, True)
+    for i in range(3):
+        queue.send(f"<m{i}/>".encode("ascii"))
+    clock.advance(0)
+    # limited by max_bytes, the rest follows in the next tick
+    assert _writes(queue) == [b"<m0/><m1/>", b"<m2/>"]
+    queue.pauseProducing()
+    queue.send(b"<m3/>")
+    queue.send(b"<presence/>", priority=True)
+    clock.advance(0)
+    assert _writes(queue)[-1] == b"<presence/>"
+    assert len(queue) == 1
+    queue.resumeProducing()
+    clock.advance(0)
+    assert _writes(queue)[-1] == b"<m3/>"
+    assert queue.status()["outbound.pauses"] == 1
+
+
+def test_overflow_and_stop():
+    """Only a configured limit drops bulk stanzas, as does a disconnect."""
+    queue, clock = _queue()
+    queue.pauseProducing()
+    for i in range(30000):
+        queue.send(b"<m/>")
+    assert len(queue) == 30000
+    assert queue.dropped == 0
+
+    queue, clock = _queue()
+    queue.configure({"bot.outbound_max_queued": "2"})
+    with mock.patch("iembot.outbound.log") as log:
+        for i in range(3):
+            queue.send(
+                f"<message to='dmxchat@conference.localhost/iembot'>"
+                f"<x product_id='{i}'/></message>".encode("ascii")
+            )
+    assert "to dmxchat product_id: 0" in log.msg.call_args[0][0]
+    assert queue.dropped == 1
+    queue.stopProducing()
+    clock.advance(0)
+    assert _writes(queue) == []
+    assert queue.dropped == 3
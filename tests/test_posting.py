@@ -0,0 +1,143 @@
+"""Test the posting scheduler."""
+
+from iembot.posting import PostingScheduler, PostRetry
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+
+def _scheduler(workers=2):
+    """A scheduler whose jobs run when the test says so."""
+    scheduler = PostingScheduler(clock=Clock(), workers=workers)
+    scheduler.running = []
+
+    def _defer(func, *args, **kwargs):
+        df = defer.Deferred()
+        scheduler.running.append((df, func, args, kwargs))
+        return df
+
+    scheduler._defer = _defer
+    return scheduler
+
+
+def _finish(scheduler, idx=0):
+    """Run a job that was handed to the thread pool."""
+    df, func, args, kwargs = scheduler.running.pop(idx)
+    try:
+        df.callback(func(*args, **kwargs))
+    except Exception as exp:
+        df.errback(exp)
+
+
+def test_account_order_and_workers():
+    """One post per account at a time, bounded by the workers."""
+    scheduler = _scheduler()
+    results = []
+    for account, text in [("a", 1), ("a", 2), ("b", 3), ("c", 4)]:
+        scheduler.submit(account, str, text).addCallback(results.append)
+    assert [r[2] for r in scheduler.running] == [(1,), (3,)]
+    assert scheduler.queued == 2
+    _finish(scheduler)
+    # account a goes to the back of the line
+    assert [r[2] for r in scheduler.running] == [(3,), (4,)]
+    _finish(scheduler)
+    _finish(scheduler)
+    _finish(scheduler)
+    assert results == ["1", "3", "4", "2"]
+    assert scheduler.inflight == 0
+    assert not scheduler._queues
+
+
+def test_retry_without_holding_a_worker():
+    """A PostRetry frees the worker and reruns after the delay."""
+    scheduler = _scheduler(workers=1)
+    calls = []
+
+    def _post(text, media="img"):
+        calls.append(media)
+        if len(calls) == 1:
+            raise PostRetry(ValueError("boom"), 10, media=None)
+        return text
+
+    results = []
+    scheduler.submit("a", _post, "1").addCallback(results.append)
+    scheduler.submit("a", _post, "2").addCallback(results.append)
+    scheduler.submit("b", str, 3).addCallback(results.append)
+    _finish(scheduler)
+    # b runs while a backs off, a's second post waits its turn
+    assert scheduler.backoff == 1
+    assert [r[2] for r in scheduler.running] == [(3,)]
+    _finish(scheduler)
+    scheduler.clock.advance(10)
+    _finish(scheduler)
+    _finish(scheduler)
+    assert calls == ["img", None, "img"]
+    assert results == ["3", "1", "2"]
+    assert scheduler.retries == 1
+
+
+def test_retries_exhausted():
+    """The cause fails the post, or is swallowed when asked."""
+    scheduler = _scheduler()
+
+    def _post(reraise):
+        raise PostRetry(ValueError("boom"), 1, reraise=reraise)
+
+    failures = []
+    results = []
+    scheduler.submit("a", _post, True).addErrback(failures.append)
+    scheduler.submit("b", _post, False).addCallback(results.append)
+    _finish(scheduler)
+    _finish(scheduler)
+    scheduler.clock.advance(1)
+    _finish(scheduler)
+    _finish(scheduler)
+    assert failures[0].check(ValueError)
+    assert results == [None]
+
+
+def test_priority_and_gate():
+    """Important posts go first and the gate defers or drops posts."""
+    scheduler = _scheduler(workers=1)
+    decisions = {2: 0, 1: 5, 0: 0}
+    scheduler.gate = lambda account, priority: decisions[priority]
+    results = []
+    scheduler.submit("a", str, "first", priority=0).addCallback(results.append)
+    for priority, text in [(2, "low"), (1, "normal"), (0, "high")]:
+        scheduler.submit("a", str, text, priority=priority).addCallback(
+            results.append
+        )
+    _finish(scheduler)
+    _finish(scheduler)
+    # the normal post is deferred by the gate, low has to wait for it
+    assert not scheduler.running
+    assert scheduler.deferred == 1
+    decisions[1] = 0
+    decisions[2] = None
+    scheduler.clock.advance(5)
+    _finish(scheduler)
+    assert results == ["first", "high", "normal", None]
+    assert scheduler.dropped == 1
+
+
+def test_shed_and_expire():
+    """Full queues shed the least important posts, stale posts expire."""
+    scheduler = _scheduler(workers=1)
+    scheduler.max_depth = 2
+    results = []
+    scheduler.submit("a", str, "busy").addCallback(results.append)
+    for priority, text in [(1, "n1"), (2, "low"), (1, "n2"), (2, "low2")]:
+        scheduler.submit("a", str, text, priority=priority).addCallback(
+            results.append
+        )
+    # low was shed to make room for n2 and low2 was refused
+    assert results == [None, None]
+    assert scheduler.shed == 2
+    assert scheduler.queued == 2
+    scheduler.clock.advance(scheduler.max_age + 1)
+    # the oldest of equal priority is shed
+    scheduler.submit("a", str, "fresh").addCallback(results.append)
+    assert scheduler.shed == 3
+    _finish(scheduler)
+    _finish(scheduler)
+    assert results == [None, None, None, "busy", None, "fresh"]
+    assert scheduler.expired == 1
@@ -0,0 +1,76 @@
+"""Test the Twitter rate limiter."""
+
+from iembot.ratelimit import (
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    RateLimiter,
+    TokenBucket,
+    product_priority,
+    stanza_priority,
+)
+from twisted.internet.task import Clock
+from twisted.words.xish.domish import Element
+
+
+def test_product_priority():
+    """Warnings go ahead of statements."""
+    assert product_priority("202310031200-KDMX-WUUS53-SVRDMX") == PRIORITY_HIGH
+    assert product_priority("202310031200-KDMX-WWUS83-SPSDMX") == PRIORITY_LOW
+    assert product_priority("202310031200-KDMX-FXUS63-AFDDMX") == PRIORITY_LOW
+    assert product_priority("202310031200-KDMX-NOUS43-ADMDMX") == (
+        PRIORITY_NORMAL
+    )
+    assert product_priority(None) == PRIORITY_NORMAL
+
+
+def test_token_bucket():
+    """Tokens refill over the window and honor the reserve."""
+    bucket = TokenBucket(10, 100)
+    for _ in range(8):
+        assert bucket.wait(0) == 0
+        bucket.take(0)
+    assert bucket.wait(0, reserve=0.25) == 15
+    assert bucket.wait(5, reserve=0.25) == 10
+    bucket.sync(5, 20, 0, 500)
+    assert bucket.capacity == 20
+    assert bucket.wait(5) == 495
+
+
+def test_limiter_headers_and_priorities():
+    """Headers sync the budgets, low priority posts are dropped first."""
+    clock = Clock()
+    clock.advance(1000)
+    limiter = RateLimiter(clock=clock)
+    limiter.update(
+        1,
+        {
+            "x-rate-limit-limit": "100",
+            "x-rate-limit-remaining": "5",
+            "x-rate-limit-reset": "1900",
+        },
+    )
+    # 5 tokens is below the 25% low priority reserve
+    assert limiter.admit(("twitter", 1), PRIORITY_LOW) is None
+    assert limiter.admit(("twitter", 1), PRIORITY_NORMAL) > 0
+    assert limiter.admit(("twitter", 1), PRIORITY_HIGH) == 0
+    assert limiter.admit(("twitter", 2), PRIORITY_LOW) == 0
+    assert limiter.admit(("mastodon", 1), PRIORITY_LOW) == 0
+    limiter.update(
+        1, {"x-rate-limit-remaining": "0", "x-rate-limit-reset": "1900"}
+    )
+    assert limiter.admit(("twitter", 1), PRIORITY_HIGH) == 900
+    status = limiter.status()
+    assert status["ratelimit.users_waiting"] == 1
+    assert status["ratelimit.dropped"] == 1
+    assert status["ratelimit.deferred"] == 2
+
+
+def test_stanza_priority():
+    """An explicit priority attribute wins."""
+    x = Element(("", "x"))
+    x["product_id"] = "202310031200-KDMX-WUUS53-SVRDMX"
+    assert stanza_priority(x) == PRIORITY_HIGH
+    x["priority"] = "LOW"
+    assert stanza_priority(x) == PRIORITY_LOW
+    assert stanza_priority(None) == PRIORITY_NORMAL
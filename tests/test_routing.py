@@ -0,0 +1,99 @@
+"""Test the routing tables and fan-out plans."""
+
+import random
+
+import pytest
+from iembot.basicbot import basicbot
+from iembot.routing import FanoutPlanner, RoutingTable
+
+
+def test_plan_dedup_and_invalidate():
+    """Rooms subscribed to many channels are only listed once."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.routingtable = RoutingTable({"A": ["r1", "r2"], "B": ["r2", "r3"]})
+    bot.md_routingtable = RoutingTable({"A": [1], "B": [1, 2]})
+    bot.webhooks_routingtable = RoutingTable({"B": ["http://localhost"]})
+    plan = bot.fanout.plan(["B", "A"])
+    assert plan.rooms == ("r1", "r2", "r3")
+    assert plan.mastodon == (1, 2)
+    assert plan.webhooks == ("http://localhost",)
+    # Order of channels does not matter
+    assert bot.fanout.plan(["A", "B"]) is plan
+    bot.routingtable.add("C", "r4")
+    bot.fanout.invalidate()
+    assert bot.fanout.plan(["C"]).rooms == ("r4",)
+
+
+def test_plan_lru():
+    """Least recently used plans are evicted."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    planner = FanoutPlanner(bot, maxsize=2)
+    planner.plan(["A"])
+    planner.plan(["B"])
+    planner.plan(["A"])
+    planner.plan(["C"])
+    assert len(planner) == 2
+    assert frozenset(["B"]) not in planner._cache
+    assert planner.hits == 1
+
+
+def check_against_model(table, model):
+    """Compare a RoutingTable with a naive set of (channel, target) pairs."""
+    table.check()
+    assert {(c, t) for c in table for t in table[c]} == model
+    for target in {t for _c, t in model}:
+        assert set(table.channels(target)) == {
+            c for c, t in model if t == target
+        }
+    assert len(table.targets()) == len({t for _c, t in model})
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_routing_table_consistency(seed):
+    """Random operations keep both directions consistent with a model."""
+    rng = random.Random(seed)
+    channels = [f"C{i}" for i in range(8)]
+    targets = [f"r{i}" for i in range(8)]
+    table = RoutingTable()
+    model = set()
+    for _ in range(500):
+        op = rng.randrange(4)
+        channel = rng.choice(channels)
+        target = rng.choice(targets)
+        if op == 0:
+            assert table.add(channel, target) == (
+                (channel, target) not in model
+            )
+            model.add((channel, target))
+        elif op == 1:
+            assert table.remove(channel, target) == (
+                (channel, target) in model
+            )
+            model.discard((channel, target))
+        elif op == 2:
+            wanted = rng.sample(channels, rng.randrange(4))
+            table.set_channels(target, wanted)
+            model = {(c, t) for c, t in model if t != target}
+            model.update((c, target) for c in wanted)
+        else:
+            wanted = rng.sample(targets, rng.randrange(4))
+            table.set_targets(channel, wanted)
+            model = {(c, t) for c, t in model if c != channel}
+            model.update((channel, t) for t in wanted)
+        check_against_model(table, model)
+
+
+def test_routing_table():
+    """Only the target's subscriptions change, in subscription order."""
+    table = RoutingTable({"A": ["r1", "r2"], "B": ["r2"], "C": ["r1"]})
+    table.set_channels("r2", ["C", "D"])
+    assert table == {"A": ("r1",), "C": ("r1", "r2"), "D": ("r2",)}
+    assert table.channels("r1") == ("A", "C")
+    assert table.subscribed("D", "r2")
+    assert "B" not in table
+    table.set_channels("r2", [])
+    assert table == {"A": ("r1",), "C": ("r1",)}
+    assert table.channels("r2") == ()
+    table._channels["r1"].pop("A")
+    with pytest.raises(ValueError):
+        table.check()
@@ -8,7 +8,11 @@ import iembot.util as botutil
 # Third party modules
 import pytest
 from iembot.basicbot import basicbot
+from iembot.chatlog import ChatlogJournal
 from iembot.iemchatbot import JabberClient
+from iembot.muc import JoinScheduler
+from iembot.posting import PostRetry
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
 from twisted.words.xish.domish import Element
 from twitter.error import TwitterError
@@ -65,13 +69,16 @@ def test_util_toot():
             "api_base_url": "https://localhost",
         }
     }
-    botutil.toot(bot, "123", "test", sleep=0)
+    with pytest.raises(PostRetry) as exc:
+        botutil.toot(bot, "123", "test", sleep=0)
+    assert exc.value.overrides == {"twitter_media": None}
 
 
 def test_load_chatlog():
     """Test our pickling fun."""
     bot = JabberClient(None, None, xml_log_path="/tmp")
     bot.PICKLEFILE = tempfile.mkstemp()[1]
+    bot.chatlog_journal = ChatlogJournal(tempfile.mkstemp()[1])
     bot.save_chatlog()
     botutil.load_chatlog(bot)
     assert bot.seqnum == 0
@@ -106,8 +113,39 @@ def test_load_chatrooms_fromdb(dbcursor):
     bot = mock.Mock()
     bot.name = "iembot"
     bot.rooms = {}
-    botutil.load_chatrooms_from_db(dbcursor, bot, True)
-    assert bot
+    snapshot = botutil.load_chatrooms_from_db(dbcursor, bot)
+    snapshot.routingtable.check()
+    assert not bot.rooms
+
+
+def test_chatrooms_snapshot(xmlstream):
+    """The loader builds a snapshot that is then swapped in."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.xmlstream = xmlstream
+    bot.myjid = mock.Mock(user="iembot")
+    bot.conference = "conference.localhost"
+    bot.rooms = {"gone": {}, "dmxchat": {"twitter": None}}
+    txn = mock.Mock()
+    txn.fetchall.side_effect = [
+        [{"roomname": "dmxchat", "channel": "A"}],
+        [{"roomname": "dmxchat", "endpoint": "x"}],
+        [
+            {"roomname": "botstalk", "twitter": None},
+            {"roomname": "dmxchat", "twitter": "iembot"},
+        ],
+    ]
+    bot.joins = JoinScheduler(bot, clock=Clock())
+    snapshot = botutil.load_chatrooms_from_db(txn, bot)
+    assert "botstalk" not in bot.rooms
+    botutil.apply_chatrooms(snapshot, bot, False)
+    assert bot.routingtable == {"A": ("dmxchat",)}
+    assert bot.syndication == {"dmxchat": ["x"]}
+    assert sorted(bot.rooms) == ["botstalk", "dmxchat"]
+    assert bot.rooms["dmxchat"]["twitter"] == "iembot"
+    # only the new room is joined
+    assert bot.joins.state == {"botstalk": "joining"}
+    bot.outbound.flush()
+    assert b"type='unavailable'" in xmlstream.transport.value()
 
 
 def test_daily_timestamp():
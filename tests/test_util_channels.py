@@ -1,11 +1,18 @@
 """Test things done with channel subs."""
 
+from unittest import mock
+
 import pytest
+from iembot.routing import RoutingTable
 from iembot.util import (
+    apply_channel_config,
+    apply_room_config,
+    apply_twitter_user,
     channels_room_add,
     channels_room_del,
     channels_room_list,
 )
+from twisted.words.protocols.jabber.jid import JID
 
 
 @pytest.mark.parametrize("database", ["mesosite"])
@@ -22,3 +29,67 @@ def test_room_list(bot, dbcursor):
     channels_room_list(bot, "test")
 
     channels_room_del(dbcursor, bot, "test", "XXX")
+
+
+def test_room_add_del(bot):
+    """Subscriptions keep both directions of the routing table in sync."""
+    txn = mock.Mock()
+    txn.rowcount = 1
+    bot.send_groupchat = mock.Mock()
+    channels_room_add(txn, bot, "dmxchat", "a, b")
+    assert bot.routingtable.channels("dmxchat") == ("A", "B")
+    msg = bot.send_groupchat.call_args[0][1]
+    assert msg == "This room is subscribed to 2 channels (['A', 'B'])"
+    channels_room_add(txn, bot, "dmxchat", "A")
+    assert "already subscribed" in bot.send_groupchat.call_args_list[-2][0][1]
+    channels_room_del(txn, bot, "dmxchat", "A,C")
+    assert bot.routingtable == {"B": ("dmxchat",)}
+    bot.routingtable.check()
+    assert len(bot.fanout) == 0
+
+
+def test_scoped_reloads(bot, xmlstream):
+    """Room, channel and account reloads patch the running bot."""
+    bot.xmlstream = xmlstream
+    bot.myjid = JID("iembot@localhost/twisted_words")
+    bot.conference = "conference.localhost"
+    bot.routingtable = RoutingTable(
+        {"A": ["dmxchat", "botstalk"], "B": ["dmxchat"]}
+    )
+    bot.fanout.plan(["A"])
+    config = {"twitter": None, "channels": ["B", "C"], "syndication": []}
+    apply_room_config(config, bot, "dmxchat")
+    assert bot.routingtable == {
+        "A": ("botstalk",),
+        "B": ("dmxchat",),
+        "C": ("dmxchat",),
+    }
+    assert "dmxchat" in bot.rooms
+    assert len(bot.fanout) == 0
+    bot.rooms["dmxchat"]["joined"] = True
+    bot.send_groupchat("dmxchat", "Hello")
+    apply_room_config(None, bot, "dmxchat")
+    assert "dmxchat" not in bot.rooms
+    bot.outbound.flush()
+    sent = xmlstream.transport.value()
+    # the leave follows the message queued for the room
+    assert sent.index(b"type='groupchat'") < sent.index(b"'unavailable'")
+
+    config = {
+        "rooms": ["botstalk"],
+        "mastodon": [],
+        "webhooks": ["http://localhost"],
+        "webhooks_batching": {"http://localhost": (0.5, 10)},
+    }
+    apply_channel_config(config, bot, "A")
+    assert bot.webhooks_routingtable == {"A": ("http://localhost",)}
+    assert bot.webhooks_batching == {"http://localhost": (0.5, 10)}
+
+    # Twitter routing stays off, as with a full load_twitter_from_db
+    user = {"screen_name": "iembot"}
+    apply_twitter_user({"user": user}, bot, 1)
+    assert bot.tw_users[1] == user
+    assert bot.tw_routingtable == {}
+    apply_twitter_user(None, bot, 1)
+    assert 1 not in bot.tw_users
+    bot.routingtable.check()
@@ -0,0 +1,141 @@
+"""Test the webhooks client."""
+
+import json
+
+from iembot.webhooks import WebhookBatcher, WebhookClient, WebhookError
+from twisted.internet import defer
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+
+class FakeResponse:
+    """Just enough of IResponse for readBody."""
+
+    phrase = b"OK"
+
+    def __init__(self, code, body=b"ok"):
+        """Constructor"""
+        self.code = code
+        self.body = body
+
+    def deliverBody(self, protocol):
+        """Send the body."""
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class FakeAgent:
+    """Hand out the deferreds the test fires."""
+
+    def __init__(self):
+        """Constructor"""
+        self.requests = []
+        self.kwargs = []
+
+    def request(self, **kwargs):
+        """Record the request."""
+        d = defer.Deferred()
+        self.requests.append((kwargs["uri"], d))
+        self.kwargs.append(kwargs)
+        return d
+
+
+def test_retry_and_stats():
+    """Server errors are retried with backoff before succeeding."""
+    clock = Clock()
+    agent = FakeAgent()
+    client = WebhookClient(clock=clock, agent=agent, backoff=1)
+    results = []
+    client.post("https://localhost/secret", b"{}").addCallback(results.append)
+    agent.requests[0][1].callback(FakeResponse(503))
+    assert len(agent.requests) == 1
+    clock.advance(1)
+    clock.advance(0.5)
+    agent.requests[1][1].callback(FakeResponse(200))
+    assert results == [b"ok"]
+    (label,) = client.stats
+    assert label.startswith("localhost#")
+    assert "secret" not in label
+    stats = client.stats[label]
+    assert stats["success"] == 1
+    assert stats["retries"] == 1
+    assert stats["latency_ms"] == 500
+
+
+def test_client_error_fails_fast():
+    """A 4xx other than 429 is not retried."""
+    agent = FakeAgent()
+    client = WebhookClient(clock=Clock(), agent=agent)
+    failures = []
+    client.post("https://localhost/", b"{}").addErrback(failures.append)
+    agent.requests[0][1].callback(FakeResponse(404))
+    assert failures[0].check(WebhookError)
+    assert len(agent.requests) == 1
+
+
+def test_retry_only_undelivered():
+    """Connection failures are retried, a timed out response is not."""
+    clock = Clock()
+    agent = FakeAgent()
+    client = WebhookClient(clock=clock, agent=agent, backoff=1, timeout=5)
+    failures = []
+    client.post("https://localhost/", b"{}").addErrback(failures.append)
+    agent.requests[0][1].errback(ConnectionRefusedError())
+    clock.advance(1)
+    assert len(agent.requests) == 2
+    # the server may have accepted the post, so do not send it again
+    clock.advance(5)
+    assert failures[0].check(defer.TimeoutError)
+    clock.advance(60)
+    assert len(agent.requests) == 2
+
+
+def test_per_host_limit_and_timeout():
+    """Requests beyond the host limit wait, a stuck request times out."""
+    clock = Clock()
+    agent = FakeAgent()
+    client = WebhookClient(clock=clock, agent=agent, retries=0)
+    client.configure(
+        {"bot.webhook_max_per_host": "1", "bot.webhook_timeout": "5"}
+    )
+    failures = []
+    client.post("https://localhost/a", b"{}").addErrback(failures.append)
+    client.post("https://localhost/b", b"{}")
+    client.post("https://example.com/c", b"{}").addErrback(failures.append)
+    assert [uri for uri, _ in agent.requests] == [
+        b"https://localhost/a",
+        b"https://example.com/c",
+    ]
+    clock.advance(5)
+    assert failures[0].check(defer.TimeoutError)
+    assert agent.requests[-1][0] == b"https://localhost/b"
+
+
+def test_batcher():
+    """Messages are coalesced per hook and sent in order."""
+    clock = Clock()
+    agent = FakeAgent()
+    client = WebhookClient(clock=clock, agent=agent)
+    batcher = WebhookBatcher(client, clock=clock)
+    batcher.add("https://localhost/a", "1", 0.5, 3)
+    batcher.add("https://localhost/a", "2", 0.5, 3)
+    assert not agent.requests
+    clock.advance(0.5)
+    assert len(agent.requests) == 1
+    # the window is held open while the first batch is in flight
+    for text in "34567":
+        batcher.add("https://localhost/a", text, 0.5, 3)
+    clock.advance(1)
+    assert len(agent.requests) == 1
+    agent.requests[0][1].callback(FakeResponse(200))
+    agent.requests[1][1].callback(FakeResponse(200))
+    assert len(agent.requests) == 3
+    assert batcher.batches == 3
+    assert batcher.messages == 7
+    bodies = [
+        json.loads(args["bodyProducer"]._inputFile.getvalue())["text"]
+        for args in agent.kwargs
+    ]
+    assert bodies == ["1\n\n2", "3\n\n4\n\n5", "6\n\n7"]
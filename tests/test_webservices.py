@@ -1,7 +1,18 @@
 """Try to test the webservices."""
+import gzip
+import json
+import time
+from unittest import mock
 
+import iembot.util as botutil
+from feedgen.feed import FeedGenerator
 from iembot import webservices
-from iembot.basicbot import basicbot
+from iembot.basicbot import ROOM_LOG_ENTRY, basicbot
+from iembot.chatlog import RoomLog
+from twisted.internet.task import Clock
+from twisted.web import http
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
 
 
 def test_status():
@@ -11,8 +22,275 @@ def test_status():
     assert ss.render(None) is not None
 
 
+def test_reload_scoped():
+    """Reloads can be limited to a room, channel or account."""
+    bot = mock.Mock()
+    rc = webservices.ReloadChannel(bot)
+    req = _request("/reload", room="dmxchat", twitter="123")
+    assert rc.render(req) == b'"OK"'
+    bot.reload_room.assert_called_once_with("dmxchat")
+    bot.reload_twitter_user.assert_called_once_with(123)
+    bot.load_chatrooms.assert_not_called()
+    req = _request("/reload", mastodon="abc")
+    rc.render(req)
+    assert req.responseCode == 400
+    bot.reload_mastodon_user.assert_not_called()
+
+
 def test_api():
     """Can we import API?"""
     bot = basicbot("iembot", None, xml_log_path="/tmp")
     res = webservices.wfo_rss(bot, "dmxchat")
     assert res is not None
+
+
+def _log(bot, seqnum, room="dmxchat"):
+    """Log a message to the room."""
+    bot.append_chatlog(
+        room,
+        ROOM_LOG_ENTRY(
+            seqnum=seqnum,
+            timestamp=1696334400 + seqnum,
+            log=f"<p>Message {seqnum} &amp; °</p>",
+            author="iembot",
+            product_id="",
+            product_text="",
+            txtlog="",
+        ),
+        journal=False,
+    )
+
+
+def _request(uri, **kwargs):
+    """Build a request."""
+    req = DummyRequest([b""])
+    req.uri = uri.encode("utf-8")
+    req.args = {
+        k.encode("utf-8"): [v.encode("utf-8")] for k, v in kwargs.items()
+    }
+    return req
+
+
+def test_roomchannel():
+    """Test that we get the messages since the given seqnum."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    for seqnum in range(1, 5):
+        _log(bot, seqnum)
+    rc = webservices.RoomChannel(bot)
+    req = _request("/room/dmxchat?seqnum=2", seqnum="2")
+    res = rc.render(req)
+    assert res == json.dumps(
+        {
+            "messages": [
+                {
+                    "seqnum": seqnum,
+                    "ts": f"2023-10-03 12:00:0{seqnum}",
+                    "author": "iembot",
+                    "product_id": "",
+                    "message": f"<p>Message {seqnum} &amp; °</p>",
+                }
+                for seqnum in [3, 4]
+            ]
+        }
+    ).encode("utf-8")
+    req = _request("/room/dmxchat?seqnum=4", seqnum="4")
+    assert rc.render(req) == b'{"messages": []}'
+
+
+def test_roomchannel_longpoll(monkeypatch):
+    """Long-poll requests are answered by new messages or timeouts."""
+    clock = Clock()
+    monkeypatch.setattr(webservices, "reactor", clock)
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    _log(bot, 1)
+    rc = webservices.RoomChannel(bot)
+    req = _request("/room/dmxchat?seqnum=1&wait=20", seqnum="1", wait="20")
+    assert rc.render(req) == NOT_DONE_YET
+    assert bot.chatlog_watchers.count == 1
+    _log(bot, 2)
+    assert req.finished == 1
+    assert json.loads(req.written[0])["messages"][0]["seqnum"] == 2
+    assert bot.chatlog_watchers.count == 0
+    assert not clock.getDelayedCalls()
+
+    req = _request("/room/dmxchat?seqnum=2&wait=20", seqnum="2", wait="20")
+    assert rc.render(req) == NOT_DONE_YET
+    clock.advance(20)
+    assert req.written == [b'{"messages": []}']
+    assert bot.chatlog_watchers.count == 0
+
+    bot.config["bot.json_max_watchers"] = "0"
+    req = _request("/room/dmxchat?seqnum=2&wait=20", seqnum="2", wait="20")
+    assert rc.render(req) == b'{"messages": []}'
+
+
+def test_roomchannel_bad_wait(monkeypatch):
+    """A wait that is not a number is an error, others are clamped."""
+    clock = Clock()
+    monkeypatch.setattr(webservices, "reactor", clock)
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    _log(bot, 1)
+    rc = webservices.RoomChannel(bot)
+    for wait in ("abc", "nan"):
+        uri = f"/room/dmxchat?seqnum=1&wait={wait}"
+        req = _request(uri, seqnum="1", wait=wait)
+        assert rc.render(req) == b'"ERROR"'
+    req = _request("/room/dmxchat?seqnum=1&wait=-5", seqnum="1", wait="-5")
+    assert rc.render(req) == b'{"messages": []}'
+    bot.config["bot.json_longpoll_timeout"] = "10"
+    req = _request("/room/dmxchat?seqnum=1&wait=1e9", seqnum="1", wait="1e9")
+    assert rc.render(req) == NOT_DONE_YET
+    clock.advance(10)
+    assert req.finished == 1
+
+
+def test_roomstream(monkeypatch):
+    """Test the server-sent events stream."""
+    clock = Clock()
+    monkeypatch.setattr(webservices, "reactor", clock)
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    _log(bot, 1)
+    _log(bot, 2)
+    rs = webservices.RoomStream(bot)
+    req = _request("/stream/dmxchat?seqnum=1", seqnum="1")
+    assert rs.render(req) == NOT_DONE_YET
+    _log(bot, 3)
+    _log(bot, 4, room="botstalk")
+    body = b"".join(req.written).decode("utf-8")
+    assert body.startswith("id: 2\ndata: {")
+    assert body.count("\n\n") == 2
+    clock.advance(webservices.STREAM_TIMEOUT)
+    assert req.finished == 1
+    assert bot.chatlog_watchers.count == 0
+
+
+def test_rss_not_modified():
+    """A current client gets a 304 without any feed generation."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    _log(bot, 1)
+    service = webservices.RSSService(bot)
+    req = _request("/room/dmxchat.xml")
+    assert service.render(req).startswith(b"<?xml")
+    etag = req.responseHeaders.getRawHeaders("etag")[0]
+    lastmod = req.responseHeaders.getRawHeaders("last-modified")[0]
+    assert etag == '"dmxchat-1"'
+
+    webservices.XML_CACHE.clear()
+    webservices.XML_CACHE_EXPIRES.clear()
+    with mock.patch.object(webservices, "FeedGenerator") as fg:
+        req = _request("/room/dmxchat.xml")
+        req.requestHeaders.setRawHeaders("if-none-match", [etag])
+        assert service.render(req) == b""
+        assert req.responseCode == 304
+        req = _request("/room/dmxchat.xml")
+        req.requestHeaders.setRawHeaders("if-modified-since", [lastmod])
+        assert service.render(req) == b""
+        assert req.responseCode == 304
+        fg.assert_not_called()
+
+    # A new message changes the validators
+    _log(bot, 2)
+    req = _request("/room/dmxchat.xml")
+    req.requestHeaders.setRawHeaders("if-none-match", [etag])
+    assert service.render(req).startswith(b"<?xml")
+    assert req.responseCode == 200
+
+
+def test_not_modified_same_second():
+    """If-Modified-Since can not vouch for the current second."""
+    now = int(time.time())
+    req = _request("/room/dmxchat.xml")
+    req.requestHeaders.setRawHeaders(
+        "if-modified-since", [http.datetimeToString(now)]
+    )
+    assert not webservices.not_modified(req, '"dmxchat-2"', now)
+    assert req.responseCode != 304
+    # The ETag identifies the exact message, so it still works
+    req = _request("/room/dmxchat.xml")
+    req.requestHeaders.setRawHeaders("if-none-match", ['"dmxchat-2"'])
+    assert webservices.not_modified(req, '"dmxchat-2"', now)
+
+
+def test_roomchannel_not_modified():
+    """The JSON service supports conditional requests."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    _log(bot, 1)
+    rc = webservices.RoomChannel(bot)
+    req = _request("/room/dmxchat?seqnum=0", seqnum="0")
+    rc.render(req)
+    etag = req.responseHeaders.getRawHeaders("etag")[0]
+    req = _request("/room/dmxchat?seqnum=0", seqnum="0")
+    req.requestHeaders.setRawHeaders("if-none-match", [f'{etag}, W/"x"'])
+    assert rc.render(req) == b""
+    assert req.responseCode == 304
+
+
+def test_rss_legacy_name_gzip():
+    """A 4 character feed name uses the room's validators and caches."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    _log(bot, 1, room="dmxchat")
+    service = webservices.RSSService(bot)
+    xml = service.render(_request("/room/dmxchat.xml"))
+    req = _request("/room/kdmx.xml")
+    req.requestHeaders.setRawHeaders("accept-encoding", ["gzip"])
+    res = service.render(req)
+    assert gzip.decompress(res) == xml
+    assert req.responseHeaders.getRawHeaders("etag") == ['"dmxchat-1-gzip"']
+
+
+def test_rss_gzip():
+    """Compressed feeds are built once and served when accepted."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    _log(bot, 1, room="botstalk")
+    service = webservices.RSSService(bot)
+    req = _request("/room/botstalk.xml")
+    xml = service.render(req)
+    req = _request("/room/botstalk.xml")
+    req.requestHeaders.setRawHeaders("accept-encoding", ["br;q=0, gzip"])
+    res = service.render(req)
+    assert req.responseHeaders.getRawHeaders("content-encoding") == ["gzip"]
+    assert req.responseHeaders.getRawHeaders("etag") == ['"botstalk-1-gzip"']
+    assert gzip.decompress(res) == xml
+    req = _request("/room/botstalk.xml")
+    req.requestHeaders.setRawHeaders("accept-encoding", ["gzip"])
+    assert service.render(req) is res
+
+
+def test_rss_incremental():
+    """Cached items give the same document as a full FeedGenerator build."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.chatlog["botstalk"] = RoomLog(capacity=3)
+    for seqnum in range(1, 3):
+        _log(bot, seqnum, room="botstalk")
+    webservices.wfo_rss(bot, "botstalk")
+    for seqnum in range(3, 6):
+        _log(bot, seqnum, room="botstalk")
+    xml = webservices.wfo_rss(bot, "botstalk")
+    assert list(webservices.RSS_ITEM_CACHE["botstalk"]) == [5, 4, 3]
+
+    rss = FeedGenerator()
+    rss.generator("iembot")
+    rss.title("botstalk IEMBot RSS Feed")
+    rss.link(
+        href="https://weather.im/iembot-rss/room/botstalk.xml", rel="self"
+    )
+    rss.description("botstalk IEMBot RSS Feed")
+    rss.lastBuildDate("Tue, 03 Oct 2023 12:00:05 GMT")
+    for entry in reversed(bot.chatlog["botstalk"]):
+        botutil.add_entry_to_rss(entry, rss)
+    assert xml == rss.rss_str()
+
+
+def test_negotiate_encoding():
+    """Test our Accept-Encoding parsing."""
+    req = _request("/")
+    assert webservices.negotiate_encoding(req, ["gzip"]) is None
+    for header, ans in [
+        ("gzip, deflate", "gzip"),
+        ("gzip;q=0", None),
+        ("*", "br"),
+        ("identity", None),
+        ("deflate, br;q=0.5", "br"),
+    ]:
+        req.requestHeaders.setRawHeaders("accept-encoding", [header])
+        assert webservices.negotiate_encoding(req, ["br", "gzip"]) == ans
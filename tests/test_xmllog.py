@@ -0,0 +1,51 @@
+"""Test the buffered xmllog."""
+
+import gzip
+import os
+import tempfile
+
+import iembot.util as botutil
+from iembot.basicbot import basicbot
+from iembot.xmllog import XMLLogWriter
+
+
+def test_write_flush_and_drop():
+    """Chunks are buffered, dropped on overflow and written on flush."""
+    tmpdir = tempfile.mkdtemp()
+    xl = XMLLogWriter("xmllog", tmpdir, maxlen=2)
+    xl._thread = object()  # prevent the writer thread from starting
+    for i in range(3):
+        xl.write("SEND", f"<message id='{i}'/>".encode("utf-8"))
+    assert xl.dropped == 1
+    xl._thread = None
+    xl.flush()
+    with open(os.path.join(tmpdir, "xmllog"), encoding="utf-8") as fh:
+        lines = fh.readlines()
+    assert len(lines) == 2
+    assert lines[0].endswith(" SEND <message id='1'/>\n")
+
+
+def test_sampling():
+    """Directions can be disabled."""
+    xl = XMLLogWriter("xmllog", tempfile.mkdtemp())
+    xl.configure({"bot.xmllog_sample_recv": "0"})
+    xl.write("RECV", b"<presence/>")
+    assert not xl.buffer
+    xl.write("SEND", b"<presence/>")
+    xl.stop()
+    assert xl.written == 1
+
+
+def test_rotate_compress_and_purge():
+    """Rotated files are compressed and still purged."""
+    tmpdir = tempfile.mkdtemp()
+    xl = XMLLogWriter("xmllog", tmpdir)
+    xl.configure({"bot.xmllog_compression": "gzip"})
+    xl.logfile.write("hello\n")
+    xl.logfile.lastDate = (2000, 1, 2)
+    xl.logfile.rotate()
+    with gzip.open(os.path.join(tmpdir, "xmllog.2000_1_2.gz")) as fh:
+        assert fh.read() == b"hello\n"
+    bot = basicbot("iembot", None, xml_log_path=tmpdir)
+    botutil.purge_logs(bot)
+    assert not os.path.isfile(os.path.join(tmpdir, "xmllog.2000_1_2.gz"))